@@ -0,0 +1,360 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Stand-ins for Bedrock and DingTalk, and a DynamoDB capacity meter.
+
+They only reproduce what the handlers rely on: the shape of the responses, the
+latencies and the rate limits, so a load test measures the bot rather than the
+network.
+"""
+
+import asyncio
+import base64
+import json
+import math
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class FakeBedrockRuntime:
+    """bedrock-runtime client streaming a fixed answer at a tunable pace.
+
+    Understands both the text completion and the messages API bodies, so it can
+    stand in for any model of `supported_models`.
+
+    :param time_to_first_token: seconds before the first chunk
+    :param tokens_per_second: pace of the following chunks
+    :param response_tokens: words of each answer, one per chunk
+    """
+
+    def __init__(
+        self,
+        time_to_first_token: float = 0.5,
+        tokens_per_second: float = 50,
+        response_tokens: int = 100,
+    ):
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def chunks(self, body: Dict[str, Any]) -> List[Dict[str, Any]]:
+        words = [f"word{i} " for i in range(self.response_tokens)]
+        if "messages" not in body:
+            return [{"completion": word} for word in words]
+        return [
+            {
+                "type": "message_start",
+                "message": {"usage": {"input_tokens": len(json.dumps(body)) // 4}},
+            },
+            *(
+                {"type": "content_block_delta", "delta": {"text": word}}
+                for word in words
+            ),
+            {"type": "content_block_stop"},
+            {"type": "message_delta", "usage": {"output_tokens": len(words)}},
+        ]
+
+    def _events(self, chunks: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        time.sleep(self.time_to_first_token)
+        for position, chunk in enumerate(chunks):
+            if position:
+                time.sleep(1 / self.tokens_per_second)
+            yield {"chunk": {"bytes": json.dumps(chunk).encode()}}
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        with self._lock:
+            self.calls += 1
+        return {"body": self._events(self.chunks(json.loads(body)))}
+
+    def invoke_model(self, modelId, body, **kwargs):
+        """Non-streaming call, used for summaries."""
+        with self._lock:
+            self.calls += 1
+        time.sleep(
+            self.time_to_first_token + self.response_tokens / self.tokens_per_second
+        )
+        text = "".join(f"word{i} " for i in range(self.response_tokens))
+        payload = (
+            {"content": [{"type": "text", "text": text}]}
+            if "messages" in json.loads(body)
+            else {"completion": text}
+        )
+        return {"body": _Body(json.dumps(payload).encode())}
+
+
+class _Body:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def read(self) -> bytes:
+        return self.data
+
+
+class FakeAsyncBedrock(FakeBedrockRuntime):
+    """`AsyncBedrockClient` stand-in with the same pace, for the asyncio handler."""
+
+    def for_region(self, region_name):
+        return self
+
+    async def invoke_model_with_response_stream(self, model_id, body):
+        with self._lock:
+            self.calls += 1
+        await asyncio.sleep(self.time_to_first_token)
+        for position, chunk in enumerate(self.chunks(body)):
+            if position:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            yield chunk
+
+
+class RateLimiter:
+    """Token bucket of `rate` calls per second, unlimited if 0."""
+
+    def __init__(self, rate: float = 0, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if not self.rate:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class FakeDingTalk:
+    """DingTalk card and text replies with a latency and an app-wide QPS limit.
+
+    Its methods replace `reply_card`, `update_card` and `reply_text` of a
+    handler and return what the SDK returns: the card biz id or "" for cards,
+    the response body or the HTTP status for updates. The `*_async` methods
+    do the same for `AsyncDingTalkReplier`.
+
+    :param latency: seconds per call
+    :param qps: card calls per second allowed for the app, 0 for no limit.
+        Calls over the limit are answered with 403, like DingTalk does.
+    """
+
+    def __init__(self, latency: float = 0.05, qps: float = 0):
+        self.latency = latency
+        self.limiter = RateLimiter(qps)
+        self._lock = threading.Lock()
+        self.counts = Counter()
+        # Message id -> monotonic time of the first card, for time to first text.
+        self.first_card_at: Dict[str, float] = {}
+        self.texts: Dict[str, str] = {}
+        self._next_card = 0
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counts[name] += 1
+
+    def _reply_card(self, card_data, incoming_message) -> str:
+        if not self.limiter.allow():
+            self._count("card_replies_throttled")
+            return ""
+        self._count("card_replies")
+        with self._lock:
+            self._next_card += 1
+            card_biz_id = f"card-{self._next_card}"
+            self.first_card_at.setdefault(incoming_message.message_id, time.monotonic())
+        return card_biz_id
+
+    def _update_card(self, card_biz_id, card_data):
+        if not self.limiter.allow():
+            self._count("card_updates_throttled")
+            return 403
+        self._count("card_updates")
+        return {"success": True}
+
+    def _reply_text(self, text, incoming_message):
+        self._count("text_replies")
+        with self._lock:
+            self.texts[incoming_message.message_id] = text
+        return {"errcode": 0}
+
+    def reply_card(self, card_data, incoming_message, at_sender=False, **kwargs):
+        time.sleep(self.latency)
+        return self._reply_card(card_data, incoming_message)
+
+    def update_card(self, card_biz_id, card_data):
+        time.sleep(self.latency)
+        return self._update_card(card_biz_id, card_data)
+
+    def reply_text(self, text, incoming_message, **kwargs):
+        time.sleep(self.latency)
+        return self._reply_text(text, incoming_message)
+
+    async def reply_card_async(self, card_data, incoming_message):
+        await asyncio.sleep(self.latency)
+        return self._reply_card(card_data, incoming_message)
+
+    async def update_card_async(self, card_biz_id, card_data):
+        await asyncio.sleep(self.latency)
+        return self._update_card(card_biz_id, card_data)
+
+    async def reply_text_async(self, text, incoming_message):
+        await asyncio.sleep(self.latency)
+        return self._reply_text(text, incoming_message)
+
+    def replier(self):
+        """`AsyncDingTalkReplier` stand-in."""
+        return _AsyncReplier(self)
+
+
+class _AsyncReplier:
+    def __init__(self, dingtalk: FakeDingTalk):
+        self.reply_card = dingtalk.reply_card_async
+        self.update_card = dingtalk.update_card_async
+        self.reply_text = dingtalk.reply_text_async
+
+
+def attribute_size(value: Dict[str, Any]) -> int:
+    """Approximate DynamoDB size of a low-level attribute value, in bytes."""
+    ((kind, data),) = value.items()
+    if kind == "S":
+        return len(data.encode())
+    if kind == "N":
+        return len(data.lstrip("-").replace(".", "")) // 2 + 1
+    if kind == "B":
+        # Base64 text in serialized requests, bytes in parsed responses.
+        return len(base64.b64decode(data)) if isinstance(data, str) else len(data)
+    if kind in ("BOOL", "NULL"):
+        return 1
+    if kind == "L":
+        return 3 + sum(1 + attribute_size(element) for element in data)
+    if kind == "M":
+        return 3 + sum(
+            1 + len(name.encode()) + attribute_size(element)
+            for name, element in data.items()
+        )
+    if kind in ("SS", "NS", "BS"):
+        return sum(len(str(element)) for element in data)
+    return 0
+
+
+def item_size(item: Dict[str, Any]) -> int:
+    return sum(
+        len(name.encode()) + attribute_size(value) for name, value in item.items()
+    )
+
+
+def read_units(size: int, consistent: bool) -> float:
+    return math.ceil(max(size, 1) / 4096) * (1 if consistent else 0.5)
+
+
+def write_units(size: int) -> float:
+    return math.ceil(max(size, 1) / 1024)
+
+
+class CapacityMeter:
+    """Counts DynamoDB calls and the capacity units they would consume.
+
+    Hooks into a boto3 DynamoDB client and prices every call from the size of
+    the items it reads and writes, as on-demand tables are billed. Local
+    stand-ins such as moto report a flat capacity regardless of size.
+    Updates and deletes are priced by the item after the update, respectively
+    the deleted item, which it asks for with `ReturnValues`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.read_units = 0.0
+        self.write_units = 0.0
+        self._params = threading.local()
+
+    def attach(self, client) -> "CapacityMeter":
+        events = client.meta.events
+        events.register("provide-client-params.dynamodb.*", self._ask_for_items)
+        events.register("before-call.dynamodb.*", self._remember_params)
+        # Before boto3 turns the attribute values into Python types.
+        events.register_first("after-call.dynamodb.*", self._measure)
+        return self
+
+    @staticmethod
+    def _ask_for_items(params, model, **kwargs):
+        if model.name == "UpdateItem":
+            params.setdefault("ReturnValues", "ALL_NEW")
+        elif model.name == "DeleteItem":
+            params.setdefault("ReturnValues", "ALL_OLD")
+
+    def _remember_params(self, params, model, **kwargs):
+        # The serialized request, whose JSON body holds the low-level values.
+        body = params.get("body") or b"{}"
+        self._params.value = json.loads(body)
+
+    def _measure(self, http_response, parsed, model, **kwargs):
+        params = getattr(self._params, "value", None) or {}
+        name = model.name
+        reads = writes = 0.0
+        consistent = bool(params.get("ConsistentRead"))
+        if name == "GetItem":
+            reads = read_units(item_size(parsed.get("Item", {})), consistent)
+        elif name == "Query" or name == "Scan":
+            reads = read_units(
+                sum(item_size(item) for item in parsed.get("Items", [])), consistent
+            )
+        elif name == "BatchGetItem":
+            reads = sum(
+                read_units(item_size(item), False)
+                for items in parsed.get("Responses", {}).values()
+                for item in items
+            )
+        elif name == "PutItem":
+            writes = write_units(item_size(params.get("Item", {})))
+        elif name == "UpdateItem" or name == "DeleteItem":
+            writes = write_units(item_size(parsed.get("Attributes", {})))
+        elif name == "BatchWriteItem":
+            writes = sum(
+                write_units(item_size(request.get("PutRequest", {}).get("Item", {})))
+                for requests in params.get("RequestItems", {}).values()
+                for request in requests
+            )
+        with self._lock:
+            self.calls[name] += 1
+            self.read_units += reads
+            self.write_units += writes
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "read_units": self.read_units,
+                "write_units": self.write_units,
+            }
+
+
+class LatencyRecorder:
+    """Arrival and completion times of the messages of a load test."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.arrived: Dict[str, float] = {}
+        self.completed: Dict[str, float] = {}
+        self.turns = 0
+
+    def arrive(self, message_id: str) -> None:
+        with self._lock:
+            self.arrived[message_id] = time.monotonic()
+
+    def complete(self, message_ids: List[str]) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self.turns += 1
+            for message_id in message_ids:
+                self.completed[message_id] = now
@@ -0,0 +1,174 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Stored bytes and capacity units per turn of each history codec.
+
+    python -m benchmarks.history_codec --turns 50 --storage-mode item
+
+Plays the same conversation against moto once per `HISTORY_CODEC`: every turn
+reads the recent history, as a reply does, then appends the question and the
+answer. The DynamoDB calls are priced with the `CapacityMeter` of the load
+test. The report has, for each codec, the stored bytes of the conversation and
+the read and write units per turn, on average and for the last turn, where the
+single-item layout is largest, with the change from "json".
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import Any, Dict, List
+
+from .fakes import CapacityMeter, item_size
+from .load_test import TABLE_NAME, create_table
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../dingtalk_app"))
+
+QUESTIONS = [
+    "帮我总结一下这份季度报告的要点",
+    "How do I rotate the credentials of the DingTalk app without a restart?",
+    "这个错误是什么意思：ThrottlingException when calling InvokeModel",
+    "Write a short announcement for the team about the new release",
+]
+ANSWERS = [
+    "这份报告主要有三个要点：第一，收入同比增长百分之十二，主要来自新客户；"
+    "第二，运营成本下降，因为迁移到了按需计费的数据库；第三，下季度的重点是"
+    "提升客户留存率，并在两个新地区上线服务。",
+    "Store the AppKey and AppSecret in Secrets Manager and let the service read "
+    "the secret again in the background. When the value changes, the next "
+    "stream connection and the next access token use the new credentials, so "
+    "the running task keeps answering while the secret is rotated.",
+    "ThrottlingException 表示请求超过了模型的调用配额。可以稍后重试，"
+    "使用指数退避，或者申请提高配额，也可以把请求分散到多个区域。",
+    "Hi team, the new release is out. Replies start streaming sooner, resets "
+    "are instant and conversation history costs less to store. Thanks to "
+    "everyone who tested the preview and sent feedback.",
+]
+
+
+def conversation(turns: int) -> List[List[Any]]:
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    return [
+        [
+            HumanMessage(content=QUESTIONS[turn % len(QUESTIONS)]),
+            AIMessage(content=ANSWERS[turn % len(ANSWERS)]),
+        ]
+        for turn in range(turns)
+    ]
+
+
+def stored_bytes(client, storage_mode: str, session_id: str) -> int:
+    """Size of the stored conversation, as DynamoDB counts it."""
+    if storage_mode == "item":
+        item = client.get_item(
+            TableName=TABLE_NAME, Key={"SessionId": {"S": session_id}}
+        )
+        return item_size(item.get("Item", {}))
+    items = client.query(
+        TableName=TABLE_NAME,
+        KeyConditionExpression="SessionId = :session",
+        ExpressionAttributeValues={":session": {"S": session_id}},
+    )["Items"]
+    return sum(item_size(item) for item in items)
+
+
+def measure(codec: str, options) -> Dict[str, Any]:
+    import boto3
+    from moto import mock_aws
+
+    from chatbot.dynamodb import DynamoDBChatMessageHistory
+
+    with mock_aws():
+        create_table(options.storage_mode)
+        session = boto3.session.Session()
+        history = DynamoDBChatMessageHistory(
+            table_name=TABLE_NAME,
+            session_id=codec,
+            limited_item_count=options.window,
+            boto3_session=session,
+            storage_mode=options.storage_mode,
+            history_codec=codec,
+        )
+        meter = CapacityMeter().attach(history.table.meta.client)
+        reads, writes = [], []
+        for messages in conversation(options.turns):
+            before = meter.stats()
+            history.messages
+            read = meter.stats()
+            history.add_messages(messages)
+            written = meter.stats()
+            reads.append(read["read_units"] - before["read_units"])
+            writes.append(written["write_units"] - read["write_units"])
+        size = stored_bytes(
+            session.client("dynamodb"), options.storage_mode, history.session_id
+        )
+
+    return {
+        "stored_bytes": size,
+        "bytes_per_turn": round(size / options.turns, 1),
+        "read_units_per_turn": round(sum(reads) / options.turns, 2),
+        "write_units_per_turn": round(sum(writes) / options.turns, 2),
+        "last_turn_read_units": reads[-1],
+        "last_turn_write_units": writes[-1],
+    }
+
+
+def run(options) -> Dict[str, Any]:
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+    os.environ.update(
+        {"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing"}
+    )
+    codecs = {codec: measure(codec, options) for codec in options.codecs}
+    baseline = codecs.get("json")
+    if baseline:
+        for codec, result in codecs.items():
+            if codec == "json":
+                continue
+            result["change_from_json"] = {
+                key: round(result[key] / baseline[key] - 1, 3) if baseline[key] else 0
+                for key in (
+                    "stored_bytes",
+                    "read_units_per_turn",
+                    "write_units_per_turn",
+                )
+            }
+    return {
+        "storage_mode": options.storage_mode,
+        "turns": options.turns,
+        "window": options.window,
+        "codecs": codecs,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--storage-mode", choices=["item", "message"], default="item")
+    parser.add_argument(
+        "--window", type=int, default=20, help="messages read before each turn"
+    )
+    parser.add_argument(
+        "--codecs",
+        nargs="+",
+        default=["json", "zlib"],
+        help="codecs to compare, zstd needs the zstandard package",
+    )
+    parser.add_argument("--output", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    options = parse_args(argv)
+    report = run(options)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if options.output:
+        with open(options.output, "w") as file:
+            file.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,445 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Offline load test of the message handlers.
+
+    python -m benchmarks.load_test --messages 200 --rate 20 --conversations 50
+
+Synthetic callbacks are sent to `CardBotHandler.raw_process` (or to the asyncio
+handler) at a fixed rate, as the stream client does. They are answered by
+stand-ins: a fake streaming model with a tunable time to first token and token
+rate, moto for DynamoDB and a fake DingTalk card API with a latency and a QPS
+limit. The report has the throughput, latency percentiles, card calls and the
+DynamoDB capacity units, as JSON. With `--baseline` the run fails when it is
+worse than a previous report by more than `--tolerance`.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+from unittest.mock import patch
+
+from .fakes import (
+    CapacityMeter,
+    FakeAsyncBedrock,
+    FakeBedrockRuntime,
+    FakeDingTalk,
+    LatencyRecorder,
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../dingtalk_app"))
+
+TABLE_NAME = "load_test_conversation_table"
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def at(q):
+        return round(values[min(int(q * len(values)), len(values) - 1)], 1)
+
+    return {
+        "p50": at(0.5),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": round(values[-1], 1),
+    }
+
+
+def make_callback(index: int, conversation_id: str, text: str):
+    import dingtalk_stream
+
+    callback = dingtalk_stream.CallbackMessage()
+    callback.headers.message_id = f"callback-{index}"
+    callback.data = {
+        "msgtype": "text",
+        "text": {"content": text},
+        "msgId": f"msg-{index}",
+        "conversationId": conversation_id,
+        "conversationType": "1",
+        "senderStaffId": f"staff-{conversation_id}",
+        "senderNick": "load test",
+        "sessionWebhook": "http://localhost/webhook",
+    }
+    return callback
+
+
+def create_table(storage_mode: str) -> None:
+    import boto3
+
+    key_schema = [{"AttributeName": "SessionId", "KeyType": "HASH"}]
+    attributes = [{"AttributeName": "SessionId", "AttributeType": "S"}]
+    if storage_mode == "message":
+        key_schema.append({"AttributeName": "CreatedAt", "KeyType": "RANGE"})
+        attributes.append({"AttributeName": "CreatedAt", "AttributeType": "N"})
+    boto3.client("dynamodb").create_table(
+        TableName=TABLE_NAME,
+        KeySchema=key_schema,
+        AttributeDefinitions=attributes,
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+def prefill_history(handler, conversation_ids: List[str], turns: int) -> None:
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    answer = " ".join(f"word{i}" for i in range(100))
+    for conversation_id in conversation_ids:
+        history = handler.message_history(conversation_id)
+        for turn in range(turns):
+            history.add_messages(
+                [HumanMessage(content=f"question {turn}"), AIMessage(content=answer)]
+            )
+
+
+def build_handler(options, bedrock: FakeBedrockRuntime, dingtalk: FakeDingTalk):
+    from dingtalk_app import app
+
+    logger = logging.getLogger("load_test")
+    with patch.object(app, "get_bedrock_runtime_client", return_value=bedrock):
+        if options.handler == "asyncio":
+            handler = app.AsyncioCardBotHandler(
+                logger,
+                options.model_id,
+                max_concurrency=options.workers,
+                max_queue_size=options.queue_size,
+            )
+            # Skip creating the aiohttp clients.
+            handler.http_session = object()
+            handler.bedrock = FakeAsyncBedrock(
+                bedrock.time_to_first_token,
+                bedrock.tokens_per_second,
+                bedrock.response_tokens,
+            )
+            handler.replier = dingtalk.replier()
+        else:
+            handler = app.CardBotHandler(
+                logger,
+                options.model_id,
+                max_workers=options.workers,
+                max_queue_size=options.queue_size,
+            )
+            handler.reply_card = dingtalk.reply_card
+            handler.update_card = dingtalk.update_card
+            handler.reply_text = dingtalk.reply_text
+    return app, handler
+
+
+def record_turns(handler, recorder: LatencyRecorder) -> None:
+    """Record the completion of every turn, whatever its outcome."""
+    if hasattr(handler, "handle_turn_async"):
+        handle_turn_async = handler.handle_turn_async
+
+        async def timed_turn_async(messages, conversation_id):
+            try:
+                return await handle_turn_async(messages, conversation_id)
+            finally:
+                recorder.complete([message.message_id for message in messages])
+
+        handler.handle_turn_async = timed_turn_async
+    else:
+        handle_turn = handler.handle_turn
+
+        def timed_turn(messages, conversation_id):
+            try:
+                return handle_turn(messages, conversation_id)
+            finally:
+                recorder.complete([message.message_id for message in messages])
+
+        handler.handle_turn = timed_turn
+
+
+def synthetic_schedule(options) -> List[Tuple[float, Any]]:
+    """`options.messages` callbacks at `options.rate`, over the conversations."""
+    return [
+        (
+            index / options.rate,
+            make_callback(
+                index,
+                f"conversation-{index % options.conversations}",
+                f"question number {index % options.distinct_questions}"
+                if options.distinct_questions
+                else f"question number {index}",
+            ),
+        )
+        for index in range(options.messages)
+    ]
+
+
+def settled_without_turn(app, dingtalk) -> Set[str]:
+    """Messages answered with a text instead of a turn: rejected or help."""
+    texts = (app.OVERLOADED_MESSAGE, app.BUSY_MESSAGE, app.WELCOME_MESSAGE)
+    with dingtalk._lock:
+        return {m for m, text in dingtalk.texts.items() if text in texts}
+
+
+async def drive(handler, schedule, recorder: LatencyRecorder, dingtalk, app, timeout):
+    """Send each callback of `schedule` at its offset in seconds from the start,
+    return when all are answered or `timeout` seconds after the last one."""
+    started = time.monotonic()
+    for offset, callback in schedule:
+        delay = started + offset - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        recorder.arrive(callback.data["msgId"])
+        await handler.raw_process(callback)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        settled = len(recorder.completed) + len(settled_without_turn(app, dingtalk))
+        if settled >= len(schedule):
+            break
+        await asyncio.sleep(0.05)
+    return time.monotonic() - started
+
+
+def run(options, schedule: Optional[List[Tuple[float, Any]]] = None) -> Dict[str, Any]:
+    """Play `schedule` against a handler, by default `synthetic_schedule`."""
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+    os.environ.update(
+        {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "DDB_TABLE_NAME": TABLE_NAME,
+            "DDB_STORAGE_MODE": options.storage_mode,
+            "HISTORY_BATCH_WINDOW_MS": str(options.history_batch_ms),
+            "HANDLER_STATS_INTERVAL": "0",
+            "RESPONSE_CACHE_TTL_SECONDS": str(options.response_cache_ttl),
+        }
+    )
+    from moto import mock_aws
+
+    from chatbot import clients
+
+    if schedule is None:
+        schedule = synthetic_schedule(options)
+    bedrock = FakeBedrockRuntime(
+        options.time_to_first_token, options.tokens_per_second, options.response_tokens
+    )
+    dingtalk = FakeDingTalk(options.dingtalk_latency, options.dingtalk_qps)
+    recorder = LatencyRecorder()
+
+    with mock_aws():
+        clients.clear()
+        create_table(options.storage_mode)
+        app, handler = build_handler(options, bedrock, dingtalk)
+        if options.history_turns:
+            conversation_ids = {c.data["conversationId"] for _, c in schedule}
+            prefill_history(handler, sorted(conversation_ids), options.history_turns)
+        # The table handle shared by all histories of the handler.
+        table = handler.message_history("load-test").table
+        meter = CapacityMeter().attach(table.meta.client)
+        record_turns(handler, recorder)
+        try:
+            elapsed = asyncio.run(
+                drive(handler, schedule, recorder, dingtalk, app, options.timeout)
+            )
+        finally:
+            handler.async_executor.shutdown(wait=False, cancel_futures=True)
+        handler_stats = handler.stats()
+        clients.clear()
+
+    answered = [
+        message_id
+        for message_id in recorder.completed
+        if dingtalk.texts.get(message_id)
+        not in (app.ERROR_MESSAGE, app.THROTTLED_MESSAGE)
+    ]
+    errors = len(recorder.completed) - len(answered)
+    refused = (app.OVERLOADED_MESSAGE, app.BUSY_MESSAGE)
+    rejected = sum(text in refused for text in dingtalk.texts.values())
+    without_turn = len(settled_without_turn(app, dingtalk))
+    turns = max(recorder.turns, 1)
+    dynamodb = meter.stats()
+    return {
+        "config": vars(options),
+        "duration_seconds": round(elapsed, 2),
+        "messages": len(schedule),
+        "answered": len(answered),
+        "rejected": rejected,
+        "errors": errors,
+        "turns": recorder.turns,
+        "unfinished": len(schedule) - len(recorder.completed) - without_turn,
+        "throughput_per_second": round(len(answered) / elapsed, 2),
+        "latency_ms": {
+            "first_card": percentiles(
+                [
+                    (dingtalk.first_card_at[m] - recorder.arrived[m]) * 1000
+                    for m in answered
+                    if m in dingtalk.first_card_at
+                ]
+            ),
+            "turn": percentiles(
+                [(recorder.completed[m] - recorder.arrived[m]) * 1000 for m in answered]
+            ),
+        },
+        "cards": {
+            "replies": dingtalk.counts["card_replies"],
+            "updates": dingtalk.counts["card_updates"],
+            "throttled": dingtalk.counts["card_replies_throttled"]
+            + dingtalk.counts["card_updates_throttled"],
+            "updates_per_turn": round(dingtalk.counts["card_updates"] / turns, 2),
+        },
+        "dynamodb": {
+            **dynamodb,
+            "read_units_per_turn": round(dynamodb["read_units"] / turns, 2),
+            "write_units_per_turn": round(dynamodb["write_units"] / turns, 2),
+        },
+        "model_calls": bedrock.calls
+        + getattr(getattr(handler, "bedrock", None), "calls", 0),
+        "handler": handler_stats,
+        "history_batcher": (
+            handler.history_batcher.stats() if handler.history_batcher else None
+        ),
+        "response_cache": response_cache_stats(handler.response_cache),
+    }
+
+
+def response_cache_stats(cache) -> Optional[Dict[str, Any]]:
+    """Counts of the response cache and the share of questions it answered."""
+    if cache is None:
+        return None
+    stats = cache.stats()
+    hits = stats["exact_hits"] + stats["semantic_hits"]
+    questions = hits + stats["misses"] + stats["skipped"]
+    return {**stats, "hit_rate": round(hits / questions, 3) if questions else None}
+
+
+def compare(report, baseline, tolerance: float) -> List[str]:
+    """Regressions of `report` compared with `baseline`, beyond `tolerance`."""
+    regressions = []
+
+    def check(name, current, previous, higher_is_better):
+        if current is None or previous is None or not previous:
+            return
+        change = (current - previous) / previous
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{name}: {previous} -> {current} ({change:+.0%})")
+
+    check(
+        "throughput_per_second",
+        report["throughput_per_second"],
+        baseline["throughput_per_second"],
+        True,
+    )
+    for kind in ("first_card", "turn"):
+        for q in ("p50", "p95", "p99"):
+            check(
+                f"latency_ms.{kind}.{q}",
+                report["latency_ms"][kind][q],
+                baseline["latency_ms"][kind][q],
+                False,
+            )
+    for units in ("read_units_per_turn", "write_units_per_turn"):
+        check(
+            f"dynamodb.{units}",
+            report["dynamodb"][units],
+            baseline["dynamodb"][units],
+            False,
+        )
+    check(
+        "cards.updates_per_turn",
+        report["cards"]["updates_per_turn"],
+        baseline["cards"]["updates_per_turn"],
+        False,
+    )
+    return regressions
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Options of the handler and of the stand-ins, shared with the replay."""
+    parser.add_argument("--handler", choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("--model-id", default="anthropic.claude-v2:1")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=16,
+        help="worker threads, or concurrent messages of the asyncio handler",
+    )
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--storage-mode", choices=["item", "message"], default="item")
+    parser.add_argument(
+        "--history-turns",
+        type=int,
+        default=0,
+        help="turns already in each conversation before the test",
+    )
+    parser.add_argument(
+        "--history-batch-ms",
+        type=float,
+        default=0,
+        help="HISTORY_BATCH_WINDOW_MS of the handler, 0 to read with get_item",
+    )
+    parser.add_argument("--time-to-first-token", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--response-tokens", type=int, default=100)
+    parser.add_argument("--dingtalk-latency", type=float, default=0.05)
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        default=0,
+        help="RESPONSE_CACHE_TTL_SECONDS of the handler, 0 to disable the cache",
+    )
+    parser.add_argument(
+        "--dingtalk-qps",
+        type=float,
+        default=0,
+        help="card calls per second, 0 for no limit",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=300,
+        help="seconds to wait for the answers after the last message",
+    )
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--baseline", help="report of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=20, help="messages per second")
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument(
+        "--distinct-questions",
+        type=int,
+        default=0,
+        help="questions asked in turn, e.g. of an FAQ bot, 0 for all different",
+    )
+    add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def report_and_compare(report: Dict[str, Any], options) -> int:
+    """Print and save `report`, 1 if it regressed from `options.baseline`."""
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if options.output:
+        with open(options.output, "w") as file:
+            file.write(text + "\n")
+    if options.baseline:
+        with open(options.baseline) as file:
+            regressions = compare(report, json.load(file), options.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+def main(argv=None) -> int:
+    options = parse_args(argv)
+    return report_and_compare(run(options), options)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
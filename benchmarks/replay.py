@@ -0,0 +1,219 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Replay of recorded DingTalk traffic against the message handlers.
+
+    python -m benchmarks.replay traffic.log --speed 10 --output report.json
+
+Reads the callback payloads logged by `process` (`self.logger.info(callback.data)`,
+a Python dict after the log prefix) or JSON lines holding a payload or a whole
+callback message, and sends them to the handler with their original
+inter-arrival times, from `createAt`, divided by `--speed`. Bursts of group
+chats are kept as recorded. The stand-ins and the report are those of
+`benchmarks.load_test`, so both can be compared with `--baseline`.
+Other lines, e.g. the logged headers, are skipped.
+"""
+
+import argparse
+import ast
+import json
+import re
+import sys
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from . import load_test
+
+# Leading timestamp of a log line, used when a payload has no createAt.
+LOG_TIMESTAMP = re.compile(r"^\W*(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?)")
+
+
+class Recording:
+    """Callback payloads read from log or JSONL files, in recorded order."""
+
+    def __init__(self):
+        # (seconds since the epoch or None, payload)
+        self.payloads: List[Tuple[Optional[float], Dict[str, Any]]] = []
+        self.counts = Counter()
+
+    def read(self, lines: Iterable[str]) -> "Recording":
+        seen = {payload.get("msgId") for _, payload in self.payloads}
+        for line in lines:
+            if not line.strip():
+                continue
+            self.counts["lines"] += 1
+            payload = parse_payload(line)
+            if payload is None:
+                self.counts["skipped"] += 1
+                continue
+            if payload.get("msgtype") != "text":
+                self.counts[f"unsupported_{payload.get('msgtype')}"] += 1
+                continue
+            message_id = payload.get("msgId")
+            if message_id is not None and message_id in seen:
+                # Logged twice, or redelivered by DingTalk.
+                self.counts["duplicates"] += 1
+                continue
+            seen.add(message_id)
+            self.payloads.append((payload_time(payload, line), payload))
+        return self
+
+    def schedule(
+        self, speed: float = 1.0, max_gap: float = 0, rate: float = 1.0
+    ) -> List[Tuple[float, Any]]:
+        """Offsets in seconds and callbacks of the recorded messages.
+
+        :param speed: time compression, 10 replays 10 times faster
+        :param max_gap: longest pause between two messages after compression,
+            0 to keep the recorded ones
+        :param rate: messages per second of payloads without a time
+        """
+        schedule = []
+        offset = 0.0
+        previous = None
+        for index, (timestamp, payload) in enumerate(self.payloads):
+            if index:
+                if timestamp is None or previous is None:
+                    gap = 1 / rate
+                else:
+                    # Out of order lines are sent at once.
+                    gap = max(timestamp - previous, 0) / speed
+                if max_gap:
+                    gap = min(gap, max_gap)
+                offset += gap
+            if timestamp is not None:
+                previous = timestamp
+            schedule.append((offset, callback_of(payload, index)))
+        return schedule
+
+
+def parse_payload(line: str) -> Optional[Dict[str, Any]]:
+    """The callback payload of a log or JSON line, None if there is none."""
+    start, end = line.find("{"), line.rfind("}")
+    if start < 0 or end < start:
+        return None
+    text = line[start : end + 1]
+    try:
+        record = json.loads(text)
+    except ValueError:
+        try:
+            # The logged repr of callback.data.
+            record = ast.literal_eval(text)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            return None
+    if isinstance(record, dict) and "data" in record:
+        # A whole callback message, whose data may still be the raw JSON frame.
+        record = record["data"]
+        if isinstance(record, str):
+            try:
+                record = json.loads(record)
+            except ValueError:
+                return None
+    if not isinstance(record, dict) or "conversationId" not in record:
+        return None
+    return record
+
+
+def payload_time(payload: Dict[str, Any], line: str) -> Optional[float]:
+    """When the message was sent, from createAt in ms or the log timestamp."""
+    try:
+        return int(payload["createAt"]) / 1000
+    except (KeyError, TypeError, ValueError):
+        pass
+    match = LOG_TIMESTAMP.match(line)
+    if match:
+        try:
+            return datetime.fromisoformat(match.group(1).replace(",", ".")).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+def callback_of(payload: Dict[str, Any], index: int):
+    import dingtalk_stream
+
+    callback = dingtalk_stream.CallbackMessage()
+    callback.headers.message_id = f"replay-{index}"
+    callback.data = {
+        "msgId": f"replay-msg-{index}",
+        "sessionWebhook": "http://localhost/webhook",
+        **payload,
+    }
+    return callback
+
+
+def describe(schedule: List[Tuple[float, Any]]) -> Dict[str, Any]:
+    """Shape of the replayed traffic, to tell replays apart in reports."""
+    offsets = [offset for offset, _ in schedule]
+    peak = 0
+    first = 0
+    # Most messages sent within one second.
+    for last, offset in enumerate(offsets):
+        while offset - offsets[first] >= 1:
+            first += 1
+        peak = max(peak, last - first + 1)
+    conversations = Counter(c.data["conversationId"] for _, c in schedule)
+    groups = sum(c.data.get("conversationType") == "2" for _, c in schedule)
+    return {
+        "duration_seconds": round(offsets[-1], 2) if offsets else 0,
+        "conversations": len(conversations),
+        "busiest_conversation_messages": max(conversations.values(), default=0),
+        "group_messages": groups,
+        "peak_messages_per_second": peak,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("files", nargs="+", help="log or JSONL files, - for stdin")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="time compression factor"
+    )
+    parser.add_argument(
+        "--max-gap",
+        type=float,
+        default=0,
+        help="longest pause in seconds between two messages, 0 for no limit",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=1.0,
+        help="messages per second of payloads recorded without a time",
+    )
+    parser.add_argument("--limit", type=int, default=0, help="replay the first N")
+    load_test.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    options = parse_args(argv)
+    if options.speed <= 0 or options.rate <= 0:
+        print("--speed and --rate must be positive", file=sys.stderr)
+        return 2
+    recording = Recording()
+    for path in options.files:
+        if path == "-":
+            recording.read(sys.stdin)
+        else:
+            with open(path, encoding="utf-8") as file:
+                recording.read(file)
+    if options.limit:
+        recording.payloads = recording.payloads[: options.limit]
+    if not recording.payloads:
+        print(
+            f"no text callback payloads in {options.files}: {dict(recording.counts)}",
+            file=sys.stderr,
+        )
+        return 2
+
+    schedule = recording.schedule(options.speed, options.max_gap, options.rate)
+    report = load_test.run(options, schedule)
+    report["replay"] = {**describe(schedule), "lines": dict(recording.counts)}
+    return load_test.report_and_compare(report, options)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
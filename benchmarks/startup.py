@@ -0,0 +1,198 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Startup profile of the entry point.
+
+    python -m benchmarks.startup --repeat 5 --budget-ms 1000
+
+Starts fresh interpreters, as a new ECS task does, and measures the time to
+import `app` and to create the handler, i.e. until the task can connect to
+the DingTalk stream, then the time `preload` takes to load the model modules
+in the background. Reports the medians, the slowest imports from
+`python -X importtime` and the heavy modules that were imported before
+connecting although they are only needed later. With `--budget-ms` the run
+fails when the time to connect exceeds the budget.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Dict, List
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../dingtalk_app")
+
+# Only needed once a message arrives, or with optional settings.
+DEFERRED_MODULES = [
+    "langchain.memory",
+    "langchain_community",
+    "sqlalchemy",
+    "numpy",
+    "aiohttp",
+    "dynamodb_encryption_sdk",
+]
+
+# Separates the imports before connecting from those of the preload.
+READY = "-- ready to connect --"
+
+PROBE = """
+READY = {ready!r}
+import json, logging, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+handler_class = app.AsyncioCardBotHandler if {mode!r} == "asyncio" else app.CardBotHandler
+handler = handler_class(logging.getLogger("startup"), {model_id!r})
+ready = time.perf_counter()
+deferred = [m for m in {deferred!r} if m in sys.modules]
+print(READY, file=sys.stderr, flush=True)
+handler.preload()
+preloaded = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - started) * 1000,
+    "handler_ms": (ready - imported) * 1000,
+    "preload_ms": (preloaded - ready) * 1000,
+    "eager_modules": deferred,
+}}))
+"""
+
+
+def probe(python: str, mode: str, model_id: str) -> Dict[str, Any]:
+    """Times of one fresh interpreter, with its `-X importtime` output."""
+    env = {
+        **os.environ,
+        "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-west-2"),
+        "HANDLER_MODE": mode,
+    }
+    code = PROBE.format(
+        ready=READY, mode=mode, model_id=model_id, deferred=DEFERRED_MODULES
+    )
+    started = time.perf_counter()
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", code],
+        cwd=APP_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    times = json.loads(result.stdout.strip().splitlines()[-1])
+    # Interpreter startup, imports and handler, without the preload.
+    times["process_ms"] = wall_ms - times["preload_ms"]
+    before, _, after = result.stderr.partition(READY)
+    times["imports"] = parse_importtime(before)
+    times["preload_imports"] = parse_importtime(after)
+    return times
+
+
+def parse_importtime(output: str) -> Dict[str, float]:
+    """Cumulative import milliseconds of each top-level package, `app` split
+    into the packages it imports."""
+    packages = defaultdict(float)
+    # Modules imported by the next top-level one, which is printed after them.
+    children = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        milliseconds = int(cumulative) / 1000
+        if name.startswith("    "):
+            # Nested deeper, counted in the module importing it.
+            continue
+        if name.startswith("  "):
+            children.append((name.strip(), milliseconds))
+            continue
+        if name.strip() == "app":
+            for child, child_milliseconds in children:
+                # Modules of the app are listed one by one.
+                if not child.startswith("chatbot."):
+                    child = child.split(".")[0]
+                packages[child] += child_milliseconds
+        else:
+            packages[name.strip().split(".")[0]] += milliseconds
+        children = []
+    return dict(packages)
+
+
+def run(options) -> Dict[str, Any]:
+    probes = [
+        probe(options.python, options.handler, options.model_id)
+        for _ in range(options.repeat)
+    ]
+
+    def median(key):
+        return round(statistics.median(p[key] for p in probes), 1)
+
+    def slowest(key):
+        imports = defaultdict(list)
+        for p in probes:
+            for package, ms in p[key].items():
+                imports[package].append(ms)
+        ranked = sorted(
+            (
+                (round(statistics.median(ms), 1), package)
+                for package, ms in imports.items()
+            ),
+            reverse=True,
+        )
+        return {package: ms for ms, package in ranked[: options.top]}
+
+    return {
+        "handler": options.handler,
+        "repeat": options.repeat,
+        "connect_ms": round(median("import_ms") + median("handler_ms"), 1),
+        "process_ms": median("process_ms"),
+        "import_ms": median("import_ms"),
+        "handler_ms": median("handler_ms"),
+        "preload_ms": median("preload_ms"),
+        "slowest_imports_ms": slowest("imports"),
+        "preload_imports_ms": slowest("preload_imports"),
+        "eager_modules": sorted({m for p in probes for m in p["eager_modules"]}),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--handler", choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("--model-id", default="anthropic.claude-v2:1")
+    parser.add_argument("--python", default=sys.executable)
+    parser.add_argument("--top", type=int, default=10, help="slowest imports shown")
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=0,
+        help="fail when the time to connect exceeds it, 0 for no budget",
+    )
+    return parser.parse_args(argv)
+
+
+def check(report: Dict[str, Any], budget_ms: float) -> List[str]:
+    problems = []
+    if budget_ms and report["connect_ms"] > budget_ms:
+        problems.append(
+            f"connect_ms {report['connect_ms']} exceeds the budget of {budget_ms}"
+        )
+    if report["eager_modules"]:
+        problems.append(f"imported before connecting: {report['eager_modules']}")
+    return problems
+
+
+def main(argv=None) -> int:
+    options = parse_args(argv)
+    report = run(options)
+    print(json.dumps(report, indent=2))
+    problems = check(report, options.budget_ms)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,24 +2,97 @@
 #  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
 
 import os
+import asyncio
+import functools
+import json
 import logging
+import threading
 import time
+import traceback
 import dingtalk_stream
 
 from dingtalk_stream import AckMessage
+from dingtalk_stream.frames import Headers
 
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 from chatbot.templates import INTERACTIVE_CARD_JSON_SAMPLE
-from chatbot.settings import load_dingtalk_app_setting
-from chatbot.bedrock_chatbot import Chatbot
+from chatbot.conversations import QUEUED, REJECTED, ConversationRegistry
+from chatbot.card_updater import AsyncCardUpdater, BackgroundCardUpdater, CardUpdater
+from chatbot.settings import DingTalkCredentialProvider, update_stream_credential
+from chatbot.bedrock_chatbot import Chatbot, is_throttling_error
+from chatbot.clients import get_bedrock_runtime_client
 from chatbot.dynamodb import DynamoDBChatMessageHistory
-from langchain.memory import ConversationBufferMemory
+from chatbot.history_cache import HistoryCache
+from chatbot.prefetch import HistoryBatcher
+from chatbot.metrics import (
+    CACHE_HITS,
+    CACHE_LOOKUP,
+    CARD_REPLY,
+    CARD_UPDATE,
+    ERRORS,
+    HISTORY_LOAD,
+    HISTORY_WRITE,
+    MetricsRecorder,
+    TurnMetrics,
+)
+from chatbot.response_cache import ResponseCache, conversation_context
+from chatbot.router import RoutedChatbot, endpoint_chatbot, parse_endpoints
+from chatbot.worker_pool import InflightLimiter, WorkerPool
+from langchain_core.messages import AIMessage, HumanMessage
 from datetime import datetime
 
+# 模块导入完成的时间，用于在日志中输出连接前的耗时；导入耗时见 benchmarks.startup
+STARTED_AT = time.monotonic()
+
 # 影响调用钉钉开放平台接口频率，越小调用频率越高，建议设置大一点
-STREAM_SIZE = 50
+# 卡片最多每隔 CARD_UPDATE_MIN_INTERVAL 秒，或每累积 CARD_UPDATE_MAX_PENDING_CHARS 个字符更新一次
+CARD_UPDATE_MIN_INTERVAL = float(os.environ.get("CARD_UPDATE_MIN_INTERVAL", "1.0"))
+CARD_UPDATE_MAX_PENDING_CHARS = int(
+    os.environ.get("CARD_UPDATE_MAX_PENDING_CHARS", "500")
+)
+# 钉钉限流后暂停更新的最长时间（秒）
+CARD_UPDATE_MAX_BACKOFF = float(os.environ.get("CARD_UPDATE_MAX_BACKOFF", "10"))
+# thread: 每条消息占用一个工作线程；asyncio: 每条消息是事件循环上的一个任务
+HANDLER_MODE = os.environ.get("HANDLER_MODE", "thread")
+# thread 模式下处理消息的线程数，处理消息主要在等待 Bedrock、DynamoDB 和钉钉，可以远大于 CPU 数
+HANDLER_MAX_WORKERS = int(os.environ.get("HANDLER_MAX_WORKERS", "16"))
+# 等待处理的消息数上限，超过后直接回复 OVERLOADED_MESSAGE
+HANDLER_MAX_QUEUE_SIZE = int(os.environ.get("HANDLER_MAX_QUEUE_SIZE", "100"))
+# 同时调用 Bedrock 的上限，0 表示不限制
+MAX_INFLIGHT_MODEL_CALLS = int(os.environ.get("MAX_INFLIGHT_MODEL_CALLS", "0"))
+# 每隔多少秒在日志中输出队列长度、活跃线程数等指标，0 表示不输出
+HANDLER_STATS_INTERVAL = float(os.environ.get("HANDLER_STATS_INTERVAL", "60"))
+# asyncio 模式下同时处理的消息数上限
+HANDLER_MAX_CONCURRENCY = int(os.environ.get("HANDLER_MAX_CONCURRENCY", "1000"))
+# asyncio 模式下执行 DynamoDB 等阻塞调用的线程数
+HANDLER_IO_WORKERS = int(os.environ.get("HANDLER_IO_WORKERS", "32"))
+# 同一会话上一轮还没回答完时收到的消息：reject 回复 BUSY_MESSAGE，queue 排队依次回答，coalesce 合并成一轮回答
+CONVERSATION_BUSY_POLICY = os.environ.get("CONVERSATION_BUSY_POLICY", "queue")
+# 每个会话最多排队的消息数，超过后回复 BUSY_MESSAGE
+CONVERSATION_MAX_PENDING = int(os.environ.get("CONVERSATION_MAX_PENDING", "10"))
+# Bedrock 建立连接和等待首个字节（以及流式输出的两个分片之间）的超时时间（秒）
+BEDROCK_CONNECT_TIMEOUT = float(os.environ.get("BEDROCK_CONNECT_TIMEOUT", "5"))
+BEDROCK_READ_TIMEOUT = float(os.environ.get("BEDROCK_READ_TIMEOUT", "60"))
+# Bedrock 限流时的最多尝试次数（含第一次），重试间隔指数增长并加随机抖动
+BEDROCK_MAX_ATTEMPTS = int(os.environ.get("BEDROCK_MAX_ATTEMPTS", "5"))
+# 多个模型/区域组成的调用池，格式 model_id@region=weight，逗号分隔；不设置时只用 BEDROCK_MODEL_ID
+BEDROCK_ENDPOINTS = os.environ.get("BEDROCK_ENDPOINTS", "")
+# 调用池中的模型多少秒没有输出第一个字就换下一个模型，0 表示不限制
+BEDROCK_FIRST_TOKEN_TIMEOUT = float(os.environ.get("BEDROCK_FIRST_TOKEN_TIMEOUT", "10"))
+# 调用池中连续失败的模型暂停使用的时间（秒）
+BEDROCK_ENDPOINT_COOLDOWN = float(os.environ.get("BEDROCK_ENDPOINT_COOLDOWN", "30"))
+# 重置后旧会话备份保留的天数，到期由 DynamoDB TTL 删除，0 表示一直保留
+HISTORY_ARCHIVE_TTL_DAYS = float(os.environ.get("HISTORY_ARCHIVE_TTL_DAYS", "90"))
+# 会话最后一条消息之后保留的天数，到期由 DynamoDB TTL 删除，0 表示一直保留
+HISTORY_IDLE_TTL_DAYS = float(os.environ.get("HISTORY_IDLE_TTL_DAYS", "0"))
+# 新消息在 DynamoDB 中的存储格式：json 为原格式，zlib/zstd 为压缩的紧凑格式，读取时各种格式都支持
+HISTORY_CODEC = os.environ.get("HISTORY_CODEC", "json")
 BUSY_MESSAGE = "Only one message at a time"
+ERROR_MESSAGE = "出了点小问题,请输入'重置'清理后再尝试,或者联系管理员."
+OVERLOADED_MESSAGE = "当前消息较多,请稍后再试."
+THROTTLED_MESSAGE = "模型当前请求较多,请稍后再试."
 WELCOME_MESSAGE = """我是某某聊天机器人:
 ==========================
 ♻️ 重置 👉 重置带上下文聊天
@@ -35,73 +108,401 @@ def setup_logger():
     return logger
 
 
+HELP_COMMANDS = ["", "帮助", "help"]
+RESET_COMMANDS = ["重置", "reset"]
+
+
+def message_text(incoming_message: dingtalk_stream.ChatbotMessage) -> str:
+    return incoming_message.text.content.strip()
+
+
+def split_turns(messages):
+    """Group coalesced messages into turns, a reset command stays on its own."""
+    turns = []
+    for message in messages:
+        if (
+            not turns
+            or message_text(message) in RESET_COMMANDS
+            or message_text(turns[-1][-1]) in RESET_COMMANDS
+        ):
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+def ok_ack(callback_message: dingtalk_stream.CallbackMessage) -> AckMessage:
+    ack_message = AckMessage()
+    ack_message.code = AckMessage.STATUS_OK
+    ack_message.headers.message_id = callback_message.headers.message_id
+    ack_message.headers.content_type = Headers.CONTENT_TYPE_APPLICATION_JSON
+    ack_message.data = {"response": "OK"}
+    return ack_message
+
+
 class CardBotHandler(dingtalk_stream.AsyncChatbotHandler):
     """
     接收回调消息。
     回复一个卡片，然后更新卡片的文本和图片。
     """
 
-    def __init__(self, logger: logging.Logger, model_id):
-        max_workers = os.cpu_count()
+    def __init__(
+        self,
+        logger: logging.Logger,
+        model_id,
+        max_workers=None,
+        max_queue_size=HANDLER_MAX_QUEUE_SIZE,
+        max_model_calls=MAX_INFLIGHT_MODEL_CALLS,
+    ):
+        max_workers = max_workers or HANDLER_MAX_WORKERS
         super(CardBotHandler, self).__init__(max_workers=max_workers)
+        self.async_executor = WorkerPool(
+            max_workers, max_queue_size, thread_name_prefix="handler"
+        )
+        self.model_calls = InflightLimiter(max_model_calls)
+        self.conversations = ConversationRegistry(
+            CONVERSATION_BUSY_POLICY, CONVERSATION_MAX_PENDING
+        )
         self.logger = logger
+        # The DynamoDB connection pool is shared by all worker threads.
+        self.ddb_max_pool_connections = int(
+            os.environ.get("DDB_MAX_POOL_CONNECTIONS", max_workers)
+        )
+        # In-process cache of recent conversations, disabled when the TTL is 0.
+        history_cache_ttl = float(os.environ.get("HISTORY_CACHE_TTL_SECONDS", "0"))
+        self.history_cache = None
+        if history_cache_ttl > 0:
+            self.history_cache = HistoryCache(
+                max_entries=int(os.environ.get("HISTORY_CACHE_MAX_ENTRIES", "1000")),
+                ttl_seconds=history_cache_ttl,
+                max_bytes=int(
+                    os.environ.get("HISTORY_CACHE_MAX_BYTES", str(32 * 1024 * 1024))
+                ),
+            )
+        # History reads of a burst go out as one BatchGetItem, disabled when 0.
+        history_batch_window = float(os.environ.get("HISTORY_BATCH_WINDOW_MS", "0"))
+        self.history_batcher = None
+        if history_batch_window > 0:
+            self.history_batcher = HistoryBatcher(
+                window_seconds=history_batch_window / 1000
+            )
+
+        # Opt-in cache of responses to repeated questions, disabled when the TTL is 0.
+        response_cache_ttl = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "0"))
+        self.response_cache = None
+        if response_cache_ttl > 0:
+            embed = None
+            embedding_model_id = os.environ.get("RESPONSE_CACHE_EMBEDDING_MODEL_ID")
+            if embedding_model_id:
+                from langchain_community.embeddings import BedrockEmbeddings
+
+                embed = BedrockEmbeddings(model_id=embedding_model_id).embed_query
+            self.response_cache = ResponseCache(
+                max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+                ttl_seconds=response_cache_ttl,
+                embed=embed,
+                similarity_threshold=float(
+                    os.environ.get("RESPONSE_CACHE_SIMILARITY", "0.95")
+                ),
+            )
+        # Longer conversations do not use the cache.
+        self.response_cache_max_turns = int(
+            os.environ.get("RESPONSE_CACHE_MAX_TURNS", "0")
+        )
+        self.response_cache_bypass = set(
+            filter(None, os.environ.get("RESPONSE_CACHE_BYPASS", "").split(","))
+        )
+
+        # Per-turn timings, as EMF log lines and/or in-process histograms.
+        self.metrics = MetricsRecorder(
+            namespace=os.environ.get("METRICS_NAMESPACE", "DingTalkBedrock"),
+            emf=os.environ.get("METRICS_EMF", "false").lower() == "true",
+            histograms=os.environ.get("METRICS_HISTOGRAMS", "false").lower() == "true",
+        )
+
+        # "summary" folds turns that leave the history window into a rolling
+        # summary. It is updated by a background worker after the reply is sent.
+        self.memory_mode = os.environ.get("HISTORY_MEMORY_MODE", "window")
+        self.summary_executor = ThreadPoolExecutor(max_workers=1)
+        # Conversations with a summary update waiting in the executor.
+        self.summary_queued = set()
+        self.summary_lock = threading.Lock()
+        # Copies of reset conversations to their backups, not queued behind
+        # the summaries.
+        self.archive_executor = ThreadPoolExecutor(max_workers=1)
+        # One card pusher per reply being streamed, so one per handler worker.
+        self.card_executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        # The bedrock-runtime connection pool is shared by all worker threads.
+        client_kwargs = dict(
+            max_pool_connections=int(
+                os.environ.get("BEDROCK_MAX_POOL_CONNECTIONS", max_workers)
+            ),
+            connect_timeout=BEDROCK_CONNECT_TIMEOUT,
+            read_timeout=BEDROCK_READ_TIMEOUT,
+            max_attempts=BEDROCK_MAX_ATTEMPTS,
+        )
 
         # Initialize chatbot
-        self.chatbot = Chatbot(model_id=model_id)
+        history_token_budget = os.environ.get("HISTORY_TOKEN_BUDGET")
+        chatbot_kwargs = dict(
+            history_token_budget=(
+                int(history_token_budget) if history_token_budget else None
+            ),
+            prompt_caching=os.environ.get("BEDROCK_PROMPT_CACHING", "false").lower()
+            == "true",
+        )
+        if BEDROCK_ENDPOINTS:
+            endpoints = parse_endpoints(BEDROCK_ENDPOINTS)
+            # Same interface as Chatbot, each call goes to the healthiest endpoint.
+            self.chatbot = RoutedChatbot(
+                endpoints,
+                chatbot_factory=functools.partial(
+                    endpoint_chatbot, client_kwargs=client_kwargs, **chatbot_kwargs
+                ),
+                first_token_timeout=BEDROCK_FIRST_TOKEN_TIMEOUT,
+                # A turn may abandon a stalled call on every endpoint but the last.
+                max_workers=max_workers * len(endpoints),
+                cooldown_seconds=BEDROCK_ENDPOINT_COOLDOWN,
+            )
+        else:
+            self.chatbot = Chatbot(
+                model_id=model_id,
+                client=get_bedrock_runtime_client(**client_kwargs),
+                **chatbot_kwargs,
+            )
+
+    def message_history(self, conversation_id, **kwargs):
+        return DynamoDBChatMessageHistory(
+            table_name=os.environ.get("DDB_TABLE_NAME", "chatbot_conversation_table"),
+            session_id=conversation_id,
+            storage_mode=os.environ.get("DDB_STORAGE_MODE", "item"),
+            max_pool_connections=self.ddb_max_pool_connections,
+            cache=self.history_cache,
+            memory_mode=self.memory_mode,
+            # Backups of reset conversations are written after the reply.
+            archive_executor=self.archive_executor,
+            archive_ttl_days=HISTORY_ARCHIVE_TTL_DAYS,
+            idle_ttl_days=HISTORY_IDLE_TTL_DAYS,
+            history_codec=HISTORY_CODEC,
+            batcher=self.history_batcher,
+            **kwargs,
+        )
+
+    def lookup_response(
+        self, input_text, conversation_id, metrics=None, history=(), summary=""
+    ):
+        """Look the question up in the response cache, None if it is not used.
+
+        Only answers given with the same history and summary are shared, and
+        only by conversations of at most `response_cache_max_turns` turns.
+        """
+        if self.response_cache is None or conversation_id in self.response_cache_bypass:
+            return None
+        context = conversation_context(
+            self.chatbot.prompt.template,
+            history,
+            summary,
+            self.response_cache_max_turns,
+        )
+        if context is None:
+            self.response_cache.skip()
+            return None
+        metrics = metrics or TurnMetrics()
+        try:
+            with metrics.span(CACHE_LOOKUP):
+                lookup = self.response_cache.lookup(
+                    input_text, self.chatbot.model_id, context
+                )
+        except Exception as e:
+            # e.g. the embedding model failed, answer without the cache.
+            self.logger.error(e)
+            return None
+        if lookup is not None:
+            metrics.observe(CACHE_HITS, int(lookup.response is not None))
+        return lookup
+
+    def submit_summary(self, message_history, history_count):
+        """Update the summary in the background if the turn pushed messages out
+        of the window, `history_count` being the messages read before it."""
+        if self.memory_mode != "summary":
+            return
+        window = getattr(message_history, "limited_item_count", None)
+        # The turn added a question and an answer.
+        if not window or history_count + 2 <= window:
+            return
+        with self.summary_lock:
+            if message_history.session_id in self.summary_queued:
+                return
+            self.summary_queued.add(message_history.session_id)
+        self.summary_executor.submit(self.update_summary, message_history)
 
-    def bedrock_reply_stream(self, input_text, incoming_message, conversation_id):
+    def update_summary(self, message_history):
+        # Turns from now on queue another update.
+        with self.summary_lock:
+            self.summary_queued.discard(message_history.session_id)
+        try:
+            if self.chatbot.update_summary(message_history):
+                self.logger.info(f"summary of {message_history.session_id} updated.")
+        except Exception as e:
+            self.logger.error(e)
+
+    def bedrock_reply_stream(
+        self, input_text, incoming_message, conversation_id, metrics=None
+    ):
+        metrics = metrics or TurnMetrics()
         card = deepcopy(INTERACTIVE_CARD_JSON_SAMPLE)
         card["contents"][0]["id"] = f"text_{int(time.time() * 100)}"
-        card_biz_id = None
-        is_first_reply = True
+        # 第一段文本立即回复卡片，之后合并更新。卡片在后台线程更新，不阻塞读取模型输出
+        card_updater = BackgroundCardUpdater(
+            CardUpdater(
+                card,
+                reply=metrics.timed(
+                    CARD_REPLY,
+                    lambda card_data: self.reply_card(
+                        card_data,
+                        incoming_message,
+                        False,
+                    ),
+                ),
+                update=metrics.timed(CARD_UPDATE, self.update_card),
+                min_interval=CARD_UPDATE_MIN_INTERVAL,
+                max_pending_chars=CARD_UPDATE_MAX_PENDING_CHARS,
+                max_backoff=CARD_UPDATE_MAX_BACKOFF,
+            ),
+            self.card_executor,
+        )
 
-        message_history = DynamoDBChatMessageHistory(
-            table_name=os.environ.get("DDB_TABLE_NAME", "chatbot_conversation_table"),
-            session_id=conversation_id,
+        message_history = self.message_history(
+            conversation_id,
             # Each conversation has 2 items in DDB table.
             limited_item_count=int(
                 os.environ.get("INPUT_HISTORY_CONVERSATION_COUNT", "10")
             )
             * 2,
         )
+        from langchain.memory import ConversationBufferMemory
+
         memory = ConversationBufferMemory(
             memory_key="history", chat_memory=message_history, return_messages=True
         )
 
-        for i, query in enumerate(
-            self.chatbot.ask_stream(
-                input_text,
-                role=incoming_message.sender_staff_id,
-                convo_id=incoming_message.conversation_id,
-                conversation_history=memory,
+        response = []
+        lookup = None
+        try:
+            # Read once, for the cache scope and the prompt.
+            with metrics.span(HISTORY_LOAD):
+                history = message_history.messages
+                summary = getattr(message_history, "summary", "")
+            lookup = self.lookup_response(
+                input_text, conversation_id, metrics, history, summary
             )
-        ):
-            card["contents"][0]["text"] += query
-            if i % STREAM_SIZE == 0:
-                # 先回复一个文本卡片
-                if is_first_reply:
-                    card_biz_id = self.reply_card(
-                        card,
-                        incoming_message,
-                        False,
+            if lookup is not None and lookup.response is not None:
+                # 命中缓存，直接回复，并像模型回答一样保存到会话历史
+                card_updater.append(lookup.response)
+                with metrics.span(HISTORY_WRITE):
+                    memory.save_context(
+                        {"input": input_text}, {"response": lookup.response}
                     )
-                    is_first_reply = False
-                self.update_card(
-                    card_biz_id,
-                    card,
+            else:
+                with self.model_calls:
+                    for query in self.chatbot.ask_stream(
+                        input_text,
+                        role=incoming_message.sender_staff_id,
+                        convo_id=incoming_message.conversation_id,
+                        conversation_history=memory,
+                        metrics=metrics,
+                        history=history,
+                        summary=summary,
+                    ):
+                        card_updater.append(query)
+                        response.append(query)
+        finally:
+            # Also stops the pusher when the model call failed.
+            card_updater.finish()
+
+        if lookup is not None and lookup.response is None:
+            self.response_cache.store(lookup, "".join(response))
+
+        self.submit_summary(message_history, len(history))
+
+        if self.history_cache is not None:
+            self.logger.debug(f"history cache stats: {self.history_cache.stats()}")
+
+    def preload(self):
+        """Load the model modules in the background while the stream connects,
+        so the first message does not wait for them."""
+        started = time.monotonic()
+        try:
+            from langchain.memory import ConversationBufferMemory  # noqa: F401
+
+            self.chatbot.preload()
+        except Exception:
+            self.logger.error(traceback.format_exc())
+            return
+        self.logger.info(
+            f"model modules loaded in {(time.monotonic() - started) * 1000:.0f} ms"
+        )
+
+    def pre_start(self):
+        self.logger.info(
+            f"connecting to the DingTalk stream "
+            f"{(time.monotonic() - STARTED_AT) * 1000:.0f} ms after the imports"
+        )
+        threading.Thread(target=self.preload, name="preload", daemon=True).start()
+        if HANDLER_STATS_INTERVAL > 0:
+            threading.Thread(
+                target=self.report_stats,
+                args=(HANDLER_STATS_INTERVAL,),
+                name="handler-stats",
+                daemon=True,
+            ).start()
+
+    def stats(self):
+        return {
+            **self.async_executor.stats(),
+            **self.model_calls.stats(),
+            **self.conversations.stats(),
+        }
+
+    def report_stats(self, interval):
+        while True:
+            time.sleep(interval)
+            self.logger.info(f"handler stats: {json.dumps(self.stats())}")
+            if self.response_cache is not None:
+                self.logger.info(
+                    f"response cache stats: {json.dumps(self.response_cache.stats())}"
+                )
+            if self.history_batcher is not None:
+                self.logger.info(
+                    f"history batcher stats: {json.dumps(self.history_batcher.stats())}"
+                )
+            if self.metrics.histograms:
+                self.logger.info(f"turn timings: {json.dumps(self.metrics.dump())}")
+            if isinstance(self.chatbot, RoutedChatbot):
+                self.logger.info(
+                    f"model router stats: {json.dumps(self.chatbot.stats())}"
                 )
 
-        if is_first_reply:
-            card_biz_id = self.reply_card(
-                card,
-                incoming_message,
-                False,
-            )
-        elif i % STREAM_SIZE != 0:
-            self.update_card(
-                card_biz_id,
-                card,
+    def reply_overloaded(self, callback: dingtalk_stream.CallbackMessage):
+        incoming_message = dingtalk_stream.ChatbotMessage.from_dict(callback.data)
+        self.logger.warning(
+            f"message of {incoming_message.conversation_id} rejected, queue is full"
+        )
+        self.reply_text(OVERLOADED_MESSAGE, incoming_message)
+
+    async def raw_process(self, callback_message: dingtalk_stream.CallbackMessage):
+        def func():
+            try:
+                self.process(callback_message)
+            except Exception:
+                self.logger.error(traceback.format_exc())
+
+        if self.async_executor.try_submit(func) is None:
+            asyncio.get_running_loop().run_in_executor(
+                None, self.reply_overloaded, callback_message
             )
+        return ok_ack(callback_message)
 
     def process(self, callback: dingtalk_stream.CallbackMessage):
         """
@@ -111,42 +512,320 @@ class CardBotHandler(dingtalk_stream.AsyncChatbotHandler):
         """
 
         incoming_message = dingtalk_stream.ChatbotMessage.from_dict(callback.data)
-        input_text = incoming_message.text.content.strip()
+        input_text = message_text(incoming_message)
         conversation_id = incoming_message.conversation_id.strip()
 
         self.logger.info(callback.headers)
         self.logger.info(callback.data)
 
-        if input_text in ["", "帮助", "help"]:
+        if input_text in HELP_COMMANDS:
             self.reply_text(
                 WELCOME_MESSAGE,
                 incoming_message,
             )
             return AckMessage.STATUS_OK, "OK"
-        elif input_text in ["重置", "reset"]:
-            message_history = DynamoDBChatMessageHistory(
-                table_name=os.environ.get(
-                    "DDB_TABLE_NAME", "chatbot_conversation_table"
-                ),
-                session_id=conversation_id,
-            )
-            message_history.clear()
-            self.logger.info(f"message_history for {conversation_id} cleared.")
+
+        # 同一会话同时只回答一条消息
+        state = self.conversations.start(conversation_id, incoming_message)
+        if state == REJECTED:
+            self.reply_text(BUSY_MESSAGE, incoming_message)
+            return AckMessage.STATUS_OK, "OK"
+        elif state == QUEUED:
+            self.logger.info(f"message queued behind the turn of {conversation_id}")
+            return AckMessage.STATUS_OK, "OK"
+
+        messages = [incoming_message]
+        try:
+            while messages:
+                for turn in split_turns(messages):
+                    self.handle_turn(turn, conversation_id)
+                messages = self.conversations.next(conversation_id)
+        except BaseException:
+            self.reply_dropped(self.conversations.release(conversation_id))
+            raise
+        return AckMessage.STATUS_OK, "OK"
+
+    def reply_dropped(self, messages):
+        """Answer the messages that waited behind a failed turn, nobody else will."""
+        for message in messages:
+            try:
+                self.reply_text(ERROR_MESSAGE, message)
+            except Exception as e:
+                self.logger.error(e)
+
+    def handle_turn(self, messages, conversation_id):
+        # Coalesced messages are answered together, with the card under the last one.
+        incoming_message = messages[-1]
+        input_text = "\n".join(map(message_text, messages))
+        try:
+            if input_text in RESET_COMMANDS:
+                message_history = self.message_history(conversation_id)
+                message_history.clear()
+                self.logger.info(f"message_history for {conversation_id} cleared.")
+                self.reply_text(
+                    "会话已重置",
+                    incoming_message,
+                )
+                return
+
+            metrics = self.metrics.turn(self.chatbot.model_id)
+            try:
+                self.bedrock_reply_stream(
+                    input_text, incoming_message, conversation_id, metrics=metrics
+                )
+            except Exception:
+                metrics.observe(ERRORS, 1)
+                raise
+            finally:
+                metrics.finish()
+        except Exception as e:
+            self.logger.error(e)
             self.reply_text(
-                "会话已重置",
+                THROTTLED_MESSAGE if is_throttling_error(e) else ERROR_MESSAGE,
                 incoming_message,
             )
-            return AckMessage.STATUS_OK, "OK"
 
+
+class AsyncioCardBotHandler(CardBotHandler):
+    """
+    asyncio 版本的 CardBotHandler。
+    每条消息是事件循环上的一个任务，Bedrock 流式输出和钉钉卡片更新都用 aiohttp 发送，
+    等待时不占用线程；DynamoDB 读写较快但会阻塞，在 async_executor 线程池中执行。
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        model_id,
+        max_concurrency=HANDLER_MAX_CONCURRENCY,
+        io_workers=HANDLER_IO_WORKERS,
+        max_queue_size=HANDLER_MAX_QUEUE_SIZE,
+        max_model_calls=MAX_INFLIGHT_MODEL_CALLS,
+    ):
+        # The worker pool only runs blocking calls here, it is not bounded.
+        super(AsyncioCardBotHandler, self).__init__(
+            logger,
+            model_id,
+            max_workers=io_workers,
+            max_queue_size=None,
+            max_model_calls=max_model_calls,
+        )
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.concurrency = asyncio.Semaphore(max_concurrency)
+        self.tasks = set()
+        self.active = 0
+        self.rejected = 0
+        # Created in the event loop on the first message.
+        self.http_session = None
+        self.bedrock = None
+        self.replier = None
+
+    def start_clients(self):
+        if self.http_session is not None:
+            return
+        import aiohttp
+        from chatbot.bedrock_async import AsyncBedrockClient
+        from chatbot.dingtalk_async import AsyncDingTalkReplier
+
+        self.http_session = aiohttp.ClientSession()
+        self.bedrock = AsyncBedrockClient(
+            self.http_session,
+            connect_timeout=BEDROCK_CONNECT_TIMEOUT,
+            read_timeout=BEDROCK_READ_TIMEOUT,
+            max_attempts=BEDROCK_MAX_ATTEMPTS,
+        )
+        self.replier = AsyncDingTalkReplier(self.dingtalk_client, self.http_session)
+
+    def run_blocking(self, func, *args, **kwargs):
+        return asyncio.get_running_loop().run_in_executor(
+            self.async_executor, functools.partial(func, *args, **kwargs)
+        )
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self.active,
+            "queued": len(self.tasks) - self.active,
+            "rejected": self.rejected,
+            **self.model_calls.stats(),
+            **self.conversations.stats(),
+        }
+
+    async def raw_process(self, callback_message: dingtalk_stream.CallbackMessage):
+        # Acknowledge right away, the reply is sent by the task.
+        if len(self.tasks) >= self.max_concurrency + self.max_queue_size:
+            self.rejected += 1
+            coroutine = self.reply_overloaded_async(callback_message)
+        else:
+            coroutine = self.process_async(callback_message)
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return ok_ack(callback_message)
+
+    async def reply_overloaded_async(self, callback: dingtalk_stream.CallbackMessage):
+        self.start_clients()
+        incoming_message = dingtalk_stream.ChatbotMessage.from_dict(callback.data)
+        self.logger.warning(
+            f"message of {incoming_message.conversation_id} rejected, queue is full"
+        )
+        await self.replier.reply_text(OVERLOADED_MESSAGE, incoming_message)
+
+    async def process_async(self, callback: dingtalk_stream.CallbackMessage):
         try:
-            self.bedrock_reply_stream(input_text, incoming_message, conversation_id)
+            async with self.concurrency:
+                self.active += 1
+                try:
+                    await self.handle_message(callback)
+                finally:
+                    self.active -= 1
+        except Exception:
+            self.logger.error(traceback.format_exc())
+
+    async def handle_message(self, callback: dingtalk_stream.CallbackMessage):
+        self.start_clients()
+        incoming_message = dingtalk_stream.ChatbotMessage.from_dict(callback.data)
+        input_text = message_text(incoming_message)
+        conversation_id = incoming_message.conversation_id.strip()
+
+        self.logger.info(callback.headers)
+        self.logger.info(callback.data)
+
+        if input_text in HELP_COMMANDS:
+            await self.replier.reply_text(WELCOME_MESSAGE, incoming_message)
+            return
+
+        state = self.conversations.start(conversation_id, incoming_message)
+        if state == REJECTED:
+            await self.replier.reply_text(BUSY_MESSAGE, incoming_message)
+            return
+        elif state == QUEUED:
+            self.logger.info(f"message queued behind the turn of {conversation_id}")
+            return
+
+        messages = [incoming_message]
+        try:
+            while messages:
+                for turn in split_turns(messages):
+                    await self.handle_turn_async(turn, conversation_id)
+                messages = self.conversations.next(conversation_id)
+        except BaseException:
+            await self.reply_dropped_async(self.conversations.release(conversation_id))
+            raise
+
+    async def reply_dropped_async(self, messages):
+        for message in messages:
+            try:
+                await self.replier.reply_text(ERROR_MESSAGE, message)
+            except Exception as e:
+                self.logger.error(e)
+
+    async def handle_turn_async(self, messages, conversation_id):
+        incoming_message = messages[-1]
+        input_text = "\n".join(map(message_text, messages))
+        try:
+            if input_text in RESET_COMMANDS:
+                message_history = await self.run_blocking(
+                    self.message_history, conversation_id
+                )
+                await self.run_blocking(message_history.clear)
+                self.logger.info(f"message_history for {conversation_id} cleared.")
+                await self.replier.reply_text("会话已重置", incoming_message)
+                return
+
+            metrics = self.metrics.turn(self.chatbot.model_id)
+            try:
+                await self.bedrock_reply_stream_async(
+                    input_text, incoming_message, conversation_id, metrics=metrics
+                )
+            except Exception:
+                metrics.observe(ERRORS, 1)
+                raise
+            finally:
+                metrics.finish()
         except Exception as e:
             self.logger.error(e)
-            self.reply_text(
-                "出了点小问题,请输入'重置'清理后再尝试,或者联系管理员.",
+            await self.replier.reply_text(
+                THROTTLED_MESSAGE if is_throttling_error(e) else ERROR_MESSAGE,
                 incoming_message,
             )
-            return AckMessage.STATUS_OK, "OK"
+
+    async def bedrock_reply_stream_async(
+        self, input_text, incoming_message, conversation_id, metrics=None
+    ):
+        metrics = metrics or TurnMetrics()
+        card = deepcopy(INTERACTIVE_CARD_JSON_SAMPLE)
+        card["contents"][0]["id"] = f"text_{int(time.time() * 100)}"
+        card_updater = AsyncCardUpdater(
+            card,
+            reply=metrics.timed_async(
+                CARD_REPLY,
+                lambda card_data: self.replier.reply_card(card_data, incoming_message),
+            ),
+            update=metrics.timed_async(CARD_UPDATE, self.replier.update_card),
+            min_interval=CARD_UPDATE_MIN_INTERVAL,
+            max_pending_chars=CARD_UPDATE_MAX_PENDING_CHARS,
+            max_backoff=CARD_UPDATE_MAX_BACKOFF,
+        )
+
+        response = []
+        lookup = None
+        try:
+            message_history = await self.run_blocking(
+                self.message_history,
+                conversation_id,
+                limited_item_count=int(
+                    os.environ.get("INPUT_HISTORY_CONVERSATION_COUNT", "10")
+                )
+                * 2,
+            )
+            # Reading the messages also loads the summary in "summary" mode.
+            with metrics.span(HISTORY_LOAD):
+                history = await self.run_blocking(lambda: message_history.messages)
+            summary = getattr(message_history, "summary", "")
+            lookup = await self.run_blocking(
+                self.lookup_response,
+                input_text,
+                conversation_id,
+                metrics,
+                history,
+                summary,
+            )
+            if lookup is not None and lookup.response is not None:
+                response.append(lookup.response)
+                card_updater.append(lookup.response)
+            else:
+                async with self.model_calls:
+                    async for text in self.chatbot.ask_stream_async(
+                        self.bedrock,
+                        input_text,
+                        history,
+                        summary,
+                        metrics=metrics,
+                    ):
+                        response.append(text)
+                        card_updater.append(text)
+        finally:
+            await card_updater.finish()
+
+        if lookup is not None and lookup.response is None:
+            self.response_cache.store(lookup, "".join(response))
+
+        if response:
+            with metrics.span(HISTORY_WRITE):
+                await self.run_blocking(
+                    message_history.add_messages,
+                    [
+                        HumanMessage(content=input_text),
+                        AIMessage(content="".join(response)),
+                    ],
+                )
+
+        self.submit_summary(message_history, len(history))
+
+        if self.history_cache is not None:
+            self.logger.debug(f"history cache stats: {self.history_cache.stats()}")
 
 # Main Function
 def main():
@@ -160,16 +839,27 @@ def main():
 
     logger.info(dingtalk_settings + "," + dingtalk_settings_region)
 
-    app_key, app_secret = load_dingtalk_app_setting(
-        dingtalk_settings, dingtalk_settings_region
+    credentials = DingTalkCredentialProvider(
+        dingtalk_settings or None,
+        dingtalk_settings_region,
+        ttl_seconds=float(os.environ.get("DINGTALK_SETTING_TTL_SECONDS", "3600")),
+        fallback_file=os.environ.get("DINGTALK_SETTING_FILE") or None,
     )
+    app_key, app_secret = credentials.get()
+    logger.info(f"DingTalk credentials loaded from {credentials.source}")
 
     credential = dingtalk_stream.Credential(app_key, app_secret)
     client = dingtalk_stream.DingTalkStreamClient(credential)
+    # 密钥轮换后无需重启，新连接和新的 access token 使用新密钥
+    credentials.subscribe(functools.partial(update_stream_credential, client))
+    credentials.start()
 
+    handler_class = (
+        AsyncioCardBotHandler if HANDLER_MODE == "asyncio" else CardBotHandler
+    )
     client.register_callback_handler(
         dingtalk_stream.chatbot.ChatbotMessage.TOPIC,
-        CardBotHandler(logger, bedrock_model_id),
+        handler_class(logger, bedrock_model_id),
     )
     client.start_forever()
 
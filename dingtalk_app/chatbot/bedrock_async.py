@@ -0,0 +1,207 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Bedrock response streaming on asyncio.
+
+boto3 is blocking, so a streamed reply holds a thread for its whole duration.
+`AsyncBedrockClient` sends InvokeModelWithResponseStream with aiohttp instead,
+signs it with botocore and decodes the event stream with botocore's parser, so
+one event loop can stream thousands of replies at once.
+"""
+
+import asyncio
+import base64
+import copy
+import json
+import random
+from typing import Any, AsyncIterator, Dict, Optional
+from urllib.parse import quote
+
+# Rejections retried before the stream starts, like botocore's retry modes do.
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class BedrockStreamError(Exception):
+    """Error returned by Bedrock, before or during the stream.
+
+    `code` is the Bedrock exception type, e.g. "ThrottlingException".
+    """
+
+    def __init__(self, code: str, message: str, status: Optional[int] = None):
+        super().__init__(f"{code}: {message}")
+        self.code = code
+        self.status = status
+
+
+class AsyncBedrockClient:
+    """
+    Minimal asyncio client of the bedrock-runtime streaming API.
+
+    :param session: aiohttp session, owned by the caller
+    :param region_name: defaults to the region of the default boto3 session
+    :param endpoint_url: overrides the regional bedrock-runtime endpoint
+    :param credentials: botocore credentials, defaults to the default chain.
+        Refreshable credentials are refreshed by botocore when they expire.
+    :param connect_timeout: seconds to establish a connection
+    :param read_timeout: seconds to wait for the first byte of the response and
+        between the chunks of the stream
+    :param max_attempts: attempts of a throttled or failed request, including
+        the first one. Retries wait a random time up to an exponentially growing
+        cap ("full jitter").
+    :param backoff_base: cap of the first retry wait, in seconds
+    :param max_backoff: largest retry wait, in seconds
+    """
+
+    service_name = "bedrock"
+
+    def __init__(
+        self,
+        session,
+        region_name: Optional[str] = None,
+        endpoint_url: Optional[str] = None,
+        credentials=None,
+        connect_timeout: float = 5,
+        read_timeout: float = 60,
+        max_attempts: int = 5,
+        backoff_base: float = 0.5,
+        max_backoff: float = 20,
+    ):
+        import aiohttp
+        import boto3
+
+        boto3_session = boto3.session.Session(region_name=region_name)
+        self.session = session
+        self.region_name = boto3_session.region_name
+        self.endpoint_url = (
+            endpoint_url or f"https://bedrock-runtime.{self.region_name}.amazonaws.com"
+        )
+        self.credentials = credentials or boto3_session.get_credentials()
+        self.custom_endpoint = endpoint_url is not None
+        self.timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        # Clients of other regions, shared by all of them.
+        self._regional_clients = {self.region_name: self}
+
+    def for_region(self, region_name: Optional[str]) -> "AsyncBedrockClient":
+        """Client with the same session and settings for `region_name`.
+
+        A custom endpoint is kept, requests are only signed for the region.
+        """
+        if not region_name:
+            return self
+        client = self._regional_clients.get(region_name)
+        if client is None:
+            client = copy.copy(self)
+            client.region_name = region_name
+            if not self.custom_endpoint:
+                client.endpoint_url = (
+                    f"https://bedrock-runtime.{region_name}.amazonaws.com"
+                )
+            self._regional_clients[region_name] = client
+        return client
+
+    def _signed_headers(self, url: str, body: bytes) -> Dict[str, str]:
+        from botocore.auth import SigV4Auth
+        from botocore.awsrequest import AWSRequest
+
+        request = AWSRequest(
+            method="POST",
+            url=url,
+            data=body,
+            headers={
+                "Content-Type": "application/json",
+                "X-Amzn-Bedrock-Accept": "application/json",
+            },
+        )
+        SigV4Auth(
+            self.credentials.get_frozen_credentials(),
+            self.service_name,
+            self.region_name,
+        ).add_auth(request)
+        return dict(request.headers.items())
+
+    async def invoke_model_with_response_stream(
+        self, model_id: str, body: Dict[str, Any]
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Invoke `model_id` with the request `body` and yield the decoded chunks.
+
+        Raises `BedrockStreamError` when the request is rejected or the stream
+        ends with an exception event. Rejected requests are retried; once the
+        stream started, errors are raised since chunks were already yielded.
+        """
+        from botocore.eventstream import EventStreamBuffer
+
+        url = f"{self.endpoint_url}/model/{quote(model_id, safe='')}/invoke-with-response-stream"
+        data = json.dumps(body).encode()
+
+        for attempt in range(1, self.max_attempts + 1):
+            response = await self._post(url, data)
+            if response.status == 200:
+                break
+            payload = await response.read()
+            response.release()
+            error = BedrockStreamError(
+                response.headers.get("x-amzn-ErrorType", "").split(":")[0]
+                or str(response.status),
+                _error_message(payload),
+                response.status,
+            )
+            if (
+                response.status not in RETRYABLE_STATUS_CODES
+                or attempt == self.max_attempts
+            ):
+                raise error
+            await asyncio.sleep(
+                random.uniform(
+                    0, min(self.max_backoff, self.backoff_base * 2 ** (attempt - 1))
+                )
+            )
+
+        try:
+            buffer = EventStreamBuffer()
+            async for data in response.content.iter_any():
+                buffer.add_data(data)
+                for message in buffer:
+                    headers = message.headers
+                    if headers.get(":message-type") == "event":
+                        if headers.get(":event-type") == "chunk":
+                            chunk = json.loads(message.payload)
+                            yield json.loads(base64.b64decode(chunk["bytes"]))
+                    else:
+                        raise BedrockStreamError(
+                            headers.get(":exception-type")
+                            or headers.get(":error-code", "UnknownError"),
+                            _error_message(message.payload)
+                            or headers.get(":error-message", ""),
+                        )
+        except BaseException:
+            # Errors, cancellation and closing the generator, e.g. by a
+            # failover, leave the stream unread, its connection is dropped.
+            response.close()
+            raise
+        # Read to the end, the connection goes back to the pool.
+        response.release()
+        await response.wait_for_close()
+
+    async def _post(self, url: str, data: bytes):
+        from yarl import URL
+
+        # Signed again for each attempt, the signature includes the time.
+        headers = self._signed_headers(url, data)
+        # The path is already percent-encoded and signed that way.
+        return await self.session.post(
+            URL(url, encoded=True), data=data, headers=headers, timeout=self.timeout
+        )
+
+
+def _error_message(payload: bytes) -> str:
+    try:
+        body = json.loads(payload)
+    except ValueError:
+        return payload.decode(errors="replace")
+    return body.get("message") or body.get("Message") or ""
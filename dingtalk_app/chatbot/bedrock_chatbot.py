@@ -1,29 +1,131 @@
 #  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
 #  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
 
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferMemory
-from langchain_core.prompts import PromptTemplate
-from langchain_community.llms.bedrock import Bedrock
-from langchain_community.chat_models import BedrockChat
+import functools
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from langchain_core.messages import BaseMessage, get_buffer_string
+
+from .clients import get_bedrock_runtime_client
+from .metrics import (
+    HISTORY_LOAD,
+    HISTORY_WRITE,
+    PROMPT_BUILD,
+    TIME_TO_FIRST_TOKEN,
+    TurnMetrics,
+)
+from .tokens import estimate_tokens, select_history
+
+if TYPE_CHECKING:
+    # langchain.memory and the langchain_community models take most of the
+    # startup time, they are imported on first use, see `preload`.
+    from langchain.memory import ConversationBufferMemory
+    from langchain_core.prompts import PromptTemplate
 
 supported_models = [
     "anthropic.claude-v2:1",
     "anthropic.claude-v1",
     "anthropic.claude-instant-v1",
     "anthropic.claude-3-haiku-20240307-v1:0",
-    "anthropic.claude-3-sonnet-20240229-v1:0"
+    "anthropic.claude-3-sonnet-20240229-v1:0",
+    "anthropic.claude-3-5-haiku-20241022-v1:0",
+    "anthropic.claude-3-7-sonnet-20250219-v1:0",
+]
+
+# Models accepting `cache_control` blocks on Bedrock, the others reject them.
+prompt_caching_models = [
+    "anthropic.claude-3-5-haiku-20241022-v1:0",
+    "anthropic.claude-3-7-sonnet-20250219-v1:0",
 ]
 
+logger = logging.getLogger(__name__)
+
+SYSTEM_TEMPLATE = """The following is a friendly conversation between a human and an AI. The AI is able to provide accurate information in a structured way. The AI is able to provide information in a clear and concise manner.If the AI does not know the answer to a question, it truthfully says it does not know."""
+
+DEFAULT_TEMPLATE = SYSTEM_TEMPLATE + """
+
+Current conversation:
+{history}
+Human: {input}
+Assistant:"""
+
+# Marks the end of a prompt prefix that Bedrock may cache between calls.
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Error codes of Bedrock refusing a call because of load, compared lowercase.
+THROTTLING_ERROR_CODES = {
+    "throttlingexception",
+    "toomanyrequestsexception",
+    "serviceunavailableexception",
+}
+
+
+def is_throttling_error(error: Optional[BaseException]) -> bool:
+    """Whether `error`, or an error it was raised from, is Bedrock throttling.
+
+    Understands botocore errors, `BedrockStreamError` and the errors LangChain
+    raises while handling them.
+    """
+    while error is not None:
+        code = getattr(error, "code", None)
+        response = getattr(error, "response", None)
+        if not isinstance(code, str) and isinstance(response, dict):
+            code = response.get("Error", {}).get("Code")
+        if isinstance(code, str) and code.lower() in THROTTLING_ERROR_CODES:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def _close(stream) -> None:
+    """Close a stream of chunks or events, if it can be closed."""
+    close = getattr(stream, "close", None)
+    if close is not None:
+        close()
+
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:"
+
 
 class Chatbot:
     def __init__(
         self,
         model_id="anthropic.claude-v2:1",
         stop=None,
+        history_token_budget: Optional[int] = None,
+        prompt_caching: bool = False,
+        client=None,
     ):
+        """
+        :param client: bedrock-runtime client, by default the shared client of
+            `get_bedrock_runtime_client`
+        """
         if model_id not in supported_models:
             raise ValueError(f"model_id {model_id} is not supported")
+        self.model_id = model_id
+        # Claude 3 models only support the messages API.
+        self.messages_api = "anthropic.claude-3" in model_id
+        self.prompt_caching = prompt_caching and model_id in prompt_caching_models
+        if prompt_caching and not self.prompt_caching:
+            logger.warning(f"{model_id} does not support prompt caching, disabled")
+        self.usage_totals = Counter()
+        self._usage_lock = threading.Lock()
 
         # Please check carefully with updated bedrock documents
         # https://us-west-2.console.aws.amazon.com/bedrock/home?region=us-west-2#/models
@@ -56,43 +158,124 @@ class Chatbot:
 
         self.stop = stop if stop is not None else self.default_stop
 
-        if "anthropic.claude-3" in model_id:
-            self.engine = BedrockChat(
-                model_id=model_id, streaming=True, model_kwargs=self.model_kwargs
+        # Tokens left for the conversation history once the template and the
+        # response are accounted for. A configured budget can only lower it.
+        self.max_output_tokens = (
+            self.model_kwargs.get("max_tokens_to_sample")
+            or self.model_kwargs.get("max_tokens")
+            or self.model_kwargs.get("max_gen_len")
+            or 1024
+        )
+        self.history_token_budget = max(
+            self.max_token - self.max_output_tokens - estimate_tokens(DEFAULT_TEMPLATE),
+            0,
+        )
+        if history_token_budget is not None:
+            self.history_token_budget = min(
+                self.history_token_budget, history_token_budget
             )
 
-        else:
-            self.engine = Bedrock(
-                model_id=model_id, streaming=True, model_kwargs=self.model_kwargs
-            )
+        # The engine is created on first use, with the model modules.
+        self.client = client
+        self._engine = None
+        self._engine_lock = threading.Lock()
+
+    @property
+    def engine(self):
+        """The langchain model, `BedrockChat` for messages API models."""
+        if self._engine is None:
+            with self._engine_lock:
+                if self._engine is None:
+                    self._engine = self._create_engine()
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine):
+        self._engine = engine
+
+    def _create_engine(self):
+        from langchain_community.chat_models import BedrockChat
+        from langchain_community.llms.bedrock import Bedrock
+
+        if self.client is None:
+            self.client = get_bedrock_runtime_client()
+        engine_class = BedrockChat if self.messages_api else Bedrock
+        return engine_class(
+            model_id=self.model_id,
+            client=self.client,
+            streaming=True,
+            model_kwargs=self.model_kwargs,
+        )
+
+    @functools.cached_property
+    def prompt(self) -> "PromptTemplate":
+        """The template, compiled once per Chatbot."""
+        from langchain_core.prompts import PromptTemplate
+
+        return PromptTemplate(
+            input_variables=["history", "input"], template=DEFAULT_TEMPLATE
+        )
+
+    @property
+    def summary_prompt(self) -> "PromptTemplate":
+        from langchain.memory.prompt import SUMMARY_PROMPT
+
+        return SUMMARY_PROMPT
+
+    def preload(self) -> None:
+        """Import the model modules and create the engine ahead of the first
+        message, e.g. while the stream client connects."""
+        self.prompt
+        self.summary_prompt
+        self.engine
 
     def ask_stream(
         self,
         input_text: str,
-        conversation_history: ConversationBufferMemory = ConversationBufferMemory(
-            ai_prefix="Assistant"
-        ),
+        conversation_history: Optional["ConversationBufferMemory"] = None,
         verbose: bool = False,
+        metrics: Optional[TurnMetrics] = None,
+        history: Optional[List[BaseMessage]] = None,
+        summary: Optional[str] = None,
+        request: Union[dict, str, None] = None,
         **kwargs,
-    ):
+    ) -> Iterator[str]:
         """Processes a stream of input by invoking the engine.
 
+        The prompt template is compiled once per Chatbot; a call only formats it
+        with the conversation history and streams the engine output. Only the
+        newest messages that fit into `history_token_budget` are sent, after
+        the rolling summary of older messages if the history has one. The
+        request is sent before this method returns, so engine errors are raised
+        here rather than on the first iteration.
+
         Parameters
         ----------
         conversation_history: ConversationBufferMemory
-            The conversation history
+            The conversation history. The human input and the response are saved
+            to it once the stream has been fully consumed.
         input_text: str
             The input prompt or message.
         verbose: boolean
-            if the langchain shall show the detailed logging
+            if the formatted prompt shall be logged
+        metrics: TurnMetrics
+            Receives the time spent loading the history, building the prompt,
+            waiting for the first token, streaming and saving the turn.
+        history: List[BaseMessage]
+            The messages of `conversation_history`, when the caller already
+            read them; they are not read again.
+        summary: str
+            The rolling summary loaded with `history`.
+        request: dict or str
+            The result of `build_request` for this input and history, when the
+            caller already built it, e.g. for several attempts.
         kwargs: dict
             Additional keyword arguments to pass to the engine.
-            For example, you can pass in temperature to control the model's
-            creativity.
+            For example, you can pass in stop to override the stop sequences.
         Returns
         -------
-        str
-            The response generated by the engine.
+        Iterator[str]
+            The chunks of the response generated by the engine.
 
         Raises
         ------
@@ -100,20 +283,280 @@ class Chatbot:
         """
 
         temp_stop = kwargs.get("stop", self.stop)
+        if metrics is None:
+            metrics = TurnMetrics()
+        metrics.model_id = self.model_id
 
-        template = """The following is a friendly conversation between a human and an AI. The AI is able to provide accurate information in a structured way. The AI is able to provide information in a clear and concise manner.If the AI does not know the answer to a question, it truthfully says it does not know.
+        if history is None:
+            with metrics.span(HISTORY_LOAD):
+                history = (
+                    conversation_history.chat_memory.messages
+                    if conversation_history
+                    else []
+                )
+                # Loaded together with the messages in "summary" memory mode.
+                summary = getattr(
+                    getattr(conversation_history, "chat_memory", None), "summary", ""
+                )
+        summary = summary or ""
+        if request is None:
+            with metrics.span(PROMPT_BUILD):
+                request = self.build_request(input_text, history, summary, temp_stop)
+        if verbose:
+            logger.info(request)
+        with metrics.span(TIME_TO_FIRST_TOKEN):
+            if self.messages_api:
+                # Sent without LangChain, which can neither mark cacheable
+                # content nor report the token usage of a stream.
+                chunks = self._invoke_stream(request)
+            else:
+                chunks = iter(self.engine.stream(request, stop=temp_stop))
+            first_chunk = next(chunks, None)
+        return self._relay(
+            first_chunk, chunks, input_text, conversation_history, metrics
+        )
 
-        Current conversation:
-        {history}
-        Human: {input}
-        Assistant:"""
-        PROMPT = PromptTemplate(input_variables=["history", "input"], template=template)
+    def history_turns(
+        self, input_text: str, history: List[BaseMessage], summary: str = ""
+    ) -> Tuple[str, List[str]]:
+        """The summary and the text of each turn of the newest messages that
+        fit the token budget."""
+        budget = self.history_token_budget - estimate_tokens(input_text)
+        if summary:
+            summary = f"{SUMMARY_PREFIX}\n{summary}\n"
+            budget -= estimate_tokens(summary)
+        turns: List[List[BaseMessage]] = []
+        for message in select_history(history, budget):
+            if message.type == "human" or not turns:
+                turns.append([])
+            turns[-1].append(message)
+        return summary, [
+            get_buffer_string(turn, human_prefix="Human", ai_prefix="Assistant")
+            for turn in turns
+        ]
 
-        chain = ConversationChain(
-            llm=self.engine,
-            memory=conversation_history,
-            verbose=verbose,
-            prompt=PROMPT,
+    def history_text(
+        self, input_text: str, history: List[BaseMessage], summary: str = ""
+    ) -> str:
+        """The summary and newest messages that fit the token budget, as text."""
+        summary, turns = self.history_turns(input_text, history, summary)
+        return summary + "\n".join(turns)
+
+    def format_prompt(
+        self, input_text: str, history: List[BaseMessage], summary: str = ""
+    ) -> str:
+        """Format the prompt with the newest messages that fit the token budget."""
+        return self.prompt.format(
+            history=self.history_text(input_text, history, summary), input=input_text
+        )
+
+    def build_request(
+        self,
+        input_text: str,
+        history: List[BaseMessage],
+        summary: str = "",
+        stop: Optional[List[str]] = None,
+    ) -> Union[dict, str]:
+        """What `ask_stream` sends: the request body for Messages API models,
+        the formatted prompt for the others."""
+        if self.messages_api:
+            return self.request_body(input_text, history, summary, stop)
+        return self.format_prompt(input_text, history, summary)
+
+    def request_body(
+        self,
+        input_text: str,
+        history: Optional[List[BaseMessage]] = None,
+        summary: str = "",
+        stop: Optional[List[str]] = None,
+    ) -> dict:
+        """InvokeModel request body answering `input_text`.
+
+        Messages API models get the same text as the prompt of the other models,
+        split into the system template, the conversation so far, one content
+        block per turn, and the new input. Once the history window is full the
+        turns change with every request, only the system template and the
+        summary stay the same until the summary is updated, so with
+        `prompt_caching` they are the cache checkpoint.
+        """
+        model_kwargs = dict(self.model_kwargs)
+        stop = self.stop if stop is None else stop
+        if stop:
+            model_kwargs["stop_sequences"] = stop
+        from langchain_community.llms.bedrock import LLMInputOutputAdapter
+
+        if not self.messages_api:
+            return LLMInputOutputAdapter.prepare_input(
+                "anthropic",
+                model_kwargs,
+                prompt=self.format_prompt(input_text, history or [], summary),
+            )
+
+        summary, turns = self.history_turns(input_text, history or [], summary)
+        content = [{"type": "text", "text": "Current conversation:\n" + summary}]
+        content.extend({"type": "text", "text": turn + "\n"} for turn in turns)
+        if self.prompt_caching:
+            # Prefixes shorter than the model minimum, e.g. without a summary,
+            # are sent uncached.
+            content[0]["cache_control"] = CACHE_CONTROL
+        content.append({"type": "text", "text": f"Human: {input_text}\nAssistant:"})
+        return LLMInputOutputAdapter.prepare_input(
+            "anthropic",
+            model_kwargs,
+            system=[{"type": "text", "text": SYSTEM_TEMPLATE}],
+            messages=[{"role": "user", "content": content}],
+        )
+
+    def _invoke_stream(self, body: dict) -> Iterator[str]:
+        response = self.engine.client.invoke_model_with_response_stream(
+            modelId=self.model_id,
+            body=json.dumps(body),
+            accept="application/json",
+            contentType="application/json",
+        )
+        events = response["body"]
+        usage = {}
+        finished = False
+        try:
+            for event in events:
+                chunk = event.get("chunk")
+                if not chunk:
+                    continue
+                chunk = json.loads(chunk["bytes"])
+                self.observe_usage(chunk, usage)
+                text = self.chunk_text(chunk)
+                if text:
+                    yield text
+            finished = True
+        finally:
+            if not finished:
+                # The stream was abandoned, e.g. by a failover, its connection
+                # cannot be reused.
+                _close(events)
+        self.record_usage(usage)
+
+    @staticmethod
+    def observe_usage(chunk: Dict[str, Any], usage: Dict[str, int]) -> None:
+        """Collect the token usage reported by the messages API stream."""
+        if chunk.get("type") == "message_start":
+            usage.update(chunk.get("message", {}).get("usage", {}))
+        elif chunk.get("type") == "message_delta":
+            usage.update(chunk.get("usage", {}))
+
+    def record_usage(self, usage: Dict[str, int]) -> None:
+        """Log the token usage of a call and add it to `usage_totals`.
+
+        The cache fields tell how many input tokens were written to and read
+        from the prompt cache.
+        """
+        if not usage:
+            return
+        usage = {key: value for key, value in usage.items() if isinstance(value, int)}
+        with self._usage_lock:
+            self.usage_totals.update(usage)
+        logger.info(f"bedrock usage of {self.model_id}: {json.dumps(usage)}")
+
+    @staticmethod
+    def chunk_text(chunk: Dict[str, Any]) -> str:
+        """Text of a decoded streaming chunk, "" for chunks without text."""
+        if chunk.get("type") == "content_block_delta":
+            return chunk.get("delta", {}).get("text", "")
+        return chunk.get("completion", "")
+
+    async def ask_stream_async(
+        self,
+        bedrock_client,
+        input_text: str,
+        history: Optional[List[BaseMessage]] = None,
+        summary: str = "",
+        verbose: bool = False,
+        metrics: Optional[TurnMetrics] = None,
+        body: Optional[dict] = None,
+        **kwargs,
+    ) -> AsyncIterator[str]:
+        """Asyncio version of `ask_stream`, streaming with an `AsyncBedrockClient`.
+
+        History is passed in rather than read here, since reading it from
+        DynamoDB blocks; saving the response and timing both is also left to
+        the caller. `body` is the `request_body` of the input, when the caller
+        already built it.
+        """
+        if metrics is None:
+            metrics = TurnMetrics()
+        metrics.model_id = self.model_id
+        if body is None:
+            with metrics.span(PROMPT_BUILD):
+                body = self.request_body(
+                    input_text, history, summary, kwargs.get("stop")
+                )
+        if verbose:
+            logger.info(body)
+
+        usage = {}
+        response = []
+        started = time.perf_counter()
+        first_token_at = None
+        async for chunk in bedrock_client.invoke_model_with_response_stream(
+            self.model_id, body
+        ):
+            self.observe_usage(chunk, usage)
+            text = self.chunk_text(chunk)
+            if text:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    metrics.observe(
+                        TIME_TO_FIRST_TOKEN, (first_token_at - started) * 1000
+                    )
+                response.append(text)
+                yield text
+        self.record_usage(usage)
+        if first_token_at is not None:
+            metrics.generated(
+                estimate_tokens("".join(response)),
+                time.perf_counter() - first_token_at,
+            )
+
+    @staticmethod
+    def _relay(first_chunk, chunks, input_text, conversation_history, metrics):
+        if first_chunk is None:
+            return
+        response = []
+        started = time.perf_counter()
+        try:
+            for chunk in itertools.chain([first_chunk], chunks):
+                # LLMs stream str, chat models stream message chunks.
+                text = chunk if isinstance(chunk, str) else chunk.content
+                response.append(text)
+                yield text
+        finally:
+            # Ends the call when the reply is closed before its end.
+            _close(chunks)
+        # Output tokens are estimated, not all models report them.
+        metrics.generated(
+            estimate_tokens("".join(response)), time.perf_counter() - started
         )
 
-        return chain.predict(input=input_text, stop=temp_stop)
+        if conversation_history is not None:
+            with metrics.span(HISTORY_WRITE):
+                conversation_history.save_context(
+                    {"input": input_text}, {"response": "".join(response)}
+                )
+
+    def summarize(self, summary: str, messages: List[BaseMessage]) -> str:
+        """Fold `messages` into the running `summary` and return the new summary."""
+        prompt = self.summary_prompt.format(
+            summary=summary,
+            new_lines=get_buffer_string(
+                messages, human_prefix="Human", ai_prefix="Assistant"
+            ),
+        )
+        result = self.engine.invoke(prompt, stop=self.stop)
+        return (result if isinstance(result, str) else result.content).strip()
+
+    def update_summary(self, message_history) -> bool:
+        """Update the rolling summary of a `DynamoDBChatMessageHistory`.
+
+        Meant to run off the reply path, after the answer was sent: it reads the
+        messages that fell out of the history window and invokes the model.
+        """
+        return message_history.summarize_pending(self.summarize)
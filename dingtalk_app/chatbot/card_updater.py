@@ -0,0 +1,280 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Executor
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# DingTalk answers QPS limits with 403 (Forbidden.AccessDenied.QpsLimit*) or 429.
+THROTTLING_STATUS_CODES = (403, 429)
+
+
+class CardUpdater:
+    """Coalesces streamed text into interactive card updates.
+
+    The first text is sent right away with `reply`, which creates the card.
+    After that, `update` is called when the first of these happens:
+
+    - `min_interval` seconds passed since the last push
+    - `max_pending_chars` characters arrived since the last push
+    - the stream ended (`finish`)
+
+    When a push fails, typically because DingTalk throttles the app, pushes are
+    paused for a backoff that doubles from `min_interval` up to `max_backoff`
+    and resets after a success.
+
+    Args:
+        card: card data, its first content's text is replaced on each push.
+        reply: sends the card and returns its card biz id, falsy on failure.
+            `ChatbotHandler.reply_card` with the incoming message bound.
+        update: `ChatbotHandler.update_card`, returns the response body or the
+            HTTP status code on failure.
+        min_interval: seconds after which pending text is pushed.
+        max_pending_chars: pending characters that trigger a push.
+        max_backoff: longest pause after a failed push, in seconds.
+        final_attempts: pushes tried by `finish` before giving up.
+    """
+
+    def __init__(
+        self,
+        card: dict,
+        reply: Callable[[dict], Optional[str]],
+        update: Callable[[str, dict], Any],
+        min_interval: float = 1.0,
+        max_pending_chars: int = 500,
+        max_backoff: float = 10.0,
+        final_attempts: int = 3,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.card = card
+        self.reply = reply
+        self.update = update
+        self.min_interval = min_interval
+        self.max_pending_chars = max_pending_chars
+        self.max_backoff = max_backoff
+        self.final_attempts = final_attempts
+        self.clock = clock
+        self.sleep = sleep
+
+        self.text = card["contents"][0]["text"]
+        self.card_biz_id = None
+        self.pending_chars = 0
+        self.last_push = None
+        self.backoff = 0.0
+        self.paused_until = 0.0
+        self.pushes = 0
+        self.failures = 0
+        self.throttled = 0
+
+    def append(self, text: str) -> None:
+        """Add streamed text and push it if one of the flush conditions is met."""
+        self.add(text)
+        if self.delay() == 0:
+            self.push()
+
+    def add(self, text: str) -> None:
+        """Add streamed text without pushing it."""
+        self.text += text
+        self.pending_chars += len(text)
+
+    def delay(self) -> float:
+        """Seconds until the pending text is due to be pushed, 0 if it is now."""
+        due = self.paused_until
+        if self.card_biz_id is not None and self.pending_chars < self.max_pending_chars:
+            due = max(due, self.last_push + self.min_interval)
+        return max(due - self.clock(), 0.0)
+
+    def finish(self) -> None:
+        """Push the complete text, waiting out throttling a few times if needed.
+
+        Sends nothing if no text arrived before the card was created, e.g. the
+        model call failed, so that the caller can reply with an error instead.
+        """
+        if self.card_biz_id is None and not self.pending_chars:
+            return
+        for _ in range(self.final_attempts):
+            if self.card_biz_id is not None and self.pending_chars == 0:
+                return
+            wait = self.paused_until - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+            self.push()
+        if self.card_biz_id is None or self.pending_chars:
+            logger.error("card was not updated with the final text")
+
+    def push(self) -> bool:
+        """Send the current text now. Returns False if DingTalk rejected it."""
+        pending_chars = self._start_push()
+        if self.card_biz_id is None:
+            return self._end_push(pending_chars, card_biz_id=self.reply(self.card))
+        return self._end_push(
+            pending_chars, result=self.update(self.card_biz_id, self.card)
+        )
+
+    def _start_push(self) -> int:
+        self.card["contents"][0]["text"] = self.text
+        pending_chars = self.pending_chars
+        self.pending_chars = 0
+        self.last_push = self.clock()
+        self.pushes += 1
+        return pending_chars
+
+    def _end_push(self, pending_chars: int, card_biz_id=None, result=None) -> bool:
+        status = None
+        if self.card_biz_id is None:
+            ok = bool(card_biz_id)
+            if ok:
+                self.card_biz_id = card_biz_id
+        else:
+            ok = result is not None and not isinstance(result, int)
+            status = result if isinstance(result, int) else None
+
+        if ok:
+            self.backoff = 0.0
+            self.paused_until = 0.0
+            return True
+
+        # reply_card does not tell why it failed, so every failure backs off:
+        # a failing API should not be hammered either.
+        self.pending_chars += pending_chars
+        self.failures += 1
+        if status in THROTTLING_STATUS_CODES:
+            self.throttled += 1
+        self.backoff = min(max(self.backoff * 2, self.min_interval), self.max_backoff)
+        self.paused_until = self.last_push + self.backoff
+        logger.warning(
+            "card push failed (status %s), pausing pushes for %.1fs",
+            status,
+            self.backoff,
+        )
+        return False
+
+
+class AsyncCardUpdater(CardUpdater):
+    """`CardUpdater` with coroutine `reply` and `update` functions.
+
+    The card is pushed by a task, so `append` never waits for DingTalk; like
+    `BackgroundCardUpdater`, the task always sends the latest text. Must be
+    created in a running event loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending = []
+        self._finished = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def append(self, text: str) -> None:
+        self._pending.append(text)
+        self._wakeup.set()
+
+    async def finish(self) -> None:
+        """Wait until the complete text was pushed, see `CardUpdater.finish`."""
+        self._finished = True
+        self._wakeup.set()
+        await self._task
+
+    async def push(self) -> bool:
+        pending_chars = self._start_push()
+        if self.card_biz_id is None:
+            return self._end_push(
+                pending_chars, card_biz_id=await self.reply(self.card)
+            )
+        return self._end_push(
+            pending_chars, result=await self.update(self.card_biz_id, self.card)
+        )
+
+    async def _wait(self, timeout: Optional[float] = None) -> None:
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _run(self) -> None:
+        while True:
+            if self._pending:
+                self.add("".join(self._pending))
+                self._pending.clear()
+            if self._finished:
+                break
+            if not self.pending_chars:
+                await self._wait()
+                continue
+            delay = self.delay()
+            if delay > 0:
+                await self._wait(delay)
+                continue
+            await self.push()
+
+        # Nothing to show, e.g. the model call failed: see `CardUpdater.finish`.
+        if self.card_biz_id is None and not self.pending_chars:
+            return
+        for _ in range(self.final_attempts):
+            if self.card_biz_id is not None and self.pending_chars == 0:
+                return
+            wait = self.paused_until - self.clock()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self.push()
+        if self.card_biz_id is None or self.pending_chars:
+            logger.error("card was not updated with the final text")
+
+
+class BackgroundCardUpdater:
+    """Pushes the text of a `CardUpdater` from an executor thread.
+
+    `append` only hands the text over, so reading the model stream never waits
+    for the DingTalk API. The pusher sends the latest text whenever the updater
+    says a push is due; text that arrives while a push is in flight is sent
+    with the next one, so intermediate states are dropped rather than queued.
+
+    Args:
+        updater: the updater to push with, only used by the pusher thread.
+        executor: runs the pusher until `finish` is called.
+    """
+
+    def __init__(self, updater: CardUpdater, executor: Executor):
+        self.updater = updater
+        self._condition = threading.Condition()
+        self._pending = []
+        self._finished = False
+        self._future = executor.submit(self._run)
+
+    def append(self, text: str) -> None:
+        with self._condition:
+            self._pending.append(text)
+            self._condition.notify()
+
+    def finish(self, timeout: Optional[float] = None) -> None:
+        """Wait until the complete text was pushed, see `CardUpdater.finish`."""
+        with self._condition:
+            self._finished = True
+            self._condition.notify()
+        self._future.result(timeout)
+
+    def _run(self) -> None:
+        updater = self.updater
+        while True:
+            with self._condition:
+                if self._pending:
+                    updater.add("".join(self._pending))
+                    self._pending.clear()
+                if self._finished:
+                    break
+                if not updater.pending_chars:
+                    self._condition.wait()
+                    continue
+                delay = updater.delay()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+            updater.push()
+        updater.finish()
@@ -0,0 +1,184 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Process-wide registry of AWS resources.
+
+Creating a boto3 resource resolves credentials and endpoints and opens a new HTTP
+connection pool, which is too slow to do for every incoming DingTalk message.
+Resources and table handles are created once per process and shared between the
+handler threads. boto3 sessions are not thread-safe, so each resource gets its
+own session and creation is serialized by a lock; the low-level clients behind
+the resources are safe to call from multiple threads.
+"""
+
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+# Reentrant: a table factory creates its resource through `cached` as well.
+_lock = threading.RLock()
+_registry: Dict[Hashable, Any] = {}
+
+
+def cached(key: Hashable, factory: Callable[[], Any]) -> Any:
+    """Return the object registered under `key`, creating it with `factory` once."""
+    try:
+        return _registry[key]
+    except KeyError:
+        pass
+    with _lock:
+        if key not in _registry:
+            _registry[key] = factory()
+        return _registry[key]
+
+
+def clear():
+    """Forget every cached resource, e.g. after credentials were rotated."""
+    with _lock:
+        _registry.clear()
+
+
+def get_dynamodb_resource(
+    endpoint_url: Optional[str] = None, max_pool_connections: Optional[int] = None
+):
+    """
+    Shared DynamoDB service resource.
+
+    :param endpoint_url: optional endpoint, e.g. DynamoDB Local
+    :param max_pool_connections: HTTP connection pool size, should be at least the
+        number of threads using the resource at the same time. botocore defaults to 10.
+    """
+
+    def factory():
+        import boto3
+        from botocore.config import Config
+
+        config = (
+            Config(max_pool_connections=max_pool_connections)
+            if max_pool_connections
+            else None
+        )
+        return boto3.session.Session().resource(
+            "dynamodb", endpoint_url=endpoint_url, config=config
+        )
+
+    return cached(("dynamodb", endpoint_url, max_pool_connections), factory)
+
+
+def encrypt_table(table, kms_key_id: str, attribute: str):
+    """Wrap `table` so that `attribute` is encrypted and signed client-side with KMS."""
+    try:
+        from dynamodb_encryption_sdk.encrypted.table import EncryptedTable
+        from dynamodb_encryption_sdk.identifiers import CryptoAction
+        from dynamodb_encryption_sdk.material_providers.aws_kms import (
+            AwsKmsCryptographicMaterialsProvider,
+        )
+        from dynamodb_encryption_sdk.structures import AttributeActions
+    except ImportError as e:
+        raise ImportError(
+            "Unable to import dynamodb_encryption_sdk, please install with "
+            "`pip install dynamodb-encryption-sdk`."
+        ) from e
+
+    actions = AttributeActions(
+        default_action=CryptoAction.DO_NOTHING,
+        attribute_actions={attribute: CryptoAction.ENCRYPT_AND_SIGN},
+    )
+    aws_kms_cmp = AwsKmsCryptographicMaterialsProvider(key_id=kms_key_id)
+    return EncryptedTable(
+        table=table,
+        materials_provider=aws_kms_cmp,
+        attribute_actions=actions,
+        auto_refresh_table_indexes=False,
+    )
+
+
+def get_dynamodb_table(
+    table_name: str,
+    endpoint_url: Optional[str] = None,
+    kms_key_id: Optional[str] = None,
+    encrypted_attribute: str = "History",
+    max_pool_connections: Optional[int] = None,
+):
+    """
+    Shared handle of a DynamoDB table, keyed by table name, endpoint and KMS key.
+
+    :param table_name: name of the DynamoDB table
+    :param endpoint_url: optional endpoint, e.g. DynamoDB Local
+    :param kms_key_id: if set, `encrypted_attribute` is encrypted client-side
+    :param encrypted_attribute: attribute holding the conversation
+    :param max_pool_connections: see `get_dynamodb_resource`
+    """
+
+    def factory():
+        resource = get_dynamodb_resource(endpoint_url, max_pool_connections)
+        table = resource.Table(table_name)
+        if kms_key_id:
+            table = encrypt_table(table, kms_key_id, encrypted_attribute)
+        return table
+
+    return cached(
+        ("dynamodb_table", table_name, endpoint_url, kms_key_id, encrypted_attribute),
+        factory,
+    )
+
+
+def get_bedrock_runtime_client(
+    region_name: Optional[str] = None,
+    endpoint_url: Optional[str] = None,
+    max_pool_connections: Optional[int] = None,
+    connect_timeout: float = 5,
+    read_timeout: float = 60,
+    max_attempts: int = 5,
+):
+    """
+    Shared bedrock-runtime client.
+
+    Connections are kept alive and reused by all threads. Throttled calls are
+    retried in botocore's adaptive mode, which backs off with jitter and also
+    slows down the calls of the whole client while Bedrock throttles.
+
+    :param region_name: defaults to the region of the default session
+    :param endpoint_url: optional endpoint
+    :param max_pool_connections: HTTP connection pool size, should be at least the
+        number of concurrent model calls. botocore defaults to 10.
+    :param connect_timeout: seconds to establish a connection
+    :param read_timeout: seconds to wait for the first byte of the response and
+        between the chunks of a stream
+    :param max_attempts: attempts of a call, including the first one
+    """
+
+    def factory():
+        import boto3
+        from botocore.config import Config
+
+        config = Config(
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            retries={"mode": "adaptive", "max_attempts": max_attempts},
+            tcp_keepalive=True,
+            **(
+                {"max_pool_connections": max_pool_connections}
+                if max_pool_connections
+                else {}
+            ),
+        )
+        return boto3.session.Session().client(
+            "bedrock-runtime",
+            region_name=region_name,
+            endpoint_url=endpoint_url,
+            config=config,
+        )
+
+    return cached(
+        (
+            "bedrock-runtime",
+            region_name,
+            endpoint_url,
+            max_pool_connections,
+            connect_timeout,
+            read_timeout,
+            max_attempts,
+        ),
+        factory,
+    )
@@ -0,0 +1,119 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Compact encoding of the messages stored in DynamoDB.
+
+`messages_to_dict` gives each message an envelope of LangChain fields, mostly
+empty, that DynamoDB stores as nested maps with every attribute name repeated.
+The compact encoding keeps the type, the content, the token count and only the
+other fields that are set, as a JSON array in one binary value, compressed when
+that makes it smaller. Each message stays one element of "History" (or one
+"Message" item), so appends, window slices and summary counts are unchanged,
+and stored values of both encodings can be read side by side.
+"""
+
+import json
+import zlib
+from typing import Any, Dict, List, Sequence
+
+from .tokens import TOKEN_COUNT_KEY
+
+# Messages are stored as the maps of `messages_to_dict` (the original layout).
+CODEC_JSON = "json"
+# Compact encoding, compressed with zlib.
+CODEC_ZLIB = "zlib"
+# Compact encoding, compressed with zstd, needs the `zstandard` package.
+CODEC_ZSTD = "zstd"
+CODECS = (CODEC_JSON, CODEC_ZLIB, CODEC_ZSTD)
+
+# First byte of an encoded message, telling how the rest is compressed.
+_UNCOMPRESSED = b"\x01"
+_ZLIB = b"\x02"
+_ZSTD = b"\x03"
+
+# Shorter values rarely get smaller by compressing them.
+MIN_COMPRESSED_BYTES = 128
+
+_zstd_compressor = None
+_zstd_decompressor = None
+
+
+def _zstd():
+    global _zstd_compressor, _zstd_decompressor
+    if _zstd_compressor is None:
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError(
+                "Unable to import zstandard, please install with "
+                "`pip install zstandard`."
+            ) from e
+        _zstd_compressor = zstandard.ZstdCompressor()
+        _zstd_decompressor = zstandard.ZstdDecompressor()
+    return _zstd_compressor, _zstd_decompressor
+
+
+def encode_message(item: Dict[str, Any], codec: str = CODEC_ZLIB) -> bytes:
+    """Encode a serialized message of `messages_to_items`."""
+    data = item["data"]
+    extra = {
+        name: value
+        for name, value in data.items()
+        if value and name not in ("content", "type", "additional_kwargs")
+    }
+    if data.get("additional_kwargs"):
+        extra["additional_kwargs"] = data["additional_kwargs"]
+    record = [item["type"], data.get("content", ""), item.get(TOKEN_COUNT_KEY)]
+    if extra:
+        record.append(extra)
+    raw = json.dumps(
+        record, ensure_ascii=False, separators=(",", ":"), default=int
+    ).encode("utf-8")
+
+    if len(raw) >= MIN_COMPRESSED_BYTES:
+        if codec == CODEC_ZSTD:
+            compressed = _ZSTD + _zstd()[0].compress(raw)
+        else:
+            compressed = _ZLIB + zlib.compress(raw)
+        if len(compressed) <= len(raw):
+            return compressed
+    return _UNCOMPRESSED + raw
+
+
+def decode_message(value) -> Dict[str, Any]:
+    """Serialized message of a stored value, in either encoding."""
+    if isinstance(value, dict):
+        return value
+    # boto3 reads binary attributes as Binary, with the bytes in `value`.
+    data = bytes(getattr(value, "value", value))
+    kind, payload = data[:1], data[1:]
+    if kind == _ZLIB:
+        payload = zlib.decompress(payload)
+    elif kind == _ZSTD:
+        payload = _zstd()[1].decompress(payload)
+    elif kind != _UNCOMPRESSED:
+        raise ValueError(f"unknown message encoding {kind!r}")
+
+    record = json.loads(payload)
+    message_type, content, token_count = record[:3]
+    data = {"content": content, "type": message_type, "additional_kwargs": {}}
+    if len(record) > 3:
+        data.update(record[3])
+    item = {"type": message_type, "data": data}
+    if token_count is not None:
+        item[TOKEN_COUNT_KEY] = token_count
+    return item
+
+
+def encode_messages(
+    items: Sequence[Dict[str, Any]], codec: str = CODEC_JSON
+) -> List[Any]:
+    """Values to store for serialized messages, as they are with "json"."""
+    if codec == CODEC_JSON:
+        return list(items)
+    return [encode_message(item, codec) for item in items]
+
+
+def decode_messages(values: Sequence[Any]) -> List[Dict[str, Any]]:
+    return [decode_message(value) for value in values]
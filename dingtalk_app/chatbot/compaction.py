@@ -0,0 +1,280 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Compact oversized conversations and give old items an expiry.
+
+Conversations in the single-item layout grow with every turn, and so do the
+capacity units of every read and write of the item. This job rewrites the
+items larger than `--max-kb` to their last `--keep` messages. The older
+messages are moved to a zlib-compressed `SessionId#timestamp` backup and, with
+`--model-id`, folded into the rolling summary first. Items without the TTL
+attribute, written before it existed, get one: backups expire after
+`--archive-ttl-days`, conversations after the `HISTORY_IDLE_TTL_DAYS` of the
+service when it is set.
+
+Run it from the dingtalk_app directory, e.g. from a scheduled task:
+
+    python -m chatbot.compaction --table <conversation table> --max-kb 64 --keep 20
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+import zlib
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage
+
+from .codec import decode_messages
+from .dynamodb import EXPIRES_AT_ATTRIBUTE, expires_at, messages_from_items
+
+logger = logging.getLogger(__name__)
+
+# Zlib-compressed JSON of the messages moved out of a compacted conversation.
+COMPRESSED_HISTORY_ATTRIBUTE = "CompressedHistory"
+
+
+def item_bytes(item: Dict[str, Any]) -> int:
+    """Approximate stored size of an item, close to what DynamoDB bills."""
+    return len(json.dumps(item, default=str, ensure_ascii=False).encode("utf-8"))
+
+
+def compress_history(history: List[Dict[str, Any]]) -> bytes:
+    data = json.dumps(decode_messages(history), default=int, ensure_ascii=False)
+    return zlib.compress(data.encode("utf-8"))
+
+
+def decompress_history(data) -> List[Dict[str, Any]]:
+    """Messages of a `CompressedHistory` attribute, bytes or a boto3 Binary."""
+    return json.loads(zlib.decompress(bytes(getattr(data, "value", data))))
+
+
+def compact_histories(
+    table_name: str,
+    max_bytes: int = 64 * 1024,
+    keep_messages: int = 20,
+    summarize: Optional[Callable[[str, List[BaseMessage]], str]] = None,
+    archive_ttl_days: Optional[float] = 90,
+    idle_ttl_days: Optional[float] = None,
+    primary_key_name: str = "SessionId",
+    endpoint_url: Optional[str] = None,
+    dry_run: bool = False,
+    table=None,
+) -> Dict[str, int]:
+    """
+    Compact the oversized conversations of a single-item layout table.
+
+    The compacted item is written with a condition on the length of its
+    history, so a conversation that got a new turn or was reset since the scan
+    is left for the next run.
+
+    :param table_name: table using the single-item "History" layout
+    :param max_bytes: size above which a conversation is compacted
+    :param keep_messages: number of recent messages kept in the item
+    :param summarize: `summarize(summary, messages)` returning the new summary,
+        e.g. `Chatbot.summarize`, to fold the moved messages into it
+    :param archive_ttl_days: lifetime of backups, None to keep them
+    :param idle_ttl_days: lifetime of conversations without the TTL attribute,
+        None to keep them. Only set it to the `HISTORY_IDLE_TTL_DAYS` of the
+        service: a service without it never pushes the expiry back, so active
+        conversations would be deleted.
+    :param primary_key_name: partition key of the table
+    :param endpoint_url: optional DynamoDB endpoint, e.g. DynamoDB Local
+    :param dry_run: only count what would be written
+    :param table: boto3 Table to use instead of `table_name`
+
+    :return: counts of scanned, compacted, expiring and skipped items, and the
+        bytes saved
+    """
+    from botocore.exceptions import ClientError
+
+    if table is None:
+        import boto3
+
+        table = boto3.resource("dynamodb", endpoint_url=endpoint_url).Table(table_name)
+
+    counts = Counter()
+    scan_kwargs: Dict[str, Any] = {}
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get("Items", []):
+            counts["scanned"] += 1
+            session_id = item[primary_key_name]
+            key = {primary_key_name: session_id}
+            history = item.get("History")
+            if "#" in session_id:
+                # A backup written by `clear` or by an earlier run.
+                expires = expires_at(archive_ttl_days)
+            elif isinstance(history, list) and item_bytes(item) > max_bytes:
+                if len(history) <= keep_messages:
+                    counts["too_few_messages"] += 1
+                    continue
+                if dry_run:
+                    counts["compacted"] += 1
+                    continue
+                try:
+                    saved = _compact(
+                        table,
+                        item,
+                        primary_key_name,
+                        keep_messages,
+                        summarize,
+                        archive_ttl_days,
+                    )
+                except ClientError as err:
+                    if err.response["Error"]["Code"] != (
+                        "ConditionalCheckFailedException"
+                    ):
+                        raise
+                    logger.info("Skip %s, changed during compaction", session_id)
+                    counts["changed"] += 1
+                    continue
+                counts["compacted"] += 1
+                counts["bytes_saved"] += saved
+                continue
+            else:
+                expires = expires_at(idle_ttl_days)
+
+            if expires is None or EXPIRES_AT_ATTRIBUTE in item:
+                continue
+            counts["expiring"] += 1
+            if dry_run:
+                continue
+            try:
+                table.update_item(
+                    Key=key,
+                    UpdateExpression=f"SET {EXPIRES_AT_ATTRIBUTE} = :expires",
+                    # Written by the service since the scan.
+                    ConditionExpression=f"attribute_not_exists({EXPIRES_AT_ATTRIBUTE})",
+                    ExpressionAttributeValues={":expires": expires},
+                )
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    return dict(counts)
+
+
+def _compact(
+    table, item, primary_key_name, keep_messages, summarize, archive_ttl_days
+) -> int:
+    """Move the messages before the last `keep_messages` to a backup, returning
+    the bytes saved.
+
+    The backup is written first, so the messages are never only in memory, and
+    deleted again when the conversation changed since it was read.
+    """
+    from botocore.exceptions import ClientError
+
+    session_id = item[primary_key_name]
+    history = item["History"]
+    moved, kept = history[:-keep_messages], history[-keep_messages:]
+    summarized_count = int(item.get("SummarizedCount", 0))
+    summary = item.get("Summary", "")
+    if summarize is not None and summarized_count < len(moved):
+        summary = summarize(
+            summary, messages_from_items(decode_messages(moved[summarized_count:]))
+        )
+        summarized_count = len(moved)
+
+    backup = {
+        primary_key_name: f"{session_id}#{int(time.time() * 1000)}",
+        COMPRESSED_HISTORY_ATTRIBUTE: compress_history(moved),
+    }
+    expires = expires_at(archive_ttl_days)
+    if expires is not None:
+        backup[EXPIRES_AT_ATTRIBUTE] = expires
+    table.put_item(Item=backup)
+
+    update_expression = "SET History = :kept, SummarizedCount = :summarized"
+    values = {
+        ":kept": kept,
+        ":summarized": max(summarized_count - len(moved), 0),
+        ":count": len(history),
+    }
+    if summary:
+        update_expression += ", Summary = :summary"
+        values[":summary"] = summary
+    try:
+        table.update_item(
+            Key={primary_key_name: session_id},
+            UpdateExpression=update_expression,
+            # Not appended to or reset since it was read.
+            ConditionExpression="size(History) = :count",
+            ExpressionAttributeValues=values,
+        )
+    except ClientError as err:
+        if err.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            # The messages are still in the conversation, the next run moves
+            # them to a new backup.
+            table.delete_item(Key={primary_key_name: backup[primary_key_name]})
+        raise
+    logger.info("Compacted %s messages of %s", len(moved), session_id)
+    return item_bytes(item) - item_bytes({**item, "History": kept})
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--table", required=True, help="single-item table name")
+    parser.add_argument(
+        "--max-kb", type=float, default=64, help="size of the items to compact"
+    )
+    parser.add_argument(
+        "--keep", type=int, default=20, help="recent messages kept in the item"
+    )
+    parser.add_argument(
+        "--model-id",
+        default=None,
+        help="Bedrock model folding the moved messages into the summary",
+    )
+    parser.add_argument("--archive-ttl-days", type=float, default=90)
+    parser.add_argument(
+        "--idle-ttl-days",
+        type=float,
+        default=None,
+        help="defaults to and must equal HISTORY_IDLE_TTL_DAYS of the service",
+    )
+    parser.add_argument("--endpoint-url", default=None)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+    # The service pushes the expiry back on every write only with this set.
+    service_idle_ttl_days = float(os.environ.get("HISTORY_IDLE_TTL_DAYS", "0"))
+    if args.idle_ttl_days is None:
+        args.idle_ttl_days = service_idle_ttl_days
+    elif args.idle_ttl_days != service_idle_ttl_days:
+        parser.error(
+            f"--idle-ttl-days {args.idle_ttl_days:g} differs from the "
+            f"HISTORY_IDLE_TTL_DAYS of the service ({service_idle_ttl_days:g}), "
+            "which would not keep the expiry of active conversations up to date"
+        )
+
+    summarize = None
+    if args.model_id:
+        from .bedrock_chatbot import Chatbot
+
+        summarize = Chatbot(model_id=args.model_id).summarize
+
+    counts = compact_histories(
+        args.table,
+        max_bytes=int(args.max_kb * 1024),
+        keep_messages=args.keep,
+        summarize=summarize,
+        archive_ttl_days=args.archive_ttl_days,
+        idle_ttl_days=args.idle_ttl_days,
+        endpoint_url=args.endpoint_url,
+        dry_run=args.dry_run,
+    )
+    logger.info("%s%s", "dry run: " if args.dry_run else "", counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+One turn at a time per conversation.
+
+Two messages of the same conversation handled in parallel read the same history,
+both invoke the model and both append to the history. `ConversationRegistry`
+lets only one handler own a conversation; what happens to messages arriving in
+the meantime is set by the busy policy:
+
+- "reject": they are refused, the handler answers with a busy message.
+- "queue": they wait and are handled one by one by the owner after its turn.
+- "coalesce": they wait and are handled by the owner as a single turn.
+"""
+
+import threading
+from typing import Any, Dict, List
+
+BUSY_POLICY_REJECT = "reject"
+BUSY_POLICY_QUEUE = "queue"
+BUSY_POLICY_COALESCE = "coalesce"
+BUSY_POLICIES = (BUSY_POLICY_REJECT, BUSY_POLICY_QUEUE, BUSY_POLICY_COALESCE)
+
+STARTED = "started"
+QUEUED = "queued"
+REJECTED = "rejected"
+
+
+class ConversationRegistry:
+    """
+    :param policy: one of `BUSY_POLICIES`
+    :param max_pending: messages that may wait per conversation, further ones
+        are rejected
+    """
+
+    def __init__(self, policy: str = BUSY_POLICY_QUEUE, max_pending: int = 10):
+        if policy not in BUSY_POLICIES:
+            raise ValueError(f"busy policy {policy} is not supported")
+        self.policy = policy
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        # Conversations with a turn in progress and their waiting messages.
+        self._pending: Dict[str, List[Any]] = {}
+        self.rejected = 0
+        self.queued = 0
+
+    def start(self, conversation_id: str, message: Any) -> str:
+        """Register `message` of `conversation_id`.
+
+        Returns STARTED if the caller now owns the conversation and must handle
+        the message, then call `next` until it returns no messages. Returns
+        QUEUED if the owner will handle it, REJECTED if nobody will.
+        """
+        with self._lock:
+            pending = self._pending.get(conversation_id)
+            if pending is None:
+                self._pending[conversation_id] = []
+                return STARTED
+            if self.policy == BUSY_POLICY_REJECT or len(pending) >= self.max_pending:
+                self.rejected += 1
+                return REJECTED
+            pending.append(message)
+            self.queued += 1
+            return QUEUED
+
+    def next(self, conversation_id: str) -> List[Any]:
+        """Messages for the owner's next turn, [] once the conversation is released.
+
+        A turn is a single message, or all waiting messages with "coalesce".
+        """
+        with self._lock:
+            pending = self._pending[conversation_id]
+            if not pending:
+                del self._pending[conversation_id]
+                return []
+            if self.policy == BUSY_POLICY_COALESCE:
+                messages = pending[:]
+                pending.clear()
+            else:
+                messages = [pending.pop(0)]
+            return messages
+
+    def release(self, conversation_id: str) -> List[Any]:
+        """Give up a conversation after a failure, return its dropped messages."""
+        with self._lock:
+            return self._pending.pop(conversation_id, [])
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "busy_conversations": len(self._pending),
+                "pending_messages": sum(map(len, self._pending.values())),
+                "busy_rejected": self.rejected,
+                "busy_queued": self.queued,
+            }
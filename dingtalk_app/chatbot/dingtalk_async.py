@@ -0,0 +1,131 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+DingTalk replies on asyncio.
+
+Same requests and return values as `reply_text`, `reply_card` and `update_card`
+of `dingtalk_stream.ChatbotHandler`, sent with aiohttp instead of requests.
+"""
+
+import asyncio
+import json
+import logging
+import platform
+from typing import Optional, Union
+
+from dingtalk_stream import ChatbotHandler, ChatbotMessage
+from dingtalk_stream.stream import DINGTALK_OPENAPI_ENDPOINT
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = (
+    "DingTalkStream/1.0 SDK/0.1.0 Python/%s "
+    "(+https://github.com/open-dingtalk/dingtalk-stream-sdk-python)"
+) % platform.python_version()
+
+
+class AsyncDingTalkReplier:
+    """
+    :param dingtalk_client: the `DingTalkStreamClient`, provides the app
+        credential and access token
+    :param session: aiohttp session, owned by the caller
+    """
+
+    def __init__(self, dingtalk_client, session):
+        self.dingtalk_client = dingtalk_client
+        self.session = session
+
+    async def access_token(self) -> Optional[str]:
+        # Cached by the client, it only blocks on the request renewing it.
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.dingtalk_client.get_access_token
+        )
+
+    async def reply_text(self, text: str, incoming_message: ChatbotMessage):
+        values = {
+            "msgtype": "text",
+            "text": {"content": text},
+            "at": {"atUserIds": [incoming_message.sender_staff_id]},
+        }
+        try:
+            async with self.session.post(
+                incoming_message.session_webhook, json=values
+            ) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+        except Exception as e:
+            logger.error("reply text failed, error=%s", e)
+            return None
+
+    async def reply_card(
+        self, card_data: dict, incoming_message: ChatbotMessage
+    ) -> Optional[str]:
+        """Send an interactive card, return its card biz id or "" on failure."""
+        access_token = await self.access_token()
+        if not access_token:
+            logger.error("reply card failed, cannot get dingtalk access token")
+            return None
+
+        card_biz_id = ChatbotHandler._gen_card_id(incoming_message)
+        body = {
+            "cardTemplateId": "StandardCard",
+            "robotCode": self.dingtalk_client.credential.client_id,
+            "cardData": json.dumps(card_data),
+            "sendOptions": {"atAll": False},
+            "cardBizId": card_biz_id,
+        }
+        if incoming_message.conversation_type == "2":
+            body["openConversationId"] = incoming_message.conversation_id
+        elif incoming_message.conversation_type == "1":
+            body["singleChatReceiver"] = json.dumps(
+                {"userId": incoming_message.sender_staff_id}
+            )
+
+        try:
+            async with self.session.post(
+                DINGTALK_OPENAPI_ENDPOINT + "/v1.0/im/v1.0/robot/interactiveCards/send",
+                headers=self._headers(access_token),
+                json=body,
+            ) as response:
+                response.raise_for_status()
+                return card_biz_id
+        except Exception as e:
+            logger.error("reply card failed, error=%s", e)
+            return ""
+
+    async def update_card(
+        self, card_biz_id: str, card_data: dict
+    ) -> Union[dict, int, None]:
+        """Update a card, return the response body or the HTTP status on failure."""
+        access_token = await self.access_token()
+        if not access_token:
+            logger.error("update card failed, cannot get dingtalk access token")
+            return None
+
+        values = {"cardBizId": card_biz_id, "cardData": json.dumps(card_data)}
+        try:
+            async with self.session.put(
+                DINGTALK_OPENAPI_ENDPOINT + "/v1.0/im/robots/interactiveCards",
+                headers=self._headers(access_token),
+                json=values,
+            ) as response:
+                if response.status >= 400:
+                    logger.error(
+                        "update card failed, status=%s, response=%s",
+                        response.status,
+                        await response.text(),
+                    )
+                    return response.status
+                return await response.json(content_type=None)
+        except Exception as e:
+            logger.error("update card failed, error=%s", e)
+            return None
+
+    @staticmethod
+    def _headers(access_token: str) -> dict:
+        return {
+            "Accept": "*/*",
+            "x-acs-dingtalk-access-token": access_token,
+            "User-Agent": USER_AGENT,
+        }
@@ -1,24 +1,90 @@
 #  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
 #  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
 
+import functools
 import logging
-from typing import TYPE_CHECKING, Dict, List, Optional
+import threading
+from concurrent.futures import Executor
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Sequence, Tuple
 
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.messages import (
     BaseMessage,
     message_to_dict,
     messages_from_dict,
-    messages_to_dict,
 )
 from boto3.session import Session
 import time
 
+from .clients import encrypt_table, get_dynamodb_table
+from .codec import CODEC_JSON, CODECS, decode_messages, encode_messages
+from .history_cache import HistoryCache
+from .prefetch import HistoryBatcher
+from .tokens import TOKEN_COUNT_KEY, message_tokens
+
 # if TYPE_CHECKING:
 #     from boto3.session import Session
 
 logger = logging.getLogger(__name__)
 
+# The whole conversation lives in the "History" list of a single item.
+STORAGE_MODE_ITEM = "item"
+# Each message is its own item, keyed by session id and a monotonic sort key.
+STORAGE_MODE_MESSAGE = "message"
+STORAGE_MODES = (STORAGE_MODE_ITEM, STORAGE_MODE_MESSAGE)
+
+# Only the last `limited_item_count` messages are kept in the prompt.
+MEMORY_MODE_WINDOW = "window"
+# Older messages are folded into a rolling summary sent instead of them.
+MEMORY_MODE_SUMMARY = "summary"
+MEMORY_MODES = (MEMORY_MODE_WINDOW, MEMORY_MODE_SUMMARY)
+
+# Sort key of the per-session head item in "message" mode. It sorts after every
+# message, so the reverse query for the recent window returns it first.
+HEAD_SORT_KEY = 2**63 - 1
+
+# Epoch seconds after which DynamoDB deletes an idle or archived conversation,
+# the TTL attribute of the tables.
+EXPIRES_AT_ATTRIBUTE = "ExpiresAt"
+
+_sort_key_lock = threading.Lock()
+_last_sort_key = 0
+
+
+def messages_to_items(messages: Sequence[BaseMessage]) -> List[Dict[str, Any]]:
+    """Serialize messages for DynamoDB, with their token count next to each."""
+    items = []
+    for message in messages:
+        item = message_to_dict(message)
+        item["data"]["additional_kwargs"].pop(TOKEN_COUNT_KEY, None)
+        item[TOKEN_COUNT_KEY] = message_tokens(message)
+        items.append(item)
+    return items
+
+
+def messages_from_items(items: Sequence[Dict[str, Any]]) -> List[BaseMessage]:
+    """Deserialize messages, keeping the stored token count in additional_kwargs."""
+    messages = messages_from_dict(items)
+    for message, item in zip(messages, items):
+        if TOKEN_COUNT_KEY in item:
+            message.additional_kwargs[TOKEN_COUNT_KEY] = int(item[TOKEN_COUNT_KEY])
+    return messages
+
+
+def expires_at(days: Optional[float]) -> Optional[int]:
+    """TTL value `days` from now, None for no expiry."""
+    if not days:
+        return None
+    return int(time.time() + days * 24 * 3600)
+
+
+def next_sort_key() -> int:
+    """Return a process-wide strictly increasing sort key (epoch microseconds)."""
+    global _last_sort_key
+    with _sort_key_lock:
+        _last_sort_key = max(time.time_ns() // 1000, _last_sort_key + 1)
+        return _last_sort_key
+
 
 class DynamoDBChatMessageHistory(BaseChatMessageHistory):
     """Chat message history that stores history in AWS DynamoDB.
@@ -41,6 +107,46 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
             This may also contain global and local secondary index keys.
         kms_key_id: an optional AWS KMS Key ID, AWS KMS Key ARN, or AWS KMS Alias for
             client-side encryption
+        storage_mode: "item" keeps the whole conversation in the "History" list of
+            one item (the original layout). "message" stores one item per message
+            under `primary_key_name` with a numeric `sort_key_name`, so writes do not
+            grow with the conversation length. The "message" layout needs a table
+            with a sort key, see `chatbot.migration` for moving existing data.
+        sort_key_name: name of the numeric sort key in "message" mode, defaulting to
+            "CreatedAt".
+        max_pool_connections: size of the HTTP connection pool of the shared
+            DynamoDB resource. Without a `boto3_session` the resource and table
+            handle are created once per process and reused by every instance,
+            see `chatbot.clients`.
+        cache: an optional `HistoryCache` shared by the instances of a process.
+            `messages` is served from it when possible, and writes and `clear`
+            keep it up to date.
+        memory_mode: "window" (default) only keeps the last `limited_item_count`
+            messages. "summary" also keeps a rolling summary of the messages that
+            fell out of that window, in the "Summary" attribute of the item (or of
+            the head item in "message" mode). `summary` is loaded together with
+            `messages`, and `summarize_pending` folds new messages into it.
+        archive_executor: runs the copy of a cleared conversation to its
+            `SessionId#timestamp` backup, so `clear` only waits for the reset
+            itself. Without one the copy is made by `clear` after the reset.
+        archive_ttl_days: lifetime of the backups, after which the TTL of the
+            table deletes them. 0 or None keeps them.
+        idle_ttl_days: lifetime of a conversation after its last message, after
+            which the TTL of the table deletes it. In the "item" layout every
+            write pushes it back. In the "message" layout every write pushes
+            back the expiry of the head item, and of the messages in the window
+            once half of the lifetime passed since they were last pushed back,
+            so an active conversation keeps its window, reset point and summary
+            for a few writes per half lifetime. Older messages expire that long
+            after they were written. 0 or None keeps conversations.
+        history_codec: how new messages are stored. "json" (default) stores the
+            maps of `messages_to_dict`, "zlib" and "zstd" a compact binary
+            encoding compressed with either, see `chatbot.codec`. Messages of
+            every encoding are read, so it can be changed at any time.
+        batcher: an optional `HistoryBatcher` shared by the instances of a
+            process. In the "item" layout without client-side encryption,
+            `messages` reads the item through it, so the reads of concurrent
+            turns are sent as one `BatchGetItem`.
     """
 
     def __init__(
@@ -53,55 +159,83 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
         key: Optional[Dict[str, str]] = None,
         boto3_session: Optional[Session] = None,
         kms_key_id: Optional[str] = None,
+        storage_mode: str = STORAGE_MODE_ITEM,
+        sort_key_name: str = "CreatedAt",
+        max_pool_connections: Optional[int] = None,
+        cache: Optional[HistoryCache] = None,
+        memory_mode: str = MEMORY_MODE_WINDOW,
+        archive_executor: Optional[Executor] = None,
+        archive_ttl_days: Optional[float] = None,
+        idle_ttl_days: Optional[float] = None,
+        history_codec: str = CODEC_JSON,
+        batcher: Optional[HistoryBatcher] = None,
     ):
-        if boto3_session:
-            client = boto3_session.resource("dynamodb", endpoint_url=endpoint_url)
-        else:
-            try:
-                import boto3
-            except ImportError as e:
-                raise ImportError(
-                    "Unable to import boto3, please install with `pip install boto3`."
-                ) from e
-            if endpoint_url:
-                client = boto3.resource("dynamodb", endpoint_url=endpoint_url)
-            else:
-                client = boto3.resource("dynamodb")
-        self.table = client.Table(table_name)
+        if storage_mode not in STORAGE_MODES:
+            raise ValueError(f"storage_mode {storage_mode} is not supported")
+        if history_codec not in CODECS:
+            raise ValueError(f"history_codec {history_codec} is not supported")
+        if memory_mode not in MEMORY_MODES:
+            raise ValueError(f"memory_mode {memory_mode} is not supported")
+
         self.session_id = session_id
         self.key: Dict = key or {primary_key_name: session_id}
         self.primary_key_name = primary_key_name
         self.limited_item_count = limited_item_count
+        self.storage_mode = storage_mode
+        self.sort_key_name = sort_key_name
+        self.history_attribute = (
+            "Message" if storage_mode == STORAGE_MODE_MESSAGE else "History"
+        )
+        # EncryptedTable does not implement update_item.
+        self.encrypted = bool(kms_key_id)
+        self.cache = cache
+        self.memory_mode = memory_mode
+        # Rolling summary, loaded by `messages` in "summary" memory mode.
+        self.summary = ""
+        self.archive_executor = archive_executor
+        self.archive_ttl_days = archive_ttl_days
+        self.idle_ttl_days = idle_ttl_days
+        self.history_codec = history_codec
+        # EncryptedTable decrypts the items of get_item only.
+        self.batcher = None if self.encrypted else batcher
 
-        if kms_key_id:
-            try:
-                from dynamodb_encryption_sdk.encrypted.table import EncryptedTable
-                from dynamodb_encryption_sdk.identifiers import CryptoAction
-                from dynamodb_encryption_sdk.material_providers.aws_kms import (
-                    AwsKmsCryptographicMaterialsProvider,
+        if boto3_session:
+            client = boto3_session.resource("dynamodb", endpoint_url=endpoint_url)
+            self.table = client.Table(table_name)
+            if kms_key_id:
+                self.table = encrypt_table(
+                    self.table, kms_key_id, self.history_attribute
                 )
-                from dynamodb_encryption_sdk.structures import AttributeActions
-            except ImportError as e:
-                raise ImportError(
-                    "Unable to import dynamodb_encryption_sdk, please install with "
-                    "`pip install dynamodb-encryption-sdk`."
-                ) from e
-
-            actions = AttributeActions(
-                default_action=CryptoAction.DO_NOTHING,
-                attribute_actions={"History": CryptoAction.ENCRYPT_AND_SIGN},
-            )
-            aws_kms_cmp = AwsKmsCryptographicMaterialsProvider(key_id=kms_key_id)
-            self.table = EncryptedTable(
-                table=self.table,
-                materials_provider=aws_kms_cmp,
-                attribute_actions=actions,
-                auto_refresh_table_indexes=False,
+        else:
+            self.table = get_dynamodb_table(
+                table_name,
+                endpoint_url=endpoint_url,
+                kms_key_id=kms_key_id,
+                encrypted_attribute=self.history_attribute,
+                max_pool_connections=max_pool_connections,
             )
 
     @property
     def messages(self) -> List[BaseMessage]:  # type: ignore
         """Retrieve the messages from DynamoDB"""
+        if self.cache is not None:
+            cached = self.cache.get(self.session_id, self.limited_item_count)
+            if cached is not None:
+                self.summary = self.cache.get_summary(self.session_id) or ""
+                return messages_from_items(cached)
+
+        if self.storage_mode == STORAGE_MODE_MESSAGE:
+            items = self._query_messages(self.limited_item_count)
+            if self.cache is not None:
+                self.cache.put(
+                    self.session_id,
+                    items,
+                    complete=self.limited_item_count is None
+                    or len(items) < self.limited_item_count,
+                    summary=self.summary,
+                )
+            return messages_from_items(items)
+
         try:
             from botocore.exceptions import ClientError
         except ImportError as e:
@@ -111,7 +245,11 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
 
         response = None
         try:
-            response = self.table.get_item(Key=self.key)
+            response = (
+                self.batcher.get_item(self.table, self.key)
+                if self.batcher is not None
+                else self.table.get_item(Key=self.key)
+            )
         except ClientError as error:
             if error.response["Error"]["Code"] == "ResourceNotFoundException":
                 logger.warning("No record found with session id: %s", self.session_id)
@@ -119,16 +257,32 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
                 logger.error(error)
 
         if response and "Item" in response:
-            items = response["Item"]["History"][-1 * self.limited_item_count :]
+            history = response["Item"].get("History", [])
+            if self.cache is not None:
+                # The cache keeps the whole conversation.
+                history = decode_messages(history)
+                items = history[-1 * self.limited_item_count :]
+            else:
+                items = decode_messages(history[-1 * self.limited_item_count :])
+            if self.memory_mode == MEMORY_MODE_SUMMARY:
+                self.summary = response["Item"].get("Summary", "")
         else:
-            items = []
+            history = items = []
+
+        if response is not None and self.cache is not None:
+            self.cache.put(
+                self.session_id, history, complete=True, summary=self.summary
+            )
 
-        messages = messages_from_dict(items)
+        messages = messages_from_items(items)
         return messages
 
     @property
     def all_messages(self) -> List[BaseMessage]:  # type: ignore
         """Retrieve the messages from DynamoDB"""
+        if self.storage_mode == STORAGE_MODE_MESSAGE:
+            return messages_from_items(self._query_messages(None))
+
         try:
             from botocore.exceptions import ClientError
         except ImportError as e:
@@ -146,15 +300,95 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
                 logger.error(error)
 
         if response and "Item" in response:
-            items = response["Item"]["History"]
+            items = decode_messages(response["Item"]["History"])
         else:
             items = []
 
-        messages = messages_from_dict(items)
+        messages = messages_from_items(items)
         return messages
 
+    def _query_message_items(
+        self, limit: Optional[int], newest_first: bool
+    ) -> List[Dict[str, Any]]:
+        """Query the per-message items of this session in sort key order.
+
+        With a `limit` only the first page is read, which is what the reverse
+        query for the recent window needs. Without one every page is read.
+        """
+        try:
+            from boto3.dynamodb.conditions import Key
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise ImportError(
+                "Unable to import boto3, please install with `pip install boto3`."
+            ) from e
+
+        query_kwargs: Dict[str, Any] = {
+            "KeyConditionExpression": Key(self.primary_key_name).eq(self.session_id),
+            "ScanIndexForward": not newest_first,
+        }
+        if limit is not None:
+            query_kwargs["Limit"] = limit
+
+        items: List[Dict[str, Any]] = []
+        try:
+            while True:
+                response = self.table.query(**query_kwargs)
+                items.extend(response.get("Items", []))
+                if limit is not None or "LastEvaluatedKey" not in response:
+                    break
+                query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        except ClientError as error:
+            if error.response["Error"]["Code"] == "ResourceNotFoundException":
+                logger.warning("No record found with session id: %s", self.session_id)
+            else:
+                logger.error(error)
+
+        return items
+
+    def _query_messages(self, limit: Optional[int]) -> List[Dict[str, Any]]:
+        """Return the serialized messages of this session, oldest first.
+
+        With a `limit` only the newest `limit` messages are read, via a reverse
+        query, so the cost does not depend on the conversation length. Messages
+        written before the last reset, which are kept until they are archived,
+        are left out.
+        """
+        if limit is not None:
+            # One more for the head item, which sorts first when it exists.
+            items = self._query_message_items(limit + 1, newest_first=True)
+            head = items.pop(0) if items and self._is_head(items[0]) else {}
+            items = self._after_reset(items, head)[:limit]
+            items.reverse()
+        else:
+            items = self._query_message_items(None, newest_first=False)
+            head = items.pop() if items and self._is_head(items[-1]) else {}
+            items = self._after_reset(items, head)
+        if self.memory_mode == MEMORY_MODE_SUMMARY:
+            self.summary = head.get("Summary", "")
+        return decode_messages([item["Message"] for item in items if "Message" in item])
+
+    def _is_head(self, item: Dict[str, Any]) -> bool:
+        return item[self.sort_key_name] == HEAD_SORT_KEY
+
+    def _after_reset(
+        self, items: List[Dict[str, Any]], head: Dict[str, Any]
+    ) -> List[Dict[str, Any]]:
+        reset_at = int(head.get("ResetAt", 0))
+        return [item for item in items if item[self.sort_key_name] > reset_at]
+
     def add_message(self, message: BaseMessage) -> None:
         """Append the message to the record in DynamoDB"""
+        self.add_messages([message])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Append the messages to the record in DynamoDB in a single request.
+
+        In the single-item layout this is an atomic `list_append` update, so the
+        current history is not read first and concurrent turns of the same
+        conversation cannot overwrite each other's messages. Client-side
+        encryption does not support updates and falls back to read-modify-write.
+        """
         try:
             from botocore.exceptions import ClientError
         except ImportError as e:
@@ -162,17 +396,238 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
                 "Unable to import botocore, please install with `pip install botocore`."
             ) from e
 
-        messages = messages_to_dict(self.all_messages)
-        _message = message_to_dict(message)
-        messages.append(_message)
+        if not messages:
+            return
+        _messages = messages_to_items(messages)
+        stored = encode_messages(_messages, self.history_codec)
+        expires = expires_at(self.idle_ttl_days)
 
         try:
-            self.table.put_item(Item={**self.key, "History": messages})
+            if self.storage_mode == STORAGE_MODE_MESSAGE:
+                self._put_message_items(stored, expires)
+                if expires is not None:
+                    self._refresh_expiry(expires)
+            elif self.encrypted:
+                # The summary and its progress are carried over.
+                item = self.table.get_item(Key=self.key).get("Item", {})
+                item = {**item, **self.key, "History": item.get("History", []) + stored}
+                if expires is not None:
+                    item[EXPIRES_AT_ATTRIBUTE] = expires
+                self.table.put_item(Item=item)
+            else:
+                update_expression, values = self._with_expiry(
+                    "SET History = list_append(if_not_exists(History, :empty), :messages)",
+                    {":empty": [], ":messages": stored},
+                )
+                self.table.update_item(
+                    Key=self.key,
+                    UpdateExpression=update_expression,
+                    ExpressionAttributeValues=values,
+                )
         except ClientError as err:
             logger.error(err)
+            if self.cache is not None:
+                self.cache.invalidate(self.session_id)
+            return
+
+        if self.cache is not None:
+            self.cache.append(self.session_id, _messages)
+
+    def _put_message_items(
+        self, messages: List[Any], expires: Optional[int] = None
+    ) -> None:
+        items = [
+            {
+                self.primary_key_name: self.session_id,
+                self.sort_key_name: next_sort_key(),
+                "Message": message,
+            }
+            for message in messages
+        ]
+        if expires is not None:
+            for item in items:
+                item[EXPIRES_AT_ATTRIBUTE] = expires
+        if len(items) == 1:
+            self.table.put_item(Item=items[0])
+            return
+
+        # A turn is two messages, which batch_writer sends as one BatchWriteItem.
+        with self.table.batch_writer() as batch:
+            for item in items:
+                batch.put_item(Item=item)
+
+    def _refresh_expiry(self, expires: int) -> None:
+        """Push back the expiry of the head item, and of the window messages
+        unless it was done less than half an idle lifetime ago."""
+        from botocore.exceptions import ClientError
+
+        head = self.table.update_item(
+            Key=self._head_key(),
+            UpdateExpression=f"SET {EXPIRES_AT_ATTRIBUTE} = :expires",
+            ExpressionAttributeValues={":expires": expires},
+            ReturnValues="ALL_NEW",
+        )["Attributes"]
+        half_lifetime = self.idle_ttl_days * 12 * 3600
+        if int(head.get("WindowExpiresAt", 0)) > expires - half_lifetime:
+            return
+
+        limit = self.limited_item_count
+        items = self._query_message_items(
+            limit + 1 if limit is not None else None, newest_first=True
+        )
+        items = [item for item in items if "Message" in item]
+        for item in self._after_reset(items, head)[:limit]:
+            try:
+                self.table.update_item(
+                    Key={
+                        self.primary_key_name: self.session_id,
+                        self.sort_key_name: item[self.sort_key_name],
+                    },
+                    UpdateExpression=f"SET {EXPIRES_AT_ATTRIBUTE} = :expires",
+                    # Not for messages archived in the meantime.
+                    ConditionExpression="attribute_exists(Message)",
+                    ExpressionAttributeValues={":expires": expires},
+                )
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+        self.table.update_item(
+            Key=self._head_key(),
+            UpdateExpression="SET WindowExpiresAt = :expires",
+            ExpressionAttributeValues={":expires": expires},
+        )
+
+    def summarize_pending(
+        self, summarize: Callable[[str, List[BaseMessage]], str]
+    ) -> bool:
+        """Fold the messages that fell out of the window into the summary.
+
+        `summarize(summary, messages)` returns the new summary. It is called
+        only if there are messages older than the last `limited_item_count`
+        that are not part of the summary yet. The summary is saved with a
+        condition on the previous progress marker, so a concurrent update or a
+        reset in the meantime wins and this update is dropped.
+
+        Returns True if a new summary was saved.
+        """
+        try:
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise ImportError(
+                "Unable to import botocore, please install with `pip install botocore`."
+            ) from e
+
+        try:
+            if self.storage_mode == STORAGE_MODE_MESSAGE:
+                saved = self._summarize_message_items(summarize)
+            else:
+                saved = self._summarize_history(summarize)
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                logger.error(err)
+            return False
+
+        if saved and self.cache is not None:
+            self.cache.set_summary(self.session_id, self.summary)
+        return saved
+
+    def _summarize_history(self, summarize) -> bool:
+        response = self.table.get_item(Key=self.key, ConsistentRead=True)
+        item = response.get("Item")
+        if not item:
+            return False
+        history = item.get("History", [])
+        summarized_count = int(item.get("SummarizedCount", 0))
+        end = len(history) - (self.limited_item_count or 0)
+        if end <= summarized_count:
+            return False
+
+        previous_summary = item.get("Summary", "")
+        summary = summarize(
+            previous_summary,
+            messages_from_items(decode_messages(history[summarized_count:end])),
+        )
+        self.table.update_item(
+            Key=self.key,
+            UpdateExpression="SET Summary = :summary, SummarizedCount = :end",
+            ConditionExpression=(
+                "size(History) >= :end AND "
+                "(attribute_not_exists(SummarizedCount) OR SummarizedCount = :start)"
+            ),
+            ExpressionAttributeValues={
+                ":summary": summary,
+                ":start": summarized_count,
+                ":end": end,
+            },
+        )
+        self.summary = summary
+        return True
+
+    def _head_key(self) -> Dict[str, Any]:
+        return {
+            self.primary_key_name: self.session_id,
+            self.sort_key_name: HEAD_SORT_KEY,
+        }
+
+    def _summarize_message_items(self, summarize) -> bool:
+        from boto3.dynamodb.conditions import Key
+
+        head_key = self._head_key()
+        head = self.table.get_item(Key=head_key, ConsistentRead=True).get("Item", {})
+        summarized_through = int(head.get("SummarizedThrough", 0))
+
+        items = []
+        query_kwargs: Dict[str, Any] = {
+            "KeyConditionExpression": Key(self.primary_key_name).eq(self.session_id)
+            & Key(self.sort_key_name).between(
+                summarized_through + 1, HEAD_SORT_KEY - 1
+            ),
+            "ConsistentRead": True,
+        }
+        while True:
+            response = self.table.query(**query_kwargs)
+            items.extend(i for i in response.get("Items", []) if "Message" in i)
+            if "LastEvaluatedKey" not in response:
+                break
+            query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+        dropped = items[: len(items) - (self.limited_item_count or 0)]
+        if not dropped:
+            return False
+
+        summary = summarize(
+            head.get("Summary", ""),
+            messages_from_items(decode_messages([item["Message"] for item in dropped])),
+        )
+        update_expression, values = self._with_expiry(
+            "SET Summary = :summary, SummarizedThrough = :end",
+            {
+                ":summary": summary,
+                ":start": summarized_through,
+                ":end": int(dropped[-1][self.sort_key_name]),
+            },
+        )
+        self.table.update_item(
+            Key=head_key,
+            UpdateExpression=update_expression,
+            ConditionExpression=(
+                "attribute_not_exists(SummarizedThrough) OR SummarizedThrough = :start"
+            ),
+            ExpressionAttributeValues=values,
+        )
+        self.summary = summary
+        return True
 
     def clear(self) -> None:
-        """Clear session memory from DynamoDB"""
+        """Start a new conversation, archiving the previous one lazily.
+
+        The reset is a single conditional write. In the single-item layout it
+        empties "History" and returns the old item; in the per-message layout
+        it records the reset point in the head item, and older messages are no
+        longer read. The old messages are then copied to a `SessionId#timestamp`
+        backup by `archive_executor`. Client-side encryption does not support
+        updates and reads the item before overwriting it.
+        """
         try:
             from botocore.exceptions import ClientError
         except ImportError as e:
@@ -180,16 +635,119 @@ class DynamoDBChatMessageHistory(BaseChatMessageHistory):
                 "Unable to import botocore, please install with `pip install botocore`."
             ) from e
 
+        if self.cache is not None:
+            self.cache.invalidate(self.session_id)
+
+        archive = None
         try:
-            # Backup the conversation
-            response = self.table.get_item(Key=self.key)
-            current_timestamp = str(int(time.time() * 1000))
-            backup_session_id = self.session_id + "#" + current_timestamp
-            if response and "Item" in response:
-                response["Item"]["SessionId"] = backup_session_id
-                self.table.put_item(Item=response["Item"])
-
-            # Delete current conversation
-            self.table.delete_item(Key=self.key)
+            if self.storage_mode == STORAGE_MODE_MESSAGE:
+                reset_at = self._reset_message_items()
+                archive = functools.partial(self._archive_message_items, reset_at)
+            else:
+                item = self._reset_history()
+                if item and item.get("History"):
+                    archive = functools.partial(
+                        self._archive_history, item, int(time.time() * 1000)
+                    )
         except ClientError as err:
-            logger.error(err)
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                logger.error(err)
+            return
+
+        if archive is None:
+            return
+        if self.archive_executor is not None:
+            self.archive_executor.submit(self._archive, archive)
+        else:
+            self._archive(archive)
+
+    def _reset_history(self) -> Optional[Dict[str, Any]]:
+        """Empty the history of the item, returning the item it had."""
+        if self.encrypted:
+            item = self.table.get_item(Key=self.key).get("Item")
+            if item:
+                reset = {**self.key, "History": []}
+                expires = expires_at(self.idle_ttl_days)
+                if expires is not None:
+                    reset[EXPIRES_AT_ATTRIBUTE] = expires
+                self.table.put_item(Item=reset)
+            return item
+        # Fails when there is nothing to clear, e.g. a reset sent twice.
+        response = self.table.update_item(
+            Key=self.key,
+            UpdateExpression="SET History = :empty REMOVE Summary, SummarizedCount",
+            ConditionExpression="attribute_exists(History) AND size(History) > :zero",
+            ExpressionAttributeValues={":empty": [], ":zero": 0},
+            ReturnValues="ALL_OLD",
+        )
+        return response.get("Attributes")
+
+    def _reset_message_items(self) -> int:
+        """Hide the messages written so far, returning the reset sort key."""
+        reset_at = next_sort_key()
+        # The summary progress moves along, so a summary being made of the old
+        # messages is not saved.
+        update_expression, values = self._with_expiry(
+            "SET ResetAt = :reset, SummarizedThrough = :reset", {":reset": reset_at}
+        )
+        self.table.update_item(
+            Key=self._head_key(),
+            UpdateExpression=update_expression + " REMOVE Summary",
+            ConditionExpression="attribute_not_exists(ResetAt) OR ResetAt < :reset",
+            ExpressionAttributeValues=values,
+        )
+        return reset_at
+
+    def _with_expiry(
+        self, update_expression: str, values: Dict[str, Any]
+    ) -> Tuple[str, Dict[str, Any]]:
+        """Add the idle expiry to a SET update expression and its values."""
+        expires = expires_at(self.idle_ttl_days)
+        if expires is None:
+            return update_expression, values
+        return (
+            f"{update_expression}, {EXPIRES_AT_ATTRIBUTE} = :expires",
+            {**values, ":expires": expires},
+        )
+
+    def _archive(self, archive: Callable[[], None]) -> None:
+        try:
+            archive()
+        except Exception:
+            logger.exception(f"archiving the history of {self.session_id} failed")
+
+    def _backup_item(self, item: Dict[str, Any], timestamp: int) -> Dict[str, Any]:
+        backup = {**item, self.primary_key_name: f"{self.session_id}#{timestamp}"}
+        # Replaces the idle expiry of the conversation.
+        backup.pop(EXPIRES_AT_ATTRIBUTE, None)
+        expires = expires_at(self.archive_ttl_days)
+        if expires is not None:
+            backup[EXPIRES_AT_ATTRIBUTE] = expires
+        return backup
+
+    def _archive_history(self, item: Dict[str, Any], timestamp: int) -> None:
+        self.table.put_item(Item=self._backup_item(item, timestamp))
+
+    def _archive_message_items(self, reset_at: int) -> None:
+        """Move the message items up to `reset_at` to a `SessionId#timestamp` backup"""
+        from boto3.dynamodb.conditions import Key
+
+        backup_timestamp = reset_at // 1000
+        query_kwargs: Dict[str, Any] = {
+            "KeyConditionExpression": Key(self.primary_key_name).eq(self.session_id)
+            & Key(self.sort_key_name).lte(reset_at),
+        }
+        with self.table.batch_writer() as batch:
+            while True:
+                response = self.table.query(**query_kwargs)
+                for item in response.get("Items", []):
+                    batch.put_item(Item=self._backup_item(item, backup_timestamp))
+                    batch.delete_item(
+                        Key={
+                            self.primary_key_name: self.session_id,
+                            self.sort_key_name: item[self.sort_key_name],
+                        }
+                    )
+                if "LastEvaluatedKey" not in response:
+                    break
+                query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
@@ -0,0 +1,176 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+# Rough per-message overhead of the dict envelope on top of the text itself.
+_MESSAGE_OVERHEAD_BYTES = 200
+
+
+def _estimate_size(messages: List[Dict[str, Any]]) -> int:
+    size = 0
+    for message in messages:
+        content = message.get("data", {}).get("content", "")
+        size += len(content) * 4 if isinstance(content, str) else 1024
+        size += _MESSAGE_OVERHEAD_BYTES
+    return size
+
+
+class _Entry:
+    __slots__ = ("messages", "complete", "summary", "expires_at", "size")
+
+    def __init__(self, messages, complete, summary, expires_at):
+        self.messages = messages
+        self.complete = complete
+        self.summary = summary
+        self.expires_at = expires_at
+        self.size = _estimate_size(messages) + len(summary) * 4
+
+
+class HistoryCache:
+    """In-process LRU cache of serialized conversation histories.
+
+    Entries are keyed by session id and hold the messages in `messages_to_dict`
+    form, oldest first. An entry is either the complete history or the most
+    recent messages only, as read from DynamoDB, and is kept up to date by the
+    writes of `DynamoDBChatMessageHistory` (write-through). It also holds the
+    rolling summary of the conversation, if any.
+
+    Writes from other processes are not seen, so `ttl_seconds` bounds how stale
+    an entry can get when the service runs more than one task.
+
+    Args:
+        max_entries: maximum number of cached sessions.
+        ttl_seconds: lifetime of an entry since it was last read from DynamoDB or
+            written through.
+        max_bytes: approximate memory cap over all entries.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl_seconds: float = 300,
+        max_bytes: int = 32 * 1024 * 1024,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(
+        self, session_id: str, limit: Optional[int] = None
+    ) -> Optional[List[Dict[str, Any]]]:
+        """Return the newest `limit` messages (all if None), or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._remove(session_id)
+                self.expirations += 1
+                entry = None
+            if entry is None or not (
+                entry.complete or (limit is not None and len(entry.messages) >= limit)
+            ):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return entry.messages[-limit:] if limit else list(entry.messages)
+
+    def get_summary(self, session_id: str) -> Optional[str]:
+        """Return the cached summary, without counting a hit or miss."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            return entry.summary if entry is not None else None
+
+    def put(
+        self,
+        session_id: str,
+        messages: List[Dict[str, Any]],
+        complete: bool,
+        summary: str = "",
+    ) -> None:
+        """Store messages read from DynamoDB.
+
+        `complete` tells whether `messages` is the whole history or only the most
+        recent part of it.
+        """
+        with self._lock:
+            self._remove(session_id)
+            self._insert(
+                session_id, _Entry(list(messages), complete, summary, self._expiry())
+            )
+
+    def set_summary(self, session_id: str, summary: str) -> None:
+        """Write-through of a summary just saved in DynamoDB."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            self._remove(session_id)
+            self._insert(
+                session_id,
+                _Entry(entry.messages, entry.complete, summary, entry.expires_at),
+            )
+
+    def append(self, session_id: str, messages: List[Dict[str, Any]]) -> None:
+        """Write-through of messages just added in DynamoDB.
+
+        Sessions that are not cached stay uncached: without the earlier messages
+        the entry would look like a short history.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            self._remove(session_id)
+            self._insert(
+                session_id,
+                _Entry(
+                    entry.messages + list(messages),
+                    entry.complete,
+                    entry.summary,
+                    self._expiry(),
+                ),
+            )
+
+    def invalidate(self, session_id: str) -> None:
+        with self._lock:
+            self._remove(session_id)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def _expiry(self) -> float:
+        return time.monotonic() + self.ttl_seconds
+
+    def _insert(self, session_id: str, entry: _Entry) -> None:
+        if entry.size > self.max_bytes:
+            return
+        self._entries[session_id] = entry
+        self._bytes += entry.size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, session_id: str) -> None:
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
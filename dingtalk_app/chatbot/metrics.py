@@ -0,0 +1,264 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Per-turn timings of the replies.
+
+A `TurnMetrics` collects the time spent in each stage of a turn: loading the
+history, building the prompt, waiting for the first token, streaming, sending
+and updating the card, writing the history. `MetricsRecorder` writes each turn
+as a CloudWatch Embedded Metric Format (EMF) line, which CloudWatch Logs turns
+into metrics per model and stage for p50/p95/p99 dashboards, and can keep
+in-process histograms to log the same percentiles without CloudWatch.
+"""
+
+import functools
+import json
+import math
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, TextIO
+
+# Stages, in milliseconds unless listed in UNITS.
+HISTORY_LOAD = "HistoryLoad"
+CACHE_LOOKUP = "CacheLookup"
+PROMPT_BUILD = "PromptBuild"
+TIME_TO_FIRST_TOKEN = "TimeToFirstToken"
+GENERATION = "Generation"
+CARD_REPLY = "CardReply"
+CARD_UPDATE = "CardUpdate"
+HISTORY_WRITE = "HistoryWrite"
+TOTAL = "Total"
+OUTPUT_TOKENS = "OutputTokens"
+TOKENS_PER_SECOND = "TokensPerSecond"
+CACHE_HITS = "ResponseCacheHits"
+ERRORS = "Errors"
+
+UNITS = {
+    OUTPUT_TOKENS: "Count",
+    TOKENS_PER_SECOND: "Count/Second",
+    CACHE_HITS: "Count",
+    ERRORS: "Count",
+}
+
+# EMF accepts at most 100 values per metric and line.
+MAX_EMF_VALUES = 100
+
+
+class TurnMetrics:
+    """Values observed during one turn, safe to use from several threads.
+
+    :param recorder: receives the turn on `finish`, None to only collect
+    :param model_id: dimension of the metrics, the model that answered
+    """
+
+    def __init__(
+        self,
+        recorder: Optional["MetricsRecorder"] = None,
+        model_id: Optional[str] = None,
+    ):
+        self.recorder = recorder
+        self.model_id = model_id
+        self.values: Dict[str, List[float]] = defaultdict(list)
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._finished = False
+        # The turn an adopted attempt observes into, see `adopt`.
+        self._adopted_by: Optional["TurnMetrics"] = None
+
+    def observe(self, metric: str, value: float) -> None:
+        with self._lock:
+            turn = self._adopted_by
+            if turn is None:
+                self.values[metric].append(value)
+                return
+        turn.observe(metric, value)
+
+    def attempt(self) -> "TurnMetrics":
+        """Metrics of one of several attempts at the turn, e.g. calls to
+        several endpoints, kept apart from the turn unless it is `adopt`ed."""
+        return TurnMetrics(model_id=self.model_id)
+
+    def adopt(self, attempt: "TurnMetrics") -> None:
+        """Merge the values and the model of the attempt that answered; what it
+        observes from now on goes to this turn. The values of other attempts,
+        still running or not, never reach the turn."""
+        with attempt._lock:
+            values, attempt.values = attempt.values, defaultdict(list)
+            attempt._adopted_by = self
+        with self._lock:
+            for metric, samples in values.items():
+                self.values[metric].extend(samples)
+            if attempt.model_id is not None:
+                self.model_id = attempt.model_id
+
+    @contextmanager
+    def span(self, stage: str):
+        """Time the block as `stage`, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, (time.perf_counter() - started) * 1000)
+
+    def timed(self, stage: str, func: Callable) -> Callable:
+        """`func` timed as `stage` on every call."""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.span(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def timed_async(self, stage: str, func: Callable) -> Callable:
+        """Coroutine function `func` timed as `stage` on every call."""
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with self.span(stage):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    def generated(self, output_tokens: int, seconds: float) -> None:
+        """Observe a stream of `output_tokens` that lasted `seconds` after its
+        first token."""
+        self.observe(GENERATION, seconds * 1000)
+        self.observe(OUTPUT_TOKENS, output_tokens)
+        if seconds > 0:
+            self.observe(TOKENS_PER_SECOND, output_tokens / seconds)
+
+    def finish(self) -> None:
+        """Observe the total time and hand the turn to the recorder, once."""
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+            self.values[TOTAL].append((time.perf_counter() - self.started) * 1000)
+        if self.recorder is not None:
+            self.recorder.record(self)
+
+
+class Histogram:
+    """Log-scale histogram, percentiles are within 10% of the exact value."""
+
+    BUCKETS_PER_DOUBLING = 8
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        self.buckets[
+            math.ceil(math.log2(max(value, 0.001)) * self.BUCKETS_PER_DOUBLING)
+        ] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the `q` quantile, 0 < q <= 1."""
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** (bucket / self.BUCKETS_PER_DOUBLING), self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "p50": round(self.percentile(0.5), 1),
+            "p95": round(self.percentile(0.95), 1),
+            "p99": round(self.percentile(0.99), 1),
+            "max": round(self.max, 1),
+        }
+
+
+class MetricsRecorder:
+    """
+    :param namespace: CloudWatch namespace of the EMF metrics
+    :param emf: write an EMF line per turn to `stream`
+    :param histograms: keep histograms per model and stage for `dump`
+    :param stream: where EMF lines go, stdout by default, the log stream of
+        the container. Lines must not be prefixed for CloudWatch to read them.
+    """
+
+    def __init__(
+        self,
+        namespace: str = "DingTalkBedrock",
+        emf: bool = False,
+        histograms: bool = False,
+        stream: Optional[TextIO] = None,
+    ):
+        self.namespace = namespace
+        self.emf = emf
+        self.histograms = histograms
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[str, Histogram]] = defaultdict(
+            lambda: defaultdict(Histogram)
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.emf or self.histograms
+
+    def turn(self, model_id: Optional[str] = None) -> TurnMetrics:
+        return TurnMetrics(self if self.enabled else None, model_id)
+
+    def record(self, turn: TurnMetrics) -> None:
+        with turn._lock:
+            values = {metric: list(samples) for metric, samples in turn.values.items()}
+        model_id = turn.model_id or "unknown"
+        if self.emf:
+            line = json.dumps(self.emf_document(model_id, values), ensure_ascii=False)
+            with self._lock:
+                stream = self.stream or sys.stdout
+                stream.write(line + "\n")
+                stream.flush()
+        if self.histograms:
+            with self._lock:
+                for metric, samples in values.items():
+                    for value in samples:
+                        self._histograms[model_id][metric].add(value)
+
+    def emf_document(
+        self, model_id: str, values: Dict[str, List[float]]
+    ) -> Dict[str, object]:
+        document = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [["ModelId"]],
+                        "Metrics": [
+                            {"Name": metric, "Unit": UNITS.get(metric, "Milliseconds")}
+                            for metric in values
+                        ],
+                    }
+                ],
+            },
+            "ModelId": model_id,
+        }
+        for metric, samples in values.items():
+            samples = [round(value, 3) for value in samples[-MAX_EMF_VALUES:]]
+            document[metric] = samples[0] if len(samples) == 1 else samples
+        return document
+
+    def dump(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """Percentiles per model and stage since the start."""
+        with self._lock:
+            return {
+                model_id: {
+                    metric: histogram.summary()
+                    for metric, histogram in sorted(metrics.items())
+                }
+                for model_id, metrics in self._histograms.items()
+            }
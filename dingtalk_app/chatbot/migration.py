@@ -0,0 +1,163 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Move conversations from the single-item layout to the per-message layout.
+
+The single-item table keeps the whole conversation in the "History" list of the
+item keyed by "SessionId". The per-message table uses the same partition key and
+a numeric "CreatedAt" sort key, one item per message.
+
+Run it from the dingtalk_app directory, before or after switching the service
+to `DDB_STORAGE_MODE=message`:
+
+    python -m chatbot.migration --source <conversation table> --target <message table>
+"""
+
+import argparse
+import logging
+import re
+import time
+from typing import Optional
+
+from .dynamodb import HEAD_SORT_KEY
+
+logger = logging.getLogger(__name__)
+
+# Set on the items written by the migration.
+MIGRATED_ATTRIBUTE = "Migrated"
+
+# The `SessionId#timestamp` backups written by `clear`.
+BACKUP_SESSION_ID = re.compile(r"#\d+$")
+
+
+def migrate_to_message_layout(
+    source_table_name: str,
+    target_table_name: str,
+    primary_key_name: str = "SessionId",
+    sort_key_name: str = "CreatedAt",
+    endpoint_url: Optional[str] = None,
+    dry_run: bool = False,
+) -> int:
+    """
+    Copy every conversation item of the source table into per-message items.
+
+    Messages get consecutive sort keys that end just before the migration start
+    time, so messages written by the service afterwards always sort after them.
+    Sessions that already got messages in the target table, because the service
+    was switched first, get theirs just before the earliest of them. Migrated
+    items are marked with `MIGRATED_ATTRIBUTE`, sessions whose earliest item
+    has it are skipped, which makes the migration safe to re-run.
+
+    :param source_table_name: table using the single-item "History" layout
+    :param target_table_name: table with `primary_key_name` and `sort_key_name` keys
+    :param primary_key_name: partition key of both tables
+    :param sort_key_name: numeric sort key of the target table
+    :param endpoint_url: optional DynamoDB endpoint, e.g. DynamoDB Local
+    :param dry_run: only count the messages that would be written
+
+    :return: number of migrated messages
+    """
+    import boto3
+    from boto3.dynamodb.conditions import Key
+    from botocore.exceptions import ClientError
+
+    dynamodb = boto3.resource("dynamodb", endpoint_url=endpoint_url)
+    source = dynamodb.Table(source_table_name)
+    target = dynamodb.Table(target_table_name)
+
+    base_sort_key = time.time_ns() // 1000
+    migrated = 0
+    scan_kwargs = {}
+    while True:
+        response = source.scan(**scan_kwargs)
+        for item in response.get("Items", []):
+            session_id = item[primary_key_name]
+            history = item.get("History", [])
+            if not history or BACKUP_SESSION_ID.search(session_id):
+                continue
+
+            head_key = {primary_key_name: session_id, sort_key_name: HEAD_SORT_KEY}
+            head = target.get_item(Key=head_key, ConsistentRead=True).get("Item", {})
+            if "ResetAt" in head:
+                logger.info("Skip %s, reset after switching layouts", session_id)
+                continue
+
+            # The earliest message, or the head item of a session without any.
+            existing = target.query(
+                KeyConditionExpression=Key(primary_key_name).eq(session_id),
+                Limit=1,
+            ).get("Items")
+            end_sort_key = base_sort_key
+            if existing:
+                earliest = existing[0]
+                if earliest.get(MIGRATED_ATTRIBUTE):
+                    logger.info("Skip %s, already migrated", session_id)
+                    continue
+                end_sort_key = min(int(earliest[sort_key_name]), base_sort_key)
+
+            migrated += len(history)
+            if dry_run:
+                continue
+
+            first_sort_key = end_sort_key - len(history)
+            with target.batch_writer() as batch:
+                for index, message in enumerate(history):
+                    batch.put_item(
+                        Item={
+                            primary_key_name: session_id,
+                            sort_key_name: first_sort_key + index,
+                            "Message": message,
+                            MIGRATED_ATTRIBUTE: True,
+                        }
+                    )
+            summarized_count = int(item.get("SummarizedCount", 0))
+            if item.get("Summary") and summarized_count:
+                try:
+                    # Leaves a summary the service made since the switch alone.
+                    target.update_item(
+                        Key=head_key,
+                        UpdateExpression=(
+                            "SET Summary = :summary, SummarizedThrough = :through"
+                        ),
+                        ConditionExpression="attribute_not_exists(SummarizedThrough)",
+                        ExpressionAttributeValues={
+                            ":summary": item["Summary"],
+                            ":through": first_sort_key + summarized_count - 1,
+                        },
+                    )
+                except ClientError as error:
+                    if error.response["Error"]["Code"] != (
+                        "ConditionalCheckFailedException"
+                    ):
+                        raise
+                    logger.info("Keep the existing summary of %s", session_id)
+            logger.info("Migrated %s messages of %s", len(history), session_id)
+
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    return migrated
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--source", required=True, help="single-item table name")
+    parser.add_argument("--target", required=True, help="per-message table name")
+    parser.add_argument("--endpoint-url", default=None)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    count = migrate_to_message_layout(
+        args.source,
+        args.target,
+        endpoint_url=args.endpoint_url,
+        dry_run=args.dry_run,
+    )
+    logger.info("%s messages %s", count, "to migrate" if args.dry_run else "migrated")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Batched reads of conversation items for bursts of messages.
+"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Most keys BatchGetItem accepts in one request.
+MAX_BATCH_KEYS = 100
+
+
+class HistoryBatcher:
+    """Groups the `get_item` calls of concurrent turns into `BatchGetItem` calls.
+
+    The first thread asking for an item waits `window_seconds` for others to
+    ask too, then reads all their items with one request per table and hands
+    each thread its own response. Threads asking for the same item, e.g. the
+    busy group chat of a burst, share one key of the batch. A lone turn waits
+    `window_seconds` longer than with `get_item`.
+
+    Only for tables without client-side encryption; `DynamoDBChatMessageHistory`
+    reads encrypted tables with `get_item`.
+
+    Args:
+        window_seconds: how long the first request of a batch waits for others.
+        max_attempts: requests for the keys DynamoDB left unprocessed, with
+            exponential backoff, before they are read with `get_item`.
+    """
+
+    def __init__(self, window_seconds: float = 0.005, max_attempts: int = 3):
+        self.window_seconds = window_seconds
+        self.max_attempts = max_attempts
+        self._condition = threading.Condition()
+        # (table, key, future) of the requests waiting for the next batch.
+        self._pending: List[Tuple[Any, Dict[str, Any], Future]] = []
+        self.requests = 0
+        self.batches = 0
+        self.keys = 0
+        self.fallbacks = 0
+
+    def get_item(self, table, key: Dict[str, Any]) -> Dict[str, Any]:
+        """Same response as `table.get_item(Key=key)`, read in a batch."""
+        future = Future()
+        with self._condition:
+            self._pending.append((table, key, future))
+            self.requests += 1
+            leader = len(self._pending) == 1
+            if len(self._pending) >= MAX_BATCH_KEYS:
+                self._condition.notify()
+        if leader:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: len(self._pending) >= MAX_BATCH_KEYS, self.window_seconds
+                )
+                pending, self._pending = self._pending, []
+            try:
+                self._fetch(pending)
+            except Exception as e:
+                for _, _, waiting in pending:
+                    if not waiting.done():
+                        waiting.set_exception(e)
+        return future.result()
+
+    def _fetch(self, pending: List[Tuple[Any, Dict[str, Any], Future]]) -> None:
+        tables: Dict[str, Any] = {}
+        # Futures by table name and key, duplicate keys are read once.
+        waiting: Dict[str, Dict[Tuple, List[Future]]] = {}
+        keys: Dict[str, Dict[Tuple, Dict[str, Any]]] = {}
+        for table, key, future in pending:
+            tables[table.name] = table
+            key_id = _key_id(key)
+            waiting.setdefault(table.name, {}).setdefault(key_id, []).append(future)
+            keys.setdefault(table.name, {})[key_id] = key
+
+        for table_name, table in tables.items():
+            table_keys = list(keys[table_name].values())
+            for start in range(0, len(table_keys), MAX_BATCH_KEYS):
+                chunk = table_keys[start : start + MAX_BATCH_KEYS]
+                try:
+                    items = self._batch_get(table, chunk)
+                except Exception as e:
+                    for key in chunk:
+                        for future in waiting[table_name][_key_id(key)]:
+                            future.set_exception(e)
+                    continue
+                for key in chunk:
+                    key_id = _key_id(key)
+                    response = {"Item": items[key_id]} if key_id in items else {}
+                    for future in waiting[table_name][key_id]:
+                        future.set_result(response)
+
+    def _batch_get(self, table, keys: List[Dict[str, Any]]) -> Dict[Tuple, Dict]:
+        """Items of `keys` found in `table`, by key."""
+        # The client of the table's resource takes and returns Python values.
+        client = table.meta.client
+        key_names = list(keys[0])
+        request = {table.name: {"Keys": keys}}
+        items = {}
+        for attempt in range(self.max_attempts):
+            response = client.batch_get_item(RequestItems=request)
+            with self._condition:
+                self.batches += 1
+                self.keys += len(request[table.name]["Keys"])
+            for item in response.get("Responses", {}).get(table.name, []):
+                items[_key_id({name: item[name] for name in key_names})] = item
+            request = response.get("UnprocessedKeys") or {}
+            if not request:
+                return items
+            if attempt + 1 < self.max_attempts:
+                time.sleep(random.uniform(0, 0.05 * 2**attempt))
+
+        # Still throttled: read the rest one by one, with the client's retries.
+        for key in request[table.name]["Keys"]:
+            with self._condition:
+                self.fallbacks += 1
+            item = table.get_item(Key=key).get("Item")
+            if item is not None:
+                items[_key_id(key)] = item
+        return items
+
+    def stats(self) -> Dict[str, int]:
+        with self._condition:
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "keys": self.keys,
+                "fallbacks": self.fallbacks,
+            }
+
+
+def _key_id(key: Dict[str, Any]) -> Tuple:
+    return tuple(sorted(key.items()))
@@ -0,0 +1,258 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence
+
+if TYPE_CHECKING:
+    # Imported when the cache embeds questions, not at startup.
+    import numpy as np
+
+# Trailing punctuation does not change the question.
+_TRAILING_PUNCTUATION = re.compile(r"[\s\?\!\.,;:？！。，；：~～]+$")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """Fold width, case, whitespace and trailing punctuation of a question."""
+    question = unicodedata.normalize("NFKC", question).lower()
+    question = _WHITESPACE.sub(" ", question).strip()
+    return _TRAILING_PUNCTUATION.sub("", question)
+
+
+def conversation_context(
+    template: str,
+    history: Sequence = (),
+    summary: str = "",
+    max_turns: Optional[int] = None,
+) -> Optional[str]:
+    """Context of a `ResponseCache` scope: the prompt template, the rolling
+    summary and the messages the answer is generated with.
+
+    None when the history has more than `max_turns` turns: such a context is
+    almost never seen twice, so its answers would only fill the cache.
+    """
+    if max_turns is not None and history_turns(history) > max_turns:
+        return None
+    lines = [template, summary or ""]
+    lines.extend(f"{message.type}: {message.content}" for message in history)
+    return "\n".join(lines)
+
+
+def history_turns(history: Sequence) -> int:
+    """Number of turns of `history`, a window may start with an answer."""
+    turns = sum(message.type == "human" for message in history)
+    if history and history[0].type != "human":
+        turns += 1
+    return turns
+
+
+class _Entry:
+    __slots__ = ("question", "scope", "response", "embedding", "expires_at")
+
+    def __init__(self, question, scope, response, embedding, expires_at):
+        self.question = question
+        self.scope = scope
+        self.response = response
+        self.embedding = embedding
+        self.expires_at = expires_at
+
+
+class Lookup:
+    """Result of `ResponseCache.lookup`, passed back to `store` on a miss."""
+
+    __slots__ = ("key", "question", "scope", "embedding", "response", "similarity")
+
+    def __init__(self, key, question, scope, embedding=None, response=None):
+        self.key = key
+        self.question = question
+        self.scope = scope
+        self.embedding = embedding
+        self.response = response
+        # 1.0 for exact hits, the cosine similarity for semantic hits.
+        self.similarity = None
+
+
+class ResponseCache:
+    """In-process cache of model responses to repeated questions.
+
+    Responses are keyed by the normalized question and a scope made of the
+    model id and the context the answer depends on, e.g. the prompt template.
+    An exact match is tried first. If `embed` is given, a question without an
+    exact match is also compared with the cached questions of the same scope by
+    cosine similarity of their embeddings, and the response of the closest
+    one is used when the similarity reaches `similarity_threshold`.
+
+    The context must include the conversation history and summary the answer
+    was generated with, see `conversation_context`: otherwise the answer of one
+    conversation, which may quote its messages, would be served to another.
+    Responses are therefore only shared by conversations with the same short
+    history, typically their first questions; questions of longer
+    conversations are `skip`ped. Questions shorter than `min_question_chars`
+    are not cached.
+
+    Args:
+        max_entries: maximum number of cached responses, least recently used
+            ones are evicted first.
+        ttl_seconds: lifetime of a cached response.
+        embed: returns the embedding of a text, e.g. `BedrockEmbeddings.embed_query`.
+        similarity_threshold: minimum cosine similarity of a semantic hit.
+        min_question_chars: shorter normalized questions are not cached.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl_seconds: float = 3600,
+        embed: Optional[Callable[[str], List[float]]] = None,
+        similarity_threshold: float = 0.95,
+        min_question_chars: int = 6,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self.min_question_chars = min_question_chars
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Embedding matrix of the entries, rebuilt lazily after changes.
+        self._index_keys: List[str] = []
+        self._index: Optional["np.ndarray"] = None
+        self._index_dirty = False
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.evictions = 0
+
+    @staticmethod
+    def scope(model_id: str, context: str = "") -> str:
+        return f"{model_id}:{hashlib.sha256(context.encode()).hexdigest()[:16]}"
+
+    def lookup(
+        self, question: str, model_id: str, context: str = ""
+    ) -> Optional[Lookup]:
+        """Look `question` up, None if it is not cacheable.
+
+        The returned `Lookup` holds the cached response, or None on a miss; in
+        that case pass it to `store` with the model response.
+        """
+        question = normalize_question(question)
+        if len(question) < self.min_question_chars:
+            return None
+        scope = self.scope(model_id, context)
+        key = f"{scope}\n{question}"
+        lookup = Lookup(key, question, scope)
+
+        with self._lock:
+            entry = self._get(key)
+            if entry is not None:
+                self.exact_hits += 1
+                lookup.response = entry.response
+                lookup.similarity = 1.0
+                return lookup
+
+        if self.embed is not None:
+            import numpy as np
+
+            embedding = np.asarray(self.embed(question), dtype=np.float32)
+            norm = np.linalg.norm(embedding)
+            lookup.embedding = embedding / norm if norm else embedding
+            with self._lock:
+                match = self._nearest(lookup.embedding, scope)
+                if match is not None:
+                    self.semantic_hits += 1
+                    lookup.response, lookup.similarity = match
+                    return lookup
+
+        with self._lock:
+            self.misses += 1
+        return lookup
+
+    def skip(self) -> None:
+        """Count a question answered without looking it up, e.g. because of
+        its long context."""
+        with self._lock:
+            self.skipped += 1
+
+    def store(self, lookup: Lookup, response: str) -> None:
+        """Cache the model `response` of a missed `lookup`."""
+        if not response:
+            return
+        with self._lock:
+            self._remove(lookup.key)
+            self._entries[lookup.key] = _Entry(
+                lookup.question,
+                lookup.scope,
+                response,
+                lookup.embedding,
+                time.monotonic() + self.ttl_seconds,
+            )
+            if lookup.embedding is not None:
+                self._index_dirty = True
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "skipped": self.skipped,
+                "evictions": self.evictions,
+            }
+
+    def _get(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.embedding is not None:
+            self._index_dirty = True
+
+    def _nearest(self, embedding: "np.ndarray", scope: str):
+        import numpy as np
+
+        if self._index_dirty:
+            self._index_keys = [
+                key
+                for key, entry in self._entries.items()
+                if entry.embedding is not None
+            ]
+            self._index = (
+                np.stack([self._entries[key].embedding for key in self._index_keys])
+                if self._index_keys
+                else None
+            )
+            self._index_dirty = False
+        if self._index is None or self._index.shape[1] != embedding.shape[0]:
+            return None
+
+        similarities = self._index @ embedding
+        for position in np.argsort(-similarities):
+            similarity = float(similarities[position])
+            if similarity < self.similarity_threshold:
+                return None
+            key = self._index_keys[position]
+            entry = self._entries.get(key)
+            if entry is None or entry.scope != scope:
+                continue
+            if self._get(key) is None:
+                continue
+            return entry.response, similarity
+        return None
@@ -0,0 +1,486 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Model calls routed over several Bedrock models and regions.
+
+A single model in a single region throttles the whole bot once its quota is
+used up. `RoutedChatbot` spreads the calls over a weighted pool of endpoints,
+each a model id in a region, tracks their time to first token and error rate
+and prefers the healthy ones. A call that fails or stalls before its first
+token is sent again to the next endpoint; once text was streamed an error is
+raised as with a single model.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+from langchain_core.messages import BaseMessage
+
+from .metrics import HISTORY_LOAD, PROMPT_BUILD, TurnMetrics
+
+logger = logging.getLogger(__name__)
+
+
+class FirstTokenTimeout(TimeoutError):
+    """An endpoint did not stream its first token in time."""
+
+
+class Endpoint:
+    """
+    A model id in a region, with its weight in the pool and its health.
+
+    :param model_id: one of `supported_models`
+    :param region_name: defaults to the region of the default session
+    :param weight: share of the calls compared to the other endpoints while
+        they are equally healthy
+    """
+
+    def __init__(
+        self, model_id: str, region_name: Optional[str] = None, weight: float = 1.0
+    ):
+        if weight <= 0:
+            raise ValueError(f"weight of {model_id} must be positive")
+        self.model_id = model_id
+        self.region_name = region_name
+        self.weight = weight
+        # Moving averages of the time to first token, in seconds, and of failures.
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        # No calls are sent until then, unless all endpoints are failing.
+        self.open_until = 0.0
+        self.calls = 0
+        self.failures = 0
+
+    @property
+    def name(self) -> str:
+        return (
+            f"{self.model_id}@{self.region_name}" if self.region_name else self.model_id
+        )
+
+    def __repr__(self):
+        return f"Endpoint({self.name}, weight={self.weight})"
+
+
+def parse_endpoints(spec: str) -> List[Endpoint]:
+    """Endpoints of a comma-separated `model_id[@region][=weight]` list.
+
+    e.g. "anthropic.claude-3-haiku-20240307-v1:0@us-west-2=2,anthropic.claude-v2:1@us-east-1"
+    """
+    endpoints = []
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        item, _, weight = item.partition("=")
+        model_id, _, region_name = item.partition("@")
+        endpoints.append(
+            Endpoint(
+                model_id.strip(),
+                region_name.strip() or None,
+                float(weight) if weight else 1.0,
+            )
+        )
+    return endpoints
+
+
+class ModelRouter:
+    """Orders the endpoints of a call by weight and health.
+
+    The first endpoint is drawn at random in proportion to the endpoint weights
+    divided by the expected time to first token, a failure counting as
+    `failure_penalty` seconds, so the healthiest
+    endpoints get most of the calls while the others still get some and their
+    health stays known. The remaining endpoints follow as failover, best first.
+    After `failure_threshold` failures in a row an endpoint gets no calls for
+    `cooldown_seconds`, then one call tells whether it recovered.
+
+    :param endpoints: the pool, at least one endpoint
+    :param failure_threshold: failures in a row that take an endpoint out
+    :param cooldown_seconds: how long a failing endpoint is taken out
+    :param smoothing: weight of a new sample in the moving averages
+    :param failure_penalty: seconds a failure costs, e.g. a first token timeout
+    """
+
+    def __init__(
+        self,
+        endpoints: List[Endpoint],
+        failure_threshold: int = 3,
+        cooldown_seconds: float = 30,
+        smoothing: float = 0.2,
+        failure_penalty: float = 10,
+        rng: Optional[random.Random] = None,
+    ):
+        if not endpoints:
+            raise ValueError("at least one endpoint is required")
+        names = [endpoint.name for endpoint in endpoints]
+        if len(set(names)) != len(names):
+            raise ValueError(f"duplicate endpoints in {names}")
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.smoothing = smoothing
+        self.failure_penalty = failure_penalty
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+
+    def score(self, endpoint: Endpoint) -> float:
+        """Weight of `endpoint` lowered by its health, endpoints without calls
+        yet are not penalized."""
+        # Failures expected before a call succeeds, times what each one costs.
+        failures = endpoint.error_rate / max(1 - endpoint.error_rate, 0.01)
+        return endpoint.weight / (
+            1 + (endpoint.latency or 0) + failures * self.failure_penalty
+        )
+
+    def candidates(self) -> List[Endpoint]:
+        """Endpoints to try for a call, in order."""
+        now = time.monotonic()
+        with self._lock:
+            available = [e for e in self.endpoints if e.open_until <= now]
+            # Out ones come last, the soonest back first.
+            out = sorted(
+                (e for e in self.endpoints if e.open_until > now),
+                key=lambda e: e.open_until,
+            )
+            if not available:
+                return out
+            scores = [self.score(endpoint) for endpoint in available]
+            first = self.rng.choices(available, weights=scores)[0]
+            rest = sorted(
+                (e for e in available if e is not first),
+                key=self.score,
+                reverse=True,
+            )
+            return [first, *rest, *out]
+
+    def succeeded(self, endpoint: Endpoint, latency: float) -> None:
+        """Record a call that streamed its first token after `latency` seconds."""
+        with self._lock:
+            endpoint.calls += 1
+            endpoint.latency = (
+                latency
+                if endpoint.latency is None
+                else endpoint.latency + self.smoothing * (latency - endpoint.latency)
+            )
+            endpoint.error_rate -= self.smoothing * endpoint.error_rate
+            endpoint.consecutive_failures = 0
+
+    def failed(self, endpoint: Endpoint, streaming: bool = False) -> None:
+        """Record a failed call, `streaming` if it already `succeeded`."""
+        with self._lock:
+            if not streaming:
+                endpoint.calls += 1
+            endpoint.failures += 1
+            endpoint.error_rate += self.smoothing * (1 - endpoint.error_rate)
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.failure_threshold:
+                endpoint.open_until = time.monotonic() + self.cooldown_seconds
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                endpoint.name: {
+                    "calls": endpoint.calls,
+                    "failures": endpoint.failures,
+                    "first_token_ms": (
+                        round(endpoint.latency * 1000)
+                        if endpoint.latency is not None
+                        else None
+                    ),
+                    "error_rate": round(endpoint.error_rate, 3),
+                    "out": endpoint.open_until > now,
+                }
+                for endpoint in self.endpoints
+            }
+
+
+class RoutedChatbot:
+    """Drop-in replacement of `Chatbot` answering with a pool of endpoints.
+
+    :param endpoints: the pool, see `parse_endpoints`
+    :param chatbot_factory: creates the `Chatbot` of an endpoint, by default
+        `endpoint_chatbot`
+    :param first_token_timeout: seconds to wait for the first token before
+        trying the next endpoint, 0 to wait as long as the client does
+    :param max_workers: threads waiting for first tokens in `ask_stream`. A
+        call abandoned after `first_token_timeout` keeps its thread until the
+        client read timeout, so it should cover the concurrent calls plus the
+        calls abandoned within a read timeout, e.g. the concurrent calls times
+        the endpoints. When all are busy, a call waits for its first token in
+        the caller's thread, without the timeout, rather than queueing.
+    :param router_kwargs: passed to `ModelRouter`
+    """
+
+    def __init__(
+        self,
+        endpoints: List[Endpoint],
+        chatbot_factory: Optional[Callable[[Endpoint], object]] = None,
+        first_token_timeout: float = 10,
+        max_workers: int = 32,
+        **router_kwargs,
+    ):
+        self.router = ModelRouter(endpoints, **router_kwargs)
+        if chatbot_factory is None:
+            chatbot_factory = endpoint_chatbot
+        self.chatbots = {
+            endpoint.name: chatbot_factory(endpoint) for endpoint in endpoints
+        }
+        # Identifies the pool, e.g. in the response cache scope.
+        self.model_id = ",".join(dict.fromkeys(e.model_id for e in endpoints))
+        # All chatbots share the template.
+        self.prompt = self.chatbots[endpoints[0].name].prompt
+        self.first_token_timeout = first_token_timeout
+        self.first_token_executor = (
+            ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="first-token"
+            )
+            if first_token_timeout
+            else None
+        )
+        # Free threads of the executor, abandoned calls included.
+        self._first_token_slots = threading.BoundedSemaphore(max_workers)
+
+    @property
+    def usage_totals(self) -> Counter:
+        totals = Counter()
+        for chatbot in self.chatbots.values():
+            totals.update(chatbot.usage_totals)
+        return totals
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return self.router.stats()
+
+    def ask_stream(
+        self,
+        input_text: str,
+        conversation_history=None,
+        metrics: Optional[TurnMetrics] = None,
+        history: Optional[List[BaseMessage]] = None,
+        summary: Optional[str] = None,
+        **kwargs,
+    ) -> Iterator[str]:
+        """`Chatbot.ask_stream` on the first endpoint that streams a first token.
+
+        The history is read and the request of each model built once, not
+        again by the failover attempts. Raises the error of the last endpoint
+        if none did.
+        """
+        if metrics is None:
+            metrics = TurnMetrics()
+        if history is None:
+            with metrics.span(HISTORY_LOAD):
+                history = (
+                    conversation_history.chat_memory.messages
+                    if conversation_history
+                    else []
+                )
+                summary = getattr(
+                    getattr(conversation_history, "chat_memory", None), "summary", ""
+                )
+        # Endpoints of a model in several regions send the same request.
+        requests = {}
+        error = None
+        for endpoint in self.router.candidates():
+            chatbot = self.chatbots[endpoint.name]
+            if endpoint.model_id not in requests:
+                with metrics.span(PROMPT_BUILD):
+                    requests[endpoint.model_id] = chatbot.build_request(
+                        input_text, history, summary or "", kwargs.get("stop")
+                    )
+            # An abandoned attempt may still observe, only the answering one
+            # is merged into the turn.
+            attempt = metrics.attempt()
+            started = time.monotonic()
+            try:
+                first, chunks = self._first_token(
+                    chatbot.ask_stream,
+                    input_text,
+                    conversation_history=conversation_history,
+                    metrics=attempt,
+                    history=history,
+                    summary=summary,
+                    request=requests[endpoint.model_id],
+                    **kwargs,
+                )
+            except Exception as e:
+                self.router.failed(endpoint)
+                logger.warning(f"{endpoint.name} failed before the first token: {e}")
+                error = e
+                continue
+            self.router.succeeded(endpoint, time.monotonic() - started)
+            metrics.adopt(attempt)
+            return self._watch(endpoint, first, chunks)
+        raise error
+
+    def _first_token(self, ask_stream, *args, **kwargs):
+        """The first chunk and the stream of `ask_stream`, or `_END` and the
+        stream of an empty response."""
+        if self.first_token_executor is None:
+            return _first_chunk(ask_stream(*args, **kwargs))
+        if not self._first_token_slots.acquire(blocking=False):
+            # Queued behind abandoned calls, the wait would count against the
+            # timeout.
+            logger.warning("all first token threads are busy, waiting inline")
+            return _first_chunk(ask_stream(*args, **kwargs))
+        future = self.first_token_executor.submit(
+            lambda: _first_chunk(ask_stream(*args, **kwargs))
+        )
+        future.add_done_callback(lambda _: self._first_token_slots.release())
+        try:
+            return future.result(timeout=self.first_token_timeout)
+        except FutureTimeoutError:
+            # The call is abandoned, its stream is closed once it starts, or
+            # the call ends with the client read timeout.
+            if not future.cancel():
+                future.add_done_callback(_close_abandoned)
+            raise FirstTokenTimeout(
+                f"no first token within {self.first_token_timeout}s"
+            )
+
+    def _watch(
+        self, endpoint: Endpoint, first, chunks: Iterator[str]
+    ) -> Iterator[str]:
+        try:
+            if first is not _END:
+                yield first
+                yield from chunks
+        except Exception:
+            self.router.failed(endpoint, streaming=True)
+            raise
+        finally:
+            _close(chunks)
+
+    async def ask_stream_async(
+        self,
+        bedrock_client,
+        input_text: str,
+        history: Optional[List[BaseMessage]] = None,
+        summary: str = "",
+        metrics: Optional[TurnMetrics] = None,
+        **kwargs,
+    ) -> AsyncIterator[str]:
+        """`Chatbot.ask_stream_async` on the first endpoint that streams a first
+        token, `bedrock_client` is switched to the region of the endpoint. The
+        request body of each model is built once."""
+        if metrics is None:
+            metrics = TurnMetrics()
+        bodies = {}
+        error = None
+        for endpoint in self.router.candidates():
+            chatbot = self.chatbots[endpoint.name]
+            if endpoint.model_id not in bodies:
+                with metrics.span(PROMPT_BUILD):
+                    bodies[endpoint.model_id] = chatbot.request_body(
+                        input_text, history, summary, kwargs.get("stop")
+                    )
+            attempt = metrics.attempt()
+            chunks = chatbot.ask_stream_async(
+                bedrock_client.for_region(endpoint.region_name),
+                input_text,
+                history,
+                summary,
+                metrics=attempt,
+                body=bodies[endpoint.model_id],
+                **kwargs,
+            )
+            started = time.monotonic()
+            try:
+                first = await asyncio.wait_for(
+                    anext(chunks), self.first_token_timeout or None
+                )
+            except StopAsyncIteration:
+                self.router.succeeded(endpoint, time.monotonic() - started)
+                metrics.adopt(attempt)
+                return
+            except Exception as e:
+                await chunks.aclose()
+                if isinstance(e, asyncio.TimeoutError):
+                    e = FirstTokenTimeout(
+                        f"no first token within {self.first_token_timeout}s"
+                    )
+                self.router.failed(endpoint)
+                logger.warning(f"{endpoint.name} failed before the first token: {e}")
+                error = e
+                continue
+
+            self.router.succeeded(endpoint, time.monotonic() - started)
+            metrics.adopt(attempt)
+            yield first
+            try:
+                async for text in chunks:
+                    yield text
+            except Exception:
+                self.router.failed(endpoint, streaming=True)
+                raise
+            return
+        raise error
+
+    def summarize(self, summary, messages) -> str:
+        error = None
+        for endpoint in self.router.candidates():
+            try:
+                return self.chatbots[endpoint.name].summarize(summary, messages)
+            except Exception as e:
+                self.router.failed(endpoint)
+                error = e
+        raise error
+
+    def update_summary(self, message_history) -> bool:
+        return message_history.summarize_pending(self.summarize)
+
+    def preload(self) -> None:
+        for chatbot in self.chatbots.values():
+            chatbot.preload()
+
+
+# First chunk of a response without any.
+_END = object()
+
+
+def _first_chunk(chunks: Iterator[str]):
+    """The first chunk and the rest of the stream.
+
+    `ask_stream` returns once the first token arrived, so this does not wait.
+    Reading it starts the generator of the reply, which can then be closed.
+    """
+    chunks = iter(chunks)
+    return next(chunks, _END), chunks
+
+
+def _close(chunks) -> None:
+    close = getattr(chunks, "close", None)
+    if close is not None:
+        close()
+
+
+def _close_abandoned(future) -> None:
+    """Close the stream of a call abandoned after the first token timeout."""
+    if future.exception() is None:
+        _close(future.result()[1])
+
+
+def endpoint_chatbot(
+    endpoint: Endpoint, client_kwargs: Optional[dict] = None, **chatbot_kwargs
+):
+    """`Chatbot` of `endpoint` with the shared bedrock-runtime client of its region.
+
+    :param client_kwargs: passed to `get_bedrock_runtime_client`
+    :param chatbot_kwargs: passed to `Chatbot`
+    """
+    from .bedrock_chatbot import Chatbot
+    from .clients import get_bedrock_runtime_client
+
+    return Chatbot(
+        endpoint.model_id,
+        client=get_bedrock_runtime_client(
+            region_name=endpoint.region_name, **(client_kwargs or {})
+        ),
+        **chatbot_kwargs,
+    )
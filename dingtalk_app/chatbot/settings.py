@@ -2,13 +2,24 @@
 #  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
 
 import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, List, Mapping, Optional, Tuple
 
 import boto3
 
 from botocore.exceptions import ClientError
 
+logger = logging.getLogger(__name__)
 
-def load_dingtalk_app_setting(secret_name: str, region_name: str) -> tuple:
+# Set by the task definition from the secret, or by hand for offline runs.
+APP_KEY_VARIABLE = "DINGTALK_APP_KEY"
+APP_SECRET_VARIABLE = "DINGTALK_APP_SECRET"
+
+
+def load_dingtalk_app_setting(secret_name: str, region_name: str, client=None) -> tuple:
     """
     load Dingtalk app secret and Key from secret manager
 
@@ -17,12 +28,14 @@ def load_dingtalk_app_setting(secret_name: str, region_name: str) -> tuple:
     # https://aws.amazon.com/developer/language/python/
     :param secret_name: secret name in secrets manager
     :param region_name: secret manager region name
+    :param client: secretsmanager client, a new one by default
 
     :return: (AppKey, AppSecret)
     """
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(service_name="secretsmanager", region_name=region_name)
+    if client is None:
+        # Create a Secrets Manager client
+        session = boto3.session.Session()
+        client = session.client(service_name="secretsmanager", region_name=region_name)
 
     try:
         get_secret_value_response = client.get_secret_value(SecretId=secret_name)
@@ -36,3 +49,153 @@ def load_dingtalk_app_setting(secret_name: str, region_name: str) -> tuple:
     json_secret = json.loads(secret)
 
     return json_secret["AppKey"], json_secret["AppSecret"]
+
+
+def load_dingtalk_app_setting_file(path: str) -> tuple:
+    """(AppKey, AppSecret) of a JSON file shaped like the secret."""
+    with open(path, encoding="utf-8") as file:
+        json_secret = json.load(file)
+    return json_secret["AppKey"], json_secret["AppSecret"]
+
+
+class DingTalkCredentialProvider:
+    """
+    AppKey and AppSecret of the DingTalk app, cached and refreshed in the background.
+
+    The first credentials come from the environment (`DINGTALK_APP_KEY` and
+    `DINGTALK_APP_SECRET`, which the task definition sets from the secret),
+    else from `fallback_file`, else from Secrets Manager, so that a task only
+    waits for Secrets Manager when neither is available. Every `ttl_seconds`
+    the secret is read again in the background; when it was rotated the
+    listeners are called with the new credentials. A failed refresh keeps the
+    current credentials and is retried after `retry_seconds`.
+
+    :param secret_name: secret with the AppKey and AppSecret fields, None to
+        only use the environment or the file
+    :param region_name: region of the secret
+    :param ttl_seconds: lifetime of the cached credentials, 0 to never refresh
+    :param fallback_file: JSON file with the AppKey and AppSecret fields, for
+        offline runs or when Secrets Manager cannot be reached
+    :param environ: where to look for the variables, `os.environ` by default
+    :param loader: reads the secret, `load_dingtalk_app_setting` by default
+    """
+
+    def __init__(
+        self,
+        secret_name: Optional[str],
+        region_name: Optional[str] = None,
+        ttl_seconds: float = 3600,
+        retry_seconds: float = 60,
+        fallback_file: Optional[str] = None,
+        environ: Optional[Mapping[str, str]] = None,
+        loader: Optional[Callable[[str, str], Tuple[str, str]]] = None,
+    ):
+        self.secret_name = secret_name
+        self.region_name = region_name
+        self.ttl_seconds = ttl_seconds
+        self.retry_seconds = retry_seconds
+        self.fallback_file = fallback_file
+        self.environ = os.environ if environ is None else environ
+        self.loader = loader or load_dingtalk_app_setting
+        self.credentials: Optional[Tuple[str, str]] = None
+        self.source: Optional[str] = None
+        # Monotonic time after which the secret is read again.
+        self.expires_at = 0.0
+        self.listeners: List[Callable[[Tuple[str, str]], None]] = []
+        self.rotations = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def get(self) -> Tuple[str, str]:
+        """The current (AppKey, AppSecret), loaded on the first call."""
+        with self._lock:
+            if self.credentials is None:
+                self.credentials, self.source = self._initial()
+                self.expires_at = time.monotonic() + (
+                    # Checked soon for a newer version of the secret.
+                    self.retry_seconds
+                    if self.source != "secretsmanager"
+                    else self.ttl_seconds
+                )
+            return self.credentials
+
+    def _initial(self) -> Tuple[Tuple[str, str], str]:
+        app_key = self.environ.get(APP_KEY_VARIABLE)
+        app_secret = self.environ.get(APP_SECRET_VARIABLE)
+        if app_key and app_secret:
+            return (app_key, app_secret), "environment"
+        if self.secret_name:
+            try:
+                return self.loader(self.secret_name, self.region_name), "secretsmanager"
+            except Exception:
+                if not self.fallback_file:
+                    raise
+                logger.warning(
+                    f"secret {self.secret_name} could not be read, "
+                    f"using {self.fallback_file}",
+                    exc_info=True,
+                )
+        if self.fallback_file:
+            return load_dingtalk_app_setting_file(self.fallback_file), "file"
+        raise ValueError(
+            f"no DingTalk credentials: set {APP_KEY_VARIABLE} and "
+            f"{APP_SECRET_VARIABLE}, a secret name or a fallback file"
+        )
+
+    def subscribe(self, listener: Callable[[Tuple[str, str]], None]) -> None:
+        """Call `listener` with the new credentials after each rotation."""
+        self.listeners.append(listener)
+
+    def refresh(self) -> bool:
+        """Read the secret again, True if the credentials changed."""
+        if not self.secret_name:
+            return False
+        self.get()
+        try:
+            credentials = self.loader(self.secret_name, self.region_name)
+        except Exception as e:
+            logger.warning(f"refreshing secret {self.secret_name} failed: {e}")
+            with self._lock:
+                self.expires_at = time.monotonic() + self.retry_seconds
+            return False
+        with self._lock:
+            self.expires_at = time.monotonic() + self.ttl_seconds
+            if credentials == self.credentials:
+                return False
+            self.credentials, self.source = credentials, "secretsmanager"
+            self.rotations += 1
+        logger.info(f"DingTalk credentials of {self.secret_name} rotated")
+        for listener in self.listeners:
+            try:
+                listener(credentials)
+            except Exception:
+                logger.exception("applying rotated DingTalk credentials failed")
+        return True
+
+    def start(self) -> None:
+        """Refresh the credentials in a daemon thread once they expire."""
+        if not self.secret_name or not self.ttl_seconds or self._thread is not None:
+            return
+        self.get()
+        self._thread = threading.Thread(
+            target=self._run, name="credential-refresh", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(max(self.expires_at - time.monotonic(), 0)):
+            self.refresh()
+
+
+def update_stream_credential(client, credentials: Tuple[str, str]) -> None:
+    """Use rotated credentials in a running `DingTalkStreamClient`.
+
+    The open connection stays up; the next connection and the next access
+    token of the card API use the new credentials.
+    """
+    client.credential.client_id, client.credential.client_secret = credentials
+    client.reset_access_token()
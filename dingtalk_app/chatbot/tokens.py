@@ -0,0 +1,60 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import re
+from typing import List, Sequence
+
+from langchain_core.messages import BaseMessage
+
+# Stored next to each serialized message in DynamoDB, and in
+# `additional_kwargs` of messages read back, so it is estimated only once.
+TOKEN_COUNT_KEY = "token_count"
+
+# Role prefix and separators added around each message in the prompt.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# CJK, kana, hangul and full-width forms are roughly one token per character.
+_WIDE_CHARACTERS = re.compile("[\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of `text` without a tokenizer.
+
+    Counts one token per CJK character and one per four other characters, which
+    is close to the Claude tokenizers for Chinese and English chat text and
+    errs on the high side.
+    """
+    if not text:
+        return 0
+    wide = len(_WIDE_CHARACTERS.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def message_tokens(message: BaseMessage) -> int:
+    """Token count of a message in the prompt, using the stored count if any."""
+    count = message.additional_kwargs.get(TOKEN_COUNT_KEY)
+    if count is None:
+        content = message.content if isinstance(message.content, str) else ""
+        count = estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    return int(count)
+
+
+def select_history(messages: Sequence[BaseMessage], budget: int) -> List[BaseMessage]:
+    """Keep the newest messages that fit into `budget` tokens, oldest first.
+
+    Messages are taken newest-first until the next one would not fit. The
+    selection never starts with an AI message, so the model does not see an
+    answer without its question.
+    """
+    selected: List[BaseMessage] = []
+    used = 0
+    for message in reversed(messages):
+        used += message_tokens(message)
+        if used > budget:
+            break
+        selected.append(message)
+
+    while selected and selected[-1].type == "ai":
+        selected.pop()
+    selected.reverse()
+    return selected
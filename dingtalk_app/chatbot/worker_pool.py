@@ -0,0 +1,156 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+"""
+Worker pool and model call limits of the message handlers, with their gauges.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+
+class WorkerPool(ThreadPoolExecutor):
+    """`ThreadPoolExecutor` with a bounded queue for `try_submit` and gauges.
+
+    `submit` behaves as usual, so the pool can still run internal work with
+    `run_in_executor`; incoming messages go through `try_submit`, which refuses
+    work once as many of its tasks as there are workers are running and
+    `max_queue_size` more are waiting.
+
+    Args:
+        max_workers: number of worker threads.
+        max_queue_size: tasks that may wait for a worker, unbounded if None.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_queue_size: Optional[int] = None,
+        thread_name_prefix: str = "",
+    ):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.max_queue_size = max_queue_size
+        # One per task of `try_submit` until it is done, taken without waiting
+        # so that checking the bound and reserving a place are one step.
+        self._slots = (
+            threading.BoundedSemaphore(max_workers + max_queue_size)
+            if max_queue_size is not None
+            else None
+        )
+        self._gauge_lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        with self._gauge_lock:
+            self.queued += 1
+        try:
+            return super().submit(self._run, fn, *args, **kwargs)
+        except BaseException:
+            with self._gauge_lock:
+                self.queued -= 1
+            raise
+
+    def try_submit(self, fn: Callable, /, *args, **kwargs) -> Optional[Future]:
+        """Submit `fn` unless the queue is full, return None if it was refused."""
+        if self._slots is None:
+            return self.submit(fn, *args, **kwargs)
+        if not self._slots.acquire(blocking=False):
+            with self._gauge_lock:
+                self.rejected += 1
+            return None
+        try:
+            future = self.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _run(self, fn: Callable, *args, **kwargs):
+        with self._gauge_lock:
+            self.queued -= 1
+            self.active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._gauge_lock:
+                self.active -= 1
+                self.completed += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._gauge_lock:
+            return {
+                "workers": self._max_workers,
+                "active": self.active,
+                "queued": self.queued,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+
+class InflightLimiter:
+    """Limits how many model calls run at the same time.
+
+    Used as a context manager from worker threads, or as an async context
+    manager from the event loop; a limiter is meant for one of the two.
+
+    Args:
+        limit: maximum number of concurrent calls, unlimited if 0.
+    """
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.in_flight = 0
+        self.waiting = 0
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(limit) if limit else None
+        self._async_semaphore = None
+
+    def _count(self, in_flight: int = 0, waiting: int = 0) -> None:
+        with self._lock:
+            self.in_flight += in_flight
+            self.waiting += waiting
+
+    def __enter__(self):
+        self._count(waiting=1)
+        try:
+            if self._semaphore is not None:
+                self._semaphore.acquire()
+        finally:
+            self._count(waiting=-1)
+        self._count(in_flight=1)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._count(in_flight=-1)
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    async def __aenter__(self):
+        self._count(waiting=1)
+        try:
+            if self.limit:
+                if self._async_semaphore is None:
+                    self._async_semaphore = asyncio.Semaphore(self.limit)
+                await self._async_semaphore.acquire()
+        finally:
+            self._count(waiting=-1)
+        self._count(in_flight=1)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._count(in_flight=-1)
+        if self._async_semaphore is not None:
+            self._async_semaphore.release()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "model_calls_in_flight": self.in_flight,
+                "model_calls_waiting": self.waiting,
+            }
@@ -14,7 +14,7 @@ except ImportError:
 
 
 class DDB(Construct):
-    def __init__(self, scope, construct_id) -> None:
+    def __init__(self, scope, construct_id, storage_mode: str = "item") -> None:
         super().__init__(scope, f"{construct_id}DDBTable")
 
         # conversation table
@@ -29,7 +29,39 @@ class DDB(Construct):
             encryption=aws_dynamodb.TableEncryption.AWS_MANAGED,
             stream=aws_dynamodb.StreamViewType.NEW_IMAGE,
             point_in_time_recovery=True,
+            # Backups of reset conversations and idle conversations expire, see
+            # HISTORY_ARCHIVE_TTL_DAYS and HISTORY_IDLE_TTL_DAYS.
+            time_to_live_attribute="ExpiresAt",
         )
 
+        # One item per message, used when history_storage_mode is "message".
+        # The conversation table above is kept as the migration source, see
+        # dingtalk_app/chatbot/migration.py.
+        self.message_table = None
+        if storage_mode == "message":
+            self.message_table = aws_dynamodb.Table(
+                self,
+                "message_table",
+                table_name=f"{construct_id}_message_table",
+                partition_key=aws_dynamodb.Attribute(
+                    name="SessionId", type=aws_dynamodb.AttributeType.STRING
+                ),
+                sort_key=aws_dynamodb.Attribute(
+                    name="CreatedAt", type=aws_dynamodb.AttributeType.NUMBER
+                ),
+                billing_mode=aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+                encryption=aws_dynamodb.TableEncryption.AWS_MANAGED,
+                stream=aws_dynamodb.StreamViewType.NEW_IMAGE,
+                point_in_time_recovery=True,
+                time_to_live_attribute="ExpiresAt",
+            )
+
     def get_conversation_table(self):
         return self.conversation_table
+
+    def get_message_table(self):
+        return self.message_table
+
+    def get_history_table(self):
+        """The table the chatbot reads and writes conversation history in."""
+        return self.message_table or self.conversation_table
@@ -31,6 +31,19 @@ class ECSService(Construct):
         self.config_map = config_map
         self._create_ecs(construct_id, vpc, ddb_table)
 
+    def _bedrock_regions(self):
+        """Regions of the `model_id[@region][=weight]` endpoints in the config.
+
+        Endpoints without a region, and the model of `bedrock_model_id`, are
+        called in the region of the stack.
+        """
+        regions = [cdk.Aws.REGION]
+        for item in self.config_map.get("bedrock_endpoints", "").split(","):
+            region = item.partition("=")[0].partition("@")[2].strip()
+            if region and region not in regions:
+                regions.append(region)
+        return regions
+
     def _create_ecs(self, construct_id, vpc, ddb_table):
         secret = sm.Secret.from_secret_name_v2(
             self,
@@ -66,11 +79,23 @@ class ECSService(Construct):
                 ],
                 "DINGTALK_SETTING_REGION": os.environ.get("CDK_DEPLOY_REGION", os.environ["CDK_DEFAULT_REGION"]),
                 "DDB_TABLE_NAME": ddb_table.table_name,
+                "DDB_STORAGE_MODE": self.config_map.get("history_storage_mode", "item"),
+                "HANDLER_MODE": self.config_map.get("handler_mode", "thread"),
                 "BEDROCK_MODEL_ID": self.config_map["bedrock_model_id"],
+                "BEDROCK_ENDPOINTS": self.config_map.get("bedrock_endpoints", ""),
                 "INPUT_HISTORY_CONVERSATION_COUNT": self.config_map[
                     "input_history_conversation_count"
                 ],
             },
+            # Read by ECS when the task starts, so the app does not wait for
+            # Secrets Manager before connecting. Rotations are picked up by the
+            # app itself from the secret.
+            secrets={
+                "DINGTALK_APP_KEY": ecs.Secret.from_secrets_manager(secret, "AppKey"),
+                "DINGTALK_APP_SECRET": ecs.Secret.from_secrets_manager(
+                    secret, "AppSecret"
+                ),
+            },
         )
 
         service = ecs.FargateService(
@@ -93,8 +118,12 @@ class ECSService(Construct):
                     "bedrock:InvokeModelWithResponseStream",
                 ],
                 resources=[
-                    f"arn:{cdk.Aws.PARTITION}:bedrock:{cdk.Aws.REGION}::foundation-model/*",
-                    f"arn:{cdk.Aws.PARTITION}:bedrock:{cdk.Aws.REGION}:{cdk.Aws.ACCOUNT_ID}:guardrail/*",
+                    resource
+                    for region in self._bedrock_regions()
+                    for resource in (
+                        f"arn:{cdk.Aws.PARTITION}:bedrock:{region}::foundation-model/*",
+                        f"arn:{cdk.Aws.PARTITION}:bedrock:{region}:{cdk.Aws.ACCOUNT_ID}:guardrail/*",
+                    )
                 ],
             )
         )
@@ -25,9 +25,13 @@ class AppStack(Stack):
         super().__init__(scope, construct_id, **kwargs)
 
         vpc = VPC(self, construct_id)
-        ddb = DDB(self, construct_id)
+        ddb = DDB(
+            self,
+            construct_id,
+            storage_mode=config_map.get("history_storage_mode", "item"),
+        )
         ECSService(
-            self, construct_id, vpc.get_vpc(), ddb.get_conversation_table(), config_map
+            self, construct_id, vpc.get_vpc(), ddb.get_history_table(), config_map
         )
 
         enable_bedrock_log = config_map.get("enable_bedrock_log", False)
@@ -0,0 +1,149 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import asyncio
+import base64
+import binascii
+import json
+import struct
+
+import aiohttp
+import pytest
+from aiohttp import web
+from botocore.credentials import Credentials
+
+from dingtalk_app.chatbot.bedrock_async import AsyncBedrockClient, BedrockStreamError
+
+
+def event_message(headers: dict, payload: bytes) -> bytes:
+    """Encode an application/vnd.amazon.eventstream message."""
+    encoded_headers = b""
+    for name, value in headers.items():
+        name, value = name.encode(), value.encode()
+        encoded_headers += (
+            struct.pack("B", len(name))
+            + name
+            + b"\x07"
+            + struct.pack(">H", len(value))
+            + value
+        )
+    total_length = 16 + len(encoded_headers) + len(payload)
+    prelude = struct.pack(">II", total_length, len(encoded_headers))
+    prelude += struct.pack(">I", binascii.crc32(prelude))
+    message = prelude + encoded_headers + payload
+    return message + struct.pack(">I", binascii.crc32(message))
+
+
+def chunk_event(chunk: dict) -> bytes:
+    payload = json.dumps(
+        {"bytes": base64.b64encode(json.dumps(chunk).encode()).decode()}
+    )
+    return event_message(
+        {":message-type": "event", ":event-type": "chunk"}, payload.encode()
+    )
+
+
+async def stream_from(events, status=200, rejections=None, **client_kwargs):
+    """Stream `events`, after answering `rejections` requests (all if None) with `status`."""
+    requests = []
+
+    async def handler(request):
+        requests.append((request.path_qs, request.headers, await request.json()))
+        if status != 200 and (rejections is None or len(requests) <= rejections):
+            return web.json_response(
+                {"message": "Too many requests"},
+                status=status,
+                headers={"x-amzn-ErrorType": "ThrottlingException:http://internal"},
+            )
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for event in events:
+            # Split events across writes to exercise the buffering.
+            await response.write(event[:7])
+            await response.write(event[7:])
+        return response
+
+    app = web.Application()
+    app.router.add_post("/model/{model_id}/invoke-with-response-stream", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            client = AsyncBedrockClient(
+                session,
+                region_name="us-west-2",
+                endpoint_url=f"http://127.0.0.1:{port}",
+                credentials=Credentials("AKID", "SECRET"),
+                **client_kwargs,
+            )
+            chunks = [
+                chunk
+                async for chunk in client.invoke_model_with_response_stream(
+                    "anthropic.claude-v2:1", {"prompt": "hi"}
+                )
+            ]
+    finally:
+        await runner.cleanup()
+    return chunks, requests
+
+
+def test_streams_decoded_chunks():
+    chunks, requests = asyncio.run(
+        stream_from(
+            [chunk_event({"completion": "Hel"}), chunk_event({"completion": "lo"})]
+        )
+    )
+
+    assert chunks == [{"completion": "Hel"}, {"completion": "lo"}]
+    path, headers, body = requests[0]
+    assert path == "/model/anthropic.claude-v2%3A1/invoke-with-response-stream"
+    assert headers["Authorization"].startswith("AWS4-HMAC-SHA256 Credential=AKID/")
+    assert body == {"prompt": "hi"}
+
+
+def test_raises_exception_events():
+    exception = event_message(
+        {":message-type": "exception", ":exception-type": "throttlingException"},
+        b'{"message": "slow down"}',
+    )
+    with pytest.raises(BedrockStreamError, match="slow down") as error:
+        asyncio.run(stream_from([chunk_event({"completion": "a"}), exception]))
+
+    assert error.value.code == "throttlingException"
+
+
+def test_raises_rejected_requests():
+    with pytest.raises(BedrockStreamError) as error:
+        asyncio.run(stream_from([], status=429, max_attempts=1))
+
+    assert error.value.code == "ThrottlingException"
+    assert error.value.status == 429
+
+
+def test_retries_throttled_requests():
+    chunks, requests = asyncio.run(
+        stream_from(
+            [chunk_event({"completion": "ok"})],
+            status=429,
+            rejections=2,
+            backoff_base=0.01,
+        )
+    )
+
+    assert chunks == [{"completion": "ok"}]
+    assert len(requests) == 3
+
+
+def test_raises_after_the_last_attempt():
+    with pytest.raises(BedrockStreamError) as error:
+        asyncio.run(stream_from([], status=429, max_attempts=3, backoff_base=0.01))
+
+    assert error.value.status == 429
+
+
+def test_does_not_retry_client_errors():
+    with pytest.raises(BedrockStreamError):
+        asyncio.run(stream_from([], status=400, backoff_base=0.01))
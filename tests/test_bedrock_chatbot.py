@@ -1,8 +1,15 @@
 #  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
 #  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
 
-from dingtalk_app.chatbot.bedrock_chatbot import Chatbot
+import asyncio
+import json
+
+from dingtalk_app.chatbot.bedrock_chatbot import SYSTEM_TEMPLATE, Chatbot
 import pytest
+from unittest.mock import MagicMock
+from langchain.memory import ChatMessageHistory, ConversationBufferMemory
+from langchain_core.language_models import FakeStreamingListLLM
+from langchain_core.messages import AIMessage, HumanMessage
 
 
 @pytest.mark.parametrize(
@@ -72,3 +79,326 @@ def test_ask_stream_token_exception(model_id):
         chatbot.ask_stream("hello" * 10000000)
 
     print(exec_info)
+
+
+@pytest.fixture
+def fake_chatbot(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    chatbot = Chatbot("anthropic.claude-v2:1")
+    chatbot.engine = FakeStreamingListLLM(responses=["hello world"] * 3)
+    return chatbot
+
+
+def test_ask_stream_reuses_prompt_and_saves_turn(fake_chatbot):
+    prompt = fake_chatbot.prompt
+    memory = ConversationBufferMemory(
+        chat_memory=ChatMessageHistory(), return_messages=True
+    )
+
+    first = "".join(fake_chatbot.ask_stream("hi", conversation_history=memory))
+    second = "".join(fake_chatbot.ask_stream("again", conversation_history=memory))
+
+    assert first == second == "hello world"
+    assert fake_chatbot.prompt is prompt
+    assert [m.content for m in memory.chat_memory.messages] == [
+        "hi",
+        "hello world",
+        "again",
+        "hello world",
+    ]
+
+
+def test_ask_stream_formats_history_into_prompt(fake_chatbot):
+    memory = ConversationBufferMemory(
+        chat_memory=ChatMessageHistory(), return_messages=True
+    )
+    memory.chat_memory.add_user_message("my name is Ann")
+    memory.chat_memory.add_ai_message("hello Ann")
+
+    fake_chatbot.engine = MagicMock()
+    fake_chatbot.engine.stream.return_value = iter(["ok"])
+    list(fake_chatbot.ask_stream("what is my name", conversation_history=memory))
+
+    prompt = fake_chatbot.engine.stream.call_args.args[0]
+    assert "Human: my name is Ann\nAssistant: hello Ann" in prompt
+    assert prompt.endswith("Human: what is my name\nAssistant:")
+
+
+def test_ask_stream_without_history_does_not_share_state(fake_chatbot):
+    list(fake_chatbot.ask_stream("hi"))
+
+    fake_chatbot.engine = MagicMock()
+    fake_chatbot.engine.stream.return_value = iter(["ok"])
+    list(fake_chatbot.ask_stream("hi"))
+
+    assert "hello world" not in fake_chatbot.engine.stream.call_args.args[0]
+
+
+def test_ask_stream_trims_history_to_token_budget(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    chatbot = Chatbot("anthropic.claude-v2:1", history_token_budget=100)
+    chatbot.engine = MagicMock()
+    chatbot.engine.stream.return_value = iter(["ok"])
+    memory = ConversationBufferMemory(
+        chat_memory=ChatMessageHistory(), return_messages=True
+    )
+    memory.chat_memory.add_user_message("old question " * 100)
+    memory.chat_memory.add_ai_message("old answer")
+    memory.chat_memory.add_user_message("recent question")
+    memory.chat_memory.add_ai_message("recent answer")
+
+    list(chatbot.ask_stream("new question", conversation_history=memory))
+
+    prompt = chatbot.engine.stream.call_args.args[0]
+    assert "recent question" in prompt
+    assert "old question" not in prompt
+    assert "old answer" not in prompt
+
+
+class SummaryMessageHistory(ChatMessageHistory):
+    summary: str = ""
+
+
+def test_summary_replaces_dropped_turns_in_prompt(fake_chatbot):
+    chat_memory = SummaryMessageHistory(
+        summary="The human introduced themselves as Ann."
+    )
+    chat_memory.add_user_message("recent question")
+    memory = ConversationBufferMemory(chat_memory=chat_memory, return_messages=True)
+    fake_chatbot.engine = MagicMock()
+    fake_chatbot.engine.stream.return_value = iter(["ok"])
+
+    list(fake_chatbot.ask_stream("what is my name", conversation_history=memory))
+
+    prompt = fake_chatbot.engine.stream.call_args.args[0]
+    assert "The human introduced themselves as Ann.\nHuman: recent question" in prompt
+
+
+def test_summarize_uses_previous_summary(fake_chatbot):
+    fake_chatbot.engine = MagicMock()
+    fake_chatbot.engine.invoke.return_value = " new summary "
+
+    summary = fake_chatbot.summarize(
+        "old summary", [HumanMessage(content="hi"), AIMessage(content="hello")]
+    )
+
+    assert summary == "new summary"
+    prompt = fake_chatbot.engine.invoke.call_args.args[0]
+    assert "old summary" in prompt
+    assert "Human: hi\nAssistant: hello" in prompt
+
+
+class FakeBedrockClient:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.requests = []
+
+    async def invoke_model_with_response_stream(self, model_id, body):
+        self.requests.append((model_id, body))
+        for chunk in self.chunks:
+            yield chunk
+
+
+def test_ask_stream_async_streams_completion_chunks(fake_chatbot):
+    bedrock = FakeBedrockClient([{"completion": "hello"}, {"completion": " world"}])
+    history = [HumanMessage(content="earlier question"), AIMessage(content="answer")]
+
+    async def collect():
+        return [
+            text async for text in fake_chatbot.ask_stream_async(bedrock, "hi", history)
+        ]
+
+    assert asyncio.run(collect()) == ["hello", " world"]
+    model_id, body = bedrock.requests[0]
+    assert model_id == "anthropic.claude-v2:1"
+    assert "Human: earlier question" in body["prompt"]
+    assert body["prompt"].rstrip().endswith("Assistant:")
+    assert body["stop_sequences"] == ["\n\nHuman:"]
+    assert body["max_tokens_to_sample"] == 1024
+
+
+def test_request_body_uses_messages_api_for_claude_3(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    chatbot = Chatbot("anthropic.claude-3-haiku-20240307-v1:0")
+
+    body = chatbot.request_body("question", [HumanMessage(content="hi")])
+
+    assert body["anthropic_version"] == "bedrock-2023-05-31"
+    assert body["system"] == [{"type": "text", "text": SYSTEM_TEMPLATE}]
+    content = body["messages"][0]["content"]
+    assert content == [
+        {"type": "text", "text": "Current conversation:\n"},
+        {"type": "text", "text": "Human: hi\n"},
+        {"type": "text", "text": "Human: question\nAssistant:"},
+    ]
+    assert "stop_sequences" not in body
+    assert (
+        chatbot.chunk_text(
+            {
+                "type": "content_block_delta",
+                "delta": {"type": "text_delta", "text": "x"},
+            }
+        )
+        == "x"
+    )
+    assert chatbot.chunk_text({"type": "message_start", "message": {}}) == ""
+
+
+def test_prompt_caching_marks_the_summary(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    chatbot = Chatbot("anthropic.claude-3-5-haiku-20241022-v1:0", prompt_caching=True)
+    history = [HumanMessage(content="hi"), AIMessage(content="hello")]
+
+    body = chatbot.request_body("question", history, "summary")
+    # The window slid, the oldest turn left it.
+    next_body = chatbot.request_body(
+        "next question",
+        [HumanMessage(content="question"), AIMessage(content="answer")],
+        "summary",
+    )
+
+    content = body["messages"][0]["content"]
+    next_content = next_body["messages"][0]["content"]
+    assert [block["text"] for block in content] == [
+        "Current conversation:\nSummary of the earlier conversation:\nsummary\n",
+        "Human: hi\nAssistant: hello\n",
+        "Human: question\nAssistant:",
+    ]
+    assert [("cache_control" in block) for block in content] == [True, False, False]
+    # The next turn starts with the same blocks up to the checkpoint, so it reads
+    # them from the cache.
+    assert body["system"] == next_body["system"]
+    assert next_content[0] == content[0]
+
+
+def test_prompt_caching_is_only_sent_to_supporting_models(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    chatbot = Chatbot("anthropic.claude-3-haiku-20240307-v1:0", prompt_caching=True)
+
+    body = chatbot.request_body("question", [HumanMessage(content="hi")], "summary")
+
+    assert not chatbot.prompt_caching
+    assert "cache_control" not in json.dumps(body)
+
+
+def stream_event(chunk):
+    return {"chunk": {"bytes": json.dumps(chunk).encode()}}
+
+
+def test_claude_3_stream_records_cache_usage(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    chatbot = Chatbot("anthropic.claude-3-5-haiku-20241022-v1:0", prompt_caching=True)
+    chatbot.engine = MagicMock()
+    usage = {
+        "input_tokens": 12,
+        "cache_creation_input_tokens": 0,
+        "cache_read_input_tokens": 2048,
+    }
+    chatbot.engine.client.invoke_model_with_response_stream.return_value = {
+        "body": [
+            stream_event({"type": "message_start", "message": {"usage": usage}}),
+            stream_event({"type": "content_block_start", "index": 0}),
+            stream_event({"type": "content_block_delta", "delta": {"text": "Hello"}}),
+            stream_event({"type": "content_block_stop", "index": 0}),
+            stream_event({"type": "message_delta", "usage": {"output_tokens": 3}}),
+            stream_event({"type": "message_stop"}),
+        ]
+    }
+    memory = ConversationBufferMemory(
+        chat_memory=ChatMessageHistory(), return_messages=True
+    )
+
+    assert list(chatbot.ask_stream("hi", conversation_history=memory)) == ["Hello"]
+
+    request = chatbot.engine.client.invoke_model_with_response_stream.call_args.kwargs
+    assert request["modelId"] == "anthropic.claude-3-5-haiku-20241022-v1:0"
+    assert json.loads(request["body"])["messages"][0]["content"][0]["cache_control"]
+    assert chatbot.usage_totals == {**usage, "output_tokens": 3}
+    assert [message.content for message in memory.chat_memory.messages] == [
+        "hi",
+        "Hello",
+    ]
+
+
+def test_is_throttling_error():
+    from botocore.exceptions import ClientError
+    from dingtalk_app.chatbot.bedrock_async import BedrockStreamError
+    from dingtalk_app.chatbot.bedrock_chatbot import is_throttling_error
+
+    throttled = ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "slow down"}},
+        "InvokeModelWithResponseStream",
+    )
+    try:
+        try:
+            raise throttled
+        except ClientError as e:
+            raise ValueError(f"Error raised by bedrock service: {e}") from e
+    except ValueError as e:
+        wrapped = e
+
+    assert is_throttling_error(throttled)
+    assert is_throttling_error(wrapped)
+    assert is_throttling_error(BedrockStreamError("throttlingException", "slow down"))
+    assert not is_throttling_error(BedrockStreamError("ValidationException", "bad"))
+    assert not is_throttling_error(ValueError("Error raised by bedrock service"))
+
+
+def test_ask_stream_records_stage_timings(fake_chatbot):
+    from dingtalk_app.chatbot.metrics import TurnMetrics
+    from dingtalk_app.chatbot.tokens import estimate_tokens
+
+    memory = ConversationBufferMemory(
+        chat_memory=ChatMessageHistory(), return_messages=True
+    )
+    metrics = TurnMetrics()
+
+    response = fake_chatbot.ask_stream(
+        "hi", conversation_history=memory, metrics=metrics
+    )
+
+    assert "".join(response) == "hello world"
+    assert metrics.model_id == "anthropic.claude-v2:1"
+    assert set(metrics.values) >= {
+        "HistoryLoad",
+        "PromptBuild",
+        "TimeToFirstToken",
+        "Generation",
+        "OutputTokens",
+        "HistoryWrite",
+    }
+    assert metrics.values["OutputTokens"] == [estimate_tokens("hello world")]
+
+
+def test_engine_is_created_on_first_use(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    client = MagicMock()
+    chatbot = Chatbot("anthropic.claude-3-haiku-20240307-v1:0", client=client)
+
+    assert chatbot._engine is None
+
+    chatbot.preload()
+
+    assert type(chatbot.engine).__name__ == "BedrockChat"
+    assert chatbot.engine.client is client
+    assert chatbot.engine is chatbot.engine
+
+
+def test_closing_a_claude_3_reply_closes_its_event_stream(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    chatbot = Chatbot("anthropic.claude-3-haiku-20240307-v1:0")
+    chatbot.engine = MagicMock()
+    events = MagicMock()
+    events.__iter__.return_value = iter(
+        stream_event({"type": "content_block_delta", "delta": {"text": text}})
+        for text in ("Hello", " there")
+    )
+    chatbot.engine.client.invoke_model_with_response_stream.return_value = {
+        "body": events
+    }
+
+    chunks = chatbot.ask_stream("hi")
+    assert next(chunks) == "Hello"
+    chunks.close()
+
+    events.close.assert_called_once()
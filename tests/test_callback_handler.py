@@ -6,11 +6,24 @@ import os
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../dingtalk_app"))
 
+import asyncio
+import threading
+
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock
 
 from dingtalk_stream import CallbackMessage, ChatbotMessage, AckMessage, TextContent
-from dingtalk_app.app import CardBotHandler, WELCOME_MESSAGE
+from botocore.exceptions import ClientError
+from dingtalk_app.app import (
+    AsyncioCardBotHandler,
+    CardBotHandler,
+    ERROR_MESSAGE,
+    THROTTLED_MESSAGE,
+    WELCOME_MESSAGE,
+)
+from langchain.memory import ChatMessageHistory
+from chatbot.metrics import MetricsRecorder
+from chatbot.response_cache import ResponseCache
 
 
 # Mock for the callback message
@@ -75,4 +88,377 @@ def test_process_reset_command(mock_chatbot, callback_message, model_id):
     assert message == "OK"
 
 
+class FakeBedrockClient:
+    async def invoke_model_with_response_stream(self, model_id, body):
+        for text in ["Hello", " there"]:
+            yield {"completion": text}
+
+
+def test_asyncio_handler_streams_reply_and_saves_turn(monkeypatch, callback_message):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    handler = AsyncioCardBotHandler(
+        MagicMock(), "anthropic.claude-v1", max_concurrency=2, io_workers=2
+    )
+    # Skip creating the aiohttp clients.
+    handler.http_session = MagicMock()
+    handler.bedrock = FakeBedrockClient()
+    handler.replier = MagicMock()
+    handler.replier.reply_card = AsyncMock(return_value="card_biz_id")
+    handler.replier.update_card = AsyncMock(return_value={})
+    history = ChatMessageHistory()
+    monkeypatch.setattr(
+        handler, "message_history", lambda conversation_id, **kwargs: history
+    )
+    handler.metrics = MetricsRecorder(histograms=True)
+    callback_message.headers = MagicMock(message_id="test_message_id")
+
+    async def run():
+        ack = await handler.raw_process(callback_message)
+        # The message is acknowledged before the reply is sent.
+        assert handler.tasks
+        await asyncio.gather(*handler.tasks)
+        return ack
+
+    ack = asyncio.run(run())
+
+    assert ack.code == AckMessage.STATUS_OK
+    assert ack.headers.message_id == "test_message_id"
+    handler.replier.reply_card.assert_called_once()
+    last_card = (
+        handler.replier.update_card.call_args.args[1]
+        if handler.replier.update_card.called
+        else handler.replier.reply_card.call_args.args[0]
+    )
+    assert last_card["contents"][0]["text"] == "Hello there"
+    assert [message.content for message in history.messages] == ["hi", "Hello there"]
+    timings = handler.metrics.dump()["anthropic.claude-v1"]
+    for stage in [
+        "HistoryLoad",
+        "PromptBuild",
+        "TimeToFirstToken",
+        "Generation",
+        "CardReply",
+        "HistoryWrite",
+        "Total",
+    ]:
+        assert timings[stage]["count"] == 1
+
+
+class FailingBedrockClient:
+    async def invoke_model_with_response_stream(self, model_id, body):
+        raise ValueError("Error raised by bedrock service")
+        yield
+
+
+def test_asyncio_failed_model_call_replies_only_the_error(
+    monkeypatch, callback_message
+):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    handler = AsyncioCardBotHandler(
+        MagicMock(), "anthropic.claude-v1", max_concurrency=2, io_workers=2
+    )
+    handler.http_session = MagicMock()
+    handler.bedrock = FailingBedrockClient()
+    handler.replier = MagicMock()
+    handler.replier.reply_card = AsyncMock(return_value="card_biz_id")
+    handler.replier.reply_text = AsyncMock()
+    monkeypatch.setattr(
+        handler,
+        "message_history",
+        lambda conversation_id, **kwargs: ChatMessageHistory(),
+    )
+    callback_message.headers = MagicMock(message_id="test_message_id")
+
+    async def run():
+        await handler.raw_process(callback_message)
+        await asyncio.gather(*handler.tasks)
+
+    asyncio.run(run())
+
+    # No empty card in front of the error message.
+    handler.replier.reply_card.assert_not_called()
+    handler.replier.reply_text.assert_called_once()
+    assert handler.replier.reply_text.call_args.args[0] == ERROR_MESSAGE
+
+
+@pytest.mark.parametrize(
+    "error,expected_reply",
+    [
+        (
+            ValueError("Error raised by bedrock service"),
+            ERROR_MESSAGE,
+        ),
+        (
+            ClientError(
+                {"Error": {"Code": "ThrottlingException", "Message": "slow down"}},
+                "InvokeModelWithResponseStream",
+            ),
+            THROTTLED_MESSAGE,
+        ),
+    ],
+)
+def test_throttled_reply_asks_to_retry_later(
+    monkeypatch, callback_message, error, expected_reply
+):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    handler = CardBotHandler(MagicMock(), "anthropic.claude-v1")
+
+    def bedrock_reply_stream(input_text, incoming_message, conversation_id, **kwargs):
+        # LangChain wraps botocore errors into a ValueError.
+        try:
+            raise error
+        except Exception as e:
+            raise ValueError(f"Error raised by bedrock service: {e}")
+
+    monkeypatch.setattr(handler, "bedrock_reply_stream", bedrock_reply_stream)
+    with patch.object(handler, "reply_text") as mock_reply_text:
+        handler.process(callback_message)
+
+    assert mock_reply_text.call_args.args[0] == expected_reply
+
+
+def test_failed_model_call_replies_only_the_error(monkeypatch, callback_message):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    handler = CardBotHandler(MagicMock(), "anthropic.claude-v1")
+    monkeypatch.setattr(
+        handler,
+        "message_history",
+        lambda conversation_id, **kwargs: ChatMessageHistory(),
+    )
+    handler.chatbot = MagicMock()
+    handler.chatbot.ask_stream.side_effect = ValueError("Error raised by bedrock")
+
+    with patch.object(handler, "reply_card") as mock_reply_card, patch.object(
+        handler, "reply_text"
+    ) as mock_reply_text:
+        handler.process(callback_message)
+
+    # No empty card in front of the error message.
+    mock_reply_card.assert_not_called()
+    mock_reply_text.assert_called_once()
+    assert mock_reply_text.call_args.args[0] == ERROR_MESSAGE
+
+
+def test_full_queue_replies_overloaded(monkeypatch, callback_message):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    handler = CardBotHandler(
+        MagicMock(), "anthropic.claude-v1", max_workers=1, max_queue_size=0
+    )
+    callback_message.headers = MagicMock(message_id="test_message_id")
+    release = threading.Event()
+    started = threading.Event()
+    replied = threading.Event()
+
+    def process(callback):
+        started.set()
+        release.wait(5)
+
+    monkeypatch.setattr(handler, "process", process)
+    monkeypatch.setattr(handler, "reply_text", lambda text, message: replied.set())
+
+    async def run():
+        await handler.raw_process(callback_message)
+        started.wait(5)
+        return await handler.raw_process(callback_message)
+
+    ack = asyncio.run(run())
+    replied.wait(5)
+    release.set()
+
+    assert ack.code == AckMessage.STATUS_OK
+    assert replied.is_set()
+    assert handler.stats()["rejected"] == 1
+
+
+@pytest.mark.parametrize(
+    "policy,expected_turns",
+    [
+        ("queue", ["first", "second", "third"]),
+        ("coalesce", ["first", "second\nthird"]),
+    ],
+)
+def test_messages_of_a_busy_conversation_wait_for_the_turn(
+    monkeypatch, callback_message, policy, expected_turns
+):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    handler = CardBotHandler(MagicMock(), "anthropic.claude-v1")
+    handler.conversations.policy = policy
+    turns = []
+    first_turn_started = threading.Event()
+    release = threading.Event()
+
+    def bedrock_reply_stream(input_text, incoming_message, conversation_id, **kwargs):
+        turns.append(input_text)
+        first_turn_started.set()
+        release.wait(5)
+
+    monkeypatch.setattr(handler, "bedrock_reply_stream", bedrock_reply_stream)
+
+    def callback(text):
+        message = MagicMock()
+        message.headers = callback_message.headers
+        message.data = dict(callback_message.data, text={"content": text})
+        return message
+
+    owner = threading.Thread(target=handler.process, args=(callback("first"),))
+    owner.start()
+    first_turn_started.wait(5)
+    # Handled by the owner of the conversation, these return right away.
+    handler.process(callback("second"))
+    handler.process(callback("third"))
+    release.set()
+    owner.join(5)
+
+    assert turns == expected_turns
+    assert handler.conversations.stats()["busy_conversations"] == 0
+
+
+def test_messages_waiting_behind_a_failed_turn_get_the_error(
+    monkeypatch, callback_message
+):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    handler = CardBotHandler(MagicMock(), "anthropic.claude-v1")
+    first_turn_started = threading.Event()
+    release = threading.Event()
+
+    def handle_turn(messages, conversation_id):
+        first_turn_started.set()
+        release.wait(5)
+        raise RuntimeError("turn failed")
+
+    monkeypatch.setattr(handler, "handle_turn", handle_turn)
+
+    def callback(text):
+        message = MagicMock()
+        message.headers = callback_message.headers
+        message.data = dict(callback_message.data, text={"content": text})
+        return message
+
+    def process(callback):
+        with pytest.raises(RuntimeError):
+            handler.process(callback)
+
+    with patch.object(handler, "reply_text") as mock_reply_text:
+        owner = threading.Thread(target=process, args=(callback("first"),))
+        owner.start()
+        first_turn_started.wait(5)
+        handler.process(callback("second"))
+        handler.process(callback("third"))
+        release.set()
+        owner.join(5)
+
+    assert [
+        (text, message.text.content)
+        for (text, message), _ in mock_reply_text.call_args_list
+    ] == [(ERROR_MESSAGE, "second"), (ERROR_MESSAGE, "third")]
+    assert handler.conversations.stats()["busy_conversations"] == 0
+
+
+def test_cached_response_is_sent_without_invoking_the_model(
+    monkeypatch, callback_message
+):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    handler = CardBotHandler(MagicMock(), "anthropic.claude-v1")
+    handler.response_cache = ResponseCache()
+    histories = {}
+    monkeypatch.setattr(
+        handler,
+        "message_history",
+        lambda conversation_id, **kwargs: histories.setdefault(
+            conversation_id, ChatMessageHistory()
+        ),
+    )
+    cards = []
+    monkeypatch.setattr(
+        handler,
+        "reply_card",
+        lambda card, message, at_sender: cards.append(card["contents"][0]["text"])
+        or "card_biz_id",
+    )
+    handler.chatbot = MagicMock()
+    handler.chatbot.model_id = "anthropic.claude-v1"
+    handler.chatbot.prompt.template = "template"
+    handler.chatbot.ask_stream.return_value = iter(["The answer", "."])
+    incoming_message = ChatbotMessage.from_dict(callback_message.data)
+
+    handler.bedrock_reply_stream("What is the answer?", incoming_message, "c1")
+    handler.bedrock_reply_stream("what is the answer", incoming_message, "c2")
+
+    handler.chatbot.ask_stream.assert_called_once()
+    assert cards == ["The answer.", "The answer."]
+    # The cached turn is saved like a model turn.
+    assert [message.content for message in histories["c2"].messages] == [
+        "what is the answer",
+        "The answer.",
+    ]
+
+    handler.response_cache_bypass = {"c3"}
+    handler.chatbot.ask_stream.return_value = iter(["Fresh."])
+    handler.bedrock_reply_stream("What is the answer?", incoming_message, "c3")
+    assert handler.chatbot.ask_stream.call_count == 2
+
+
+def test_cached_response_is_not_shared_across_histories(monkeypatch, callback_message):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    handler = CardBotHandler(MagicMock(), "anthropic.claude-v1")
+    handler.response_cache = ResponseCache()
+    handler.response_cache_max_turns = 1
+    histories = {"c1": ChatMessageHistory(), "c2": ChatMessageHistory()}
+    histories["c1"].add_user_message("Let's talk about the VPN")
+    histories["c2"].add_user_message("Let's talk about the printer")
+    monkeypatch.setattr(
+        handler,
+        "message_history",
+        lambda conversation_id, **kwargs: histories[conversation_id],
+    )
+    monkeypatch.setattr(
+        handler, "reply_card", lambda card, message, at_sender: "card_biz_id"
+    )
+    handler.chatbot = MagicMock()
+    handler.chatbot.model_id = "anthropic.claude-v1"
+    handler.chatbot.prompt.template = "template"
+    handler.chatbot.ask_stream.side_effect = [iter(["Restart it."]), iter(["Fine."])]
+    incoming_message = ChatbotMessage.from_dict(callback_message.data)
+
+    handler.bedrock_reply_stream("How do I fix it?", incoming_message, "c1")
+    handler.bedrock_reply_stream("How do I fix it?", incoming_message, "c2")
+
+    assert handler.chatbot.ask_stream.call_count == 2
+    assert handler.response_cache.stats()["entries"] == 2
+    # The prompt is built from the history read for the cache scope.
+    assert handler.chatbot.ask_stream.call_args.kwargs["history"] == (
+        histories["c2"].messages
+    )
+
+    # Conversations longer than the limit skip the cache.
+    handler.response_cache_max_turns = 0
+    handler.chatbot.ask_stream.side_effect = [iter(["Fine."])]
+    handler.bedrock_reply_stream("How do I fix it?", incoming_message, "c2")
+    assert handler.response_cache.stats()["skipped"] == 1
+    assert handler.response_cache.stats()["entries"] == 2
+
+
 # More tests can be written for other parts of the CardBotHandler class and other functions.
+
+
+def test_summary_is_queued_once_and_only_when_the_window_overflows(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-west-2")
+    handler = CardBotHandler(MagicMock(), "anthropic.claude-v1")
+    handler.memory_mode = "summary"
+    handler.summary_executor = MagicMock()
+    history = MagicMock(session_id="c1", limited_item_count=4)
+
+    handler.submit_summary(history, 2)
+    handler.summary_executor.submit.assert_not_called()
+
+    handler.submit_summary(history, 4)
+    handler.submit_summary(history, 4)
+    handler.summary_executor.submit.assert_called_once_with(
+        handler.update_summary, history
+    )
+
+    # Once the update runs, the next overflowing turn queues another one.
+    handler.update_summary(history)
+    handler.submit_summary(history, 4)
+    assert handler.summary_executor.submit.call_count == 2
+    assert handler.archive_executor is not handler.summary_executor
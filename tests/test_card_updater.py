@@ -0,0 +1,207 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import asyncio
+import sys
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from unittest.mock import AsyncMock, MagicMock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../dingtalk_app"))
+from dingtalk_app.chatbot.card_updater import (
+    AsyncCardUpdater,
+    BackgroundCardUpdater,
+    CardUpdater,
+)
+from dingtalk_app.chatbot.templates import INTERACTIVE_CARD_JSON_SAMPLE
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_updater(clock, update_result=None, **kwargs):
+    texts = []
+    reply = MagicMock(
+        side_effect=lambda card: texts.append(card["contents"][0]["text"]) or "biz"
+    )
+    update = MagicMock(
+        side_effect=lambda biz_id, card: texts.append(card["contents"][0]["text"])
+        or (update_result() if update_result else {})
+    )
+    updater = CardUpdater(
+        deepcopy(INTERACTIVE_CARD_JSON_SAMPLE),
+        reply=reply,
+        update=update,
+        clock=clock,
+        sleep=clock.sleep,
+        **kwargs,
+    )
+    return updater, reply, update, texts
+
+
+def test_first_token_is_sent_immediately_then_coalesced():
+    clock = FakeClock()
+    updater, reply, update, texts = make_updater(
+        clock, min_interval=1.0, max_pending_chars=1000
+    )
+
+    updater.append("Hel")
+    for _ in range(10):
+        clock.now += 0.05
+        updater.append("lo")
+    clock.now += 0.6
+    updater.append("!")
+    updater.finish()
+
+    reply.assert_called_once()
+    assert texts == ["Hel", "Hel" + "lo" * 10 + "!"]
+
+
+def test_pending_chars_trigger_a_push():
+    clock = FakeClock()
+    updater, reply, update, texts = make_updater(
+        clock, min_interval=10.0, max_pending_chars=5
+    )
+
+    updater.append("a")
+    updater.append("bc")
+    updater.append("def")
+
+    assert texts == ["a", "abcdef"]
+
+
+def test_finish_without_text_sends_nothing():
+    clock = FakeClock()
+    updater, reply, update, texts = make_updater(clock)
+
+    # e.g. the model call failed before its first token.
+    updater.finish()
+
+    reply.assert_not_called()
+    update.assert_not_called()
+
+
+def test_backs_off_when_throttled_and_delivers_final_text():
+    clock = FakeClock()
+    results = iter([403, 403, {}])
+    updater, reply, update, texts = make_updater(
+        clock,
+        update_result=lambda: next(results),
+        min_interval=1.0,
+        max_pending_chars=1,
+        max_backoff=4.0,
+    )
+
+    updater.append("a")
+    updater.append("b")  # throttled, paused for 1s
+    updater.append("c")  # still paused
+    assert update.call_count == 1
+    clock.now += 1.0
+    updater.append("d")  # throttled again, paused for 2s
+    assert updater.backoff == 2.0
+    updater.finish()  # waits out the pause
+
+    assert update.call_count == 3
+    assert texts[-1] == "abcd"
+    assert updater.throttled == 2
+    assert updater.backoff == 0.0
+
+
+def test_background_updater_sends_latest_text_without_blocking():
+    pushed = []
+    released = threading.Event()
+
+    def update(biz_id, card):
+        released.wait(5)
+        pushed.append(card["contents"][0]["text"])
+        return {}
+
+    updater = CardUpdater(
+        deepcopy(INTERACTIVE_CARD_JSON_SAMPLE),
+        reply=lambda card: pushed.append(card["contents"][0]["text"]) or "biz",
+        update=update,
+        min_interval=0.0,
+    )
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        background = BackgroundCardUpdater(updater, executor)
+        background.append("a")
+        # The first update blocks, appends must not.
+        for text in "bcdef":
+            time.sleep(0.01)
+            background.append(text)
+        released.set()
+        background.finish(timeout=5)
+
+    assert pushed[0] == "a"
+    assert pushed[-1] == "abcdef"
+    # Intermediate texts are coalesced while an update is in flight.
+    assert len(pushed) < 6
+
+
+def test_background_updater_finish_without_text():
+    reply = MagicMock(return_value="biz")
+    updater = CardUpdater(
+        deepcopy(INTERACTIVE_CARD_JSON_SAMPLE), reply=reply, update=MagicMock()
+    )
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        BackgroundCardUpdater(updater, executor).finish(timeout=5)
+
+    reply.assert_not_called()
+
+
+def test_async_updater_pushes_latest_text_from_a_task():
+    pushed = []
+
+    async def reply(card):
+        pushed.append(card["contents"][0]["text"])
+        return "biz"
+
+    async def update(biz_id, card):
+        await asyncio.sleep(0.01)
+        pushed.append(card["contents"][0]["text"])
+        return {}
+
+    async def stream():
+        updater = AsyncCardUpdater(
+            deepcopy(INTERACTIVE_CARD_JSON_SAMPLE),
+            reply=reply,
+            update=update,
+            min_interval=0.0,
+        )
+        for text in "abcdef":
+            updater.append(text)
+            await asyncio.sleep(0.003)
+        await updater.finish()
+        return updater
+
+    updater = asyncio.run(stream())
+
+    assert pushed[0] == "a"
+    assert pushed[-1] == "abcdef"
+    assert len(pushed) < 6
+    assert updater.failures == 0
+
+
+def test_async_updater_finish_without_text_sends_nothing():
+    reply = AsyncMock(return_value="biz")
+
+    async def fail():
+        updater = AsyncCardUpdater(
+            deepcopy(INTERACTIVE_CARD_JSON_SAMPLE), reply=reply, update=AsyncMock()
+        )
+        await updater.finish()
+
+    asyncio.run(fail())
+
+    reply.assert_not_called()
@@ -0,0 +1,88 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import sys
+import os
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../dingtalk_app"))
+from dingtalk_app.chatbot import clients
+from dingtalk_app.chatbot.dynamodb import DynamoDBChatMessageHistory
+
+
+@pytest.fixture(autouse=True)
+def empty_registry():
+    clients.clear()
+    yield
+    clients.clear()
+
+
+@patch("boto3.session.Session")
+def test_histories_share_one_table(mock_session):
+    first = DynamoDBChatMessageHistory(table_name="table", session_id="a")
+    second = DynamoDBChatMessageHistory(table_name="table", session_id="b")
+
+    assert first.table is second.table
+    mock_session.assert_called_once()
+
+
+@patch("boto3.session.Session")
+def test_pool_size_is_passed_to_botocore(mock_session):
+    clients.get_dynamodb_table("table", max_pool_connections=32)
+
+    config = mock_session.return_value.resource.call_args.kwargs["config"]
+    assert config.max_pool_connections == 32
+
+
+@patch("boto3.session.Session")
+def test_tables_are_keyed_by_name_and_endpoint(mock_session):
+    mock_session.return_value.resource.return_value.Table.side_effect = (
+        lambda name: object()
+    )
+
+    table = clients.get_dynamodb_table("table")
+    assert clients.get_dynamodb_table("other") is not table
+    assert clients.get_dynamodb_table("table", endpoint_url="http://local") is not table
+    assert clients.get_dynamodb_table("table") is table
+
+
+def test_cached_creates_once_under_concurrency():
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return object()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(lambda _: clients.cached("key", factory), range(64))
+        )
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+
+
+@patch("boto3.session.Session")
+def test_bedrock_runtime_client_config(mock_session):
+    mock_session.return_value.client.side_effect = lambda *args, **kwargs: object()
+    client = clients.get_bedrock_runtime_client(
+        max_pool_connections=64, connect_timeout=2, read_timeout=30, max_attempts=4
+    )
+
+    config = mock_session.return_value.client.call_args.kwargs["config"]
+    assert mock_session.return_value.client.call_args.args == ("bedrock-runtime",)
+    assert config.max_pool_connections == 64
+    assert config.connect_timeout == 2
+    assert config.read_timeout == 30
+    assert config.retries == {"mode": "adaptive", "max_attempts": 4}
+    assert config.tcp_keepalive
+    assert clients.get_bedrock_runtime_client(max_pool_connections=64) is not client
+    assert (
+        clients.get_bedrock_runtime_client(
+            max_pool_connections=64, connect_timeout=2, read_timeout=30, max_attempts=4
+        )
+        is client
+    )
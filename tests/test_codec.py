@@ -0,0 +1,93 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import json
+import sys
+import os
+
+import pytest
+from boto3.dynamodb.types import Binary
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../dingtalk_app"))
+from dingtalk_app.chatbot.codec import decode_message, encode_message
+from dingtalk_app.chatbot.dynamodb import (
+    DynamoDBChatMessageHistory,
+    messages_from_items,
+    messages_to_items,
+)
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        HumanMessage(content="你好"),
+        AIMessage(content="hello " * 100, additional_kwargs={"model": "claude"}),
+        SystemMessage(content="", name="setup"),
+    ],
+)
+def test_round_trip(message):
+    (item,) = messages_to_items([message])
+
+    encoded = encode_message(item)
+
+    # As boto3 reads it back.
+    assert messages_from_items([decode_message(Binary(encoded))]) == (
+        messages_from_items([item])
+    )
+
+
+def test_long_messages_are_compressed():
+    (item,) = messages_to_items([AIMessage(content="the same words " * 50)])
+
+    encoded = encode_message(item)
+
+    assert encoded[:1] == b"\x02"
+    assert len(encoded) < len(json.dumps(item)) / 5
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError, match="unknown message encoding"):
+        decode_message(b"\x09{}")
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError, match="history_codec lz4 is not supported"):
+        DynamoDBChatMessageHistory(
+            table_name="t", session_id="s", boto3_session=object(), history_codec="lz4"
+        )
+
+
+def test_existing_history_is_read_after_switching_codec(session):
+    def history(codec):
+        return DynamoDBChatMessageHistory(
+            table_name="conversation_table",
+            session_id="conversation",
+            boto3_session=session,
+            history_codec=codec,
+        )
+
+    history("json").add_messages([HumanMessage(content="q1"), AIMessage(content="a1")])
+    history("zlib").add_messages([HumanMessage(content="q2"), AIMessage(content="a2")])
+
+    stored = history("json").table.get_item(Key={"SessionId": "conversation"})
+    assert [type(m).__name__ for m in stored["Item"]["History"]] == [
+        "dict",
+        "dict",
+        "Binary",
+        "Binary",
+    ]
+    messages = history("json").messages
+    assert [m.content for m in messages] == ["q1", "a1", "q2", "a2"]
+    assert all("token_count" in m.additional_kwargs for m in messages)
+
+
+def test_benchmark(capsys):
+    from benchmarks import history_codec
+
+    assert history_codec.main(["--turns=4", "--window=4"]) == 0
+
+    report = json.loads(capsys.readouterr().out)
+    compact = report["codecs"]["zlib"]
+    assert compact["stored_bytes"] < report["codecs"]["json"]["stored_bytes"]
+    assert compact["change_from_json"]["stored_bytes"] < 0
@@ -0,0 +1,126 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import sys
+import os
+from unittest.mock import MagicMock
+
+import pytest
+from langchain_core.messages import HumanMessage, messages_to_dict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../dingtalk_app"))
+from dingtalk_app.chatbot.compaction import (
+    COMPRESSED_HISTORY_ATTRIBUTE,
+    compact_histories,
+    decompress_history,
+    main,
+)
+from dingtalk_app.chatbot.dynamodb import EXPIRES_AT_ATTRIBUTE
+
+
+def history(count, size=100):
+    return messages_to_dict(
+        [HumanMessage(content=f"{i} " + "x" * size) for i in range(count)]
+    )
+
+
+def items(table):
+    return {i["SessionId"]: i for i in table.scan()["Items"]}
+
+
+def test_oversized_history_keeps_recent_messages(table):
+    table.put_item(
+        Item={
+            "SessionId": "long",
+            "History": history(30),
+            "Summary": "s0",
+            "SummarizedCount": 4,
+        }
+    )
+    table.put_item(Item={"SessionId": "short", "History": history(2)})
+    summarize = MagicMock(return_value="s1")
+
+    counts = compact_histories(
+        "conversation_table",
+        max_bytes=2000,
+        keep_messages=6,
+        summarize=summarize,
+        table=table,
+    )
+
+    assert counts["compacted"] == 1
+    assert counts["bytes_saved"] > 0
+    stored = items(table)
+    long = stored["long"]
+    assert [m["data"]["content"].split()[0] for m in long["History"]] == [
+        str(i) for i in range(24, 30)
+    ]
+    assert long["Summary"] == "s1"
+    assert long["SummarizedCount"] == 0
+    previous, messages = summarize.call_args.args
+    assert previous == "s0"
+    assert len(messages) == 20
+    (backup,) = [v for k, v in stored.items() if k.startswith("long#")]
+    assert len(decompress_history(backup[COMPRESSED_HISTORY_ATTRIBUTE])) == 24
+    assert EXPIRES_AT_ATTRIBUTE in backup
+    assert stored["short"]["History"] == history(2)
+
+
+def test_conversation_changed_during_compaction_leaves_no_backup(table):
+    table.put_item(Item={"SessionId": "long", "History": history(30)})
+
+    def summarize(summary, messages):
+        # A turn is appended while the moved messages are summarized.
+        table.update_item(
+            Key={"SessionId": "long"},
+            UpdateExpression="SET History = list_append(History, :messages)",
+            ExpressionAttributeValues={":messages": history(1)},
+        )
+        return "s1"
+
+    counts = compact_histories(
+        "conversation_table",
+        max_bytes=2000,
+        keep_messages=6,
+        summarize=summarize,
+        table=table,
+    )
+
+    assert counts["changed"] == 1
+    stored = items(table)
+    assert list(stored) == ["long"]
+    assert len(stored["long"]["History"]) == 31
+
+
+def test_old_items_get_an_expiry(table):
+    table.put_item(Item={"SessionId": "conversation#1", "History": history(2)})
+    table.put_item(Item={"SessionId": "idle", "History": history(2)})
+    table.put_item(Item={"SessionId": "active", "History": [], EXPIRES_AT_ATTRIBUTE: 1})
+
+    counts = compact_histories("conversation_table", idle_ttl_days=30, table=table)
+
+    assert counts["expiring"] == 2
+    stored = items(table)
+    assert (
+        stored["conversation#1"][EXPIRES_AT_ATTRIBUTE]
+        > stored["idle"][EXPIRES_AT_ATTRIBUTE]
+    )
+    assert stored["active"][EXPIRES_AT_ATTRIBUTE] == 1
+
+
+def test_dry_run_writes_nothing(table):
+    table.put_item(Item={"SessionId": "long", "History": history(30)})
+
+    counts = compact_histories(
+        "conversation_table", max_bytes=2000, keep_messages=6, dry_run=True, table=table
+    )
+
+    assert counts == {"scanned": 1, "compacted": 1}
+    assert items(table)["long"]["History"] == history(30)
+
+
+def test_cli_refuses_an_idle_ttl_the_service_does_not_keep(monkeypatch):
+    monkeypatch.delenv("HISTORY_IDLE_TTL_DAYS", raising=False)
+
+    with pytest.raises(SystemExit):
+        main(["--table", "conversation_table", "--idle-ttl-days", "30"])
@@ -0,0 +1,62 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import pytest
+
+from dingtalk_app.chatbot.conversations import (
+    QUEUED,
+    REJECTED,
+    STARTED,
+    ConversationRegistry,
+)
+
+
+def test_reject_policy_refuses_messages_of_a_busy_conversation():
+    registry = ConversationRegistry("reject")
+
+    assert registry.start("c1", "a") == STARTED
+    assert registry.start("c1", "b") == REJECTED
+    assert registry.start("c2", "c") == STARTED
+    assert registry.next("c1") == []
+    assert registry.start("c1", "d") == STARTED
+    assert registry.stats()["busy_rejected"] == 1
+
+
+def test_queue_policy_hands_messages_to_the_owner_one_by_one():
+    registry = ConversationRegistry("queue", max_pending=2)
+
+    assert registry.start("c1", "a") == STARTED
+    assert registry.start("c1", "b") == QUEUED
+    assert registry.start("c1", "c") == QUEUED
+    assert registry.start("c1", "d") == REJECTED
+    assert registry.stats()["pending_messages"] == 2
+
+    assert registry.next("c1") == ["b"]
+    assert registry.next("c1") == ["c"]
+    assert registry.next("c1") == []
+    assert registry.stats()["busy_conversations"] == 0
+
+
+def test_coalesce_policy_hands_all_waiting_messages_at_once():
+    registry = ConversationRegistry("coalesce")
+
+    registry.start("c1", "a")
+    registry.start("c1", "b")
+    registry.start("c1", "c")
+
+    assert registry.next("c1") == ["b", "c"]
+    assert registry.next("c1") == []
+
+
+def test_release_drops_waiting_messages():
+    registry = ConversationRegistry("queue")
+    registry.start("c1", "a")
+    registry.start("c1", "b")
+
+    assert registry.release("c1") == ["b"]
+    assert registry.start("c1", "c") == STARTED
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        ConversationRegistry("drop")
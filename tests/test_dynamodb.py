@@ -6,11 +6,20 @@ import sys
 import os
 from unittest.mock import patch, MagicMock
 from langchain_core.messages import (
+    AIMessage,
     BaseMessage,
+    HumanMessage,
+    message_to_dict,
+    messages_to_dict,
 )
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../dingtalk_app"))
-from dingtalk_app.chatbot.dynamodb import DynamoDBChatMessageHistory
+from dingtalk_app.chatbot.codec import decode_messages
+from dingtalk_app.chatbot.dynamodb import (
+    DynamoDBChatMessageHistory,
+    EXPIRES_AT_ATTRIBUTE,
+    HEAD_SORT_KEY,
+)
 
 
 @pytest.mark.parametrize(
@@ -41,3 +50,371 @@ def test_dynamodb(table_name, conversation_id, limited_item_count):
 
     message: BaseMessage = BaseMessage(content="Hello?", type="human")
     ddb_history.add_message(message)
+
+
+def message_history(limited_item_count=2, **kwargs):
+    session = MagicMock()
+    return DynamoDBChatMessageHistory(
+        table_name="message_table",
+        session_id="conversation",
+        limited_item_count=limited_item_count,
+        boto3_session=session,
+        storage_mode="message",
+        **kwargs,
+    )
+
+
+def test_message_mode_reads_window_with_reverse_query():
+    history = message_history()
+    history.table.query.return_value = {
+        "Items": [
+            {
+                "SessionId": "conversation",
+                "CreatedAt": 2,
+                "Message": message_to_dict(AIMessage(content="b")),
+            },
+            {
+                "SessionId": "conversation",
+                "CreatedAt": 1,
+                "Message": message_to_dict(HumanMessage(content="a")),
+            },
+        ]
+    }
+
+    messages = history.messages
+
+    assert [m.content for m in messages] == ["a", "b"]
+    query_kwargs = history.table.query.call_args.kwargs
+    assert query_kwargs["ScanIndexForward"] is False
+    # One more for the head item.
+    assert query_kwargs["Limit"] == 3
+    history.table.get_item.assert_not_called()
+
+
+def test_message_mode_add_message_writes_one_item():
+    history = message_history()
+
+    history.add_message(HumanMessage(content="first"))
+    history.add_message(AIMessage(content="second"))
+
+    first, second = [c.kwargs["Item"] for c in history.table.put_item.call_args_list]
+    assert first["SessionId"] == "conversation"
+    assert first["Message"]["data"]["content"] == "first"
+    assert second["CreatedAt"] > first["CreatedAt"]
+    history.table.get_item.assert_not_called()
+    history.table.query.assert_not_called()
+
+
+def test_unknown_storage_mode():
+    with pytest.raises(ValueError, match="storage_mode table is not supported"):
+        DynamoDBChatMessageHistory(
+            table_name="t",
+            session_id="s",
+            boto3_session=MagicMock(),
+            storage_mode="table",
+        )
+
+
+def test_add_messages_appends_atomically():
+    history = DynamoDBChatMessageHistory(
+        table_name="conversation_table",
+        session_id="conversation",
+        boto3_session=MagicMock(),
+    )
+
+    history.add_messages([HumanMessage(content="hi"), AIMessage(content="hello")])
+
+    history.table.get_item.assert_not_called()
+    history.table.put_item.assert_not_called()
+    update_kwargs = history.table.update_item.call_args.kwargs
+    assert update_kwargs["Key"] == {"SessionId": "conversation"}
+    assert "list_append(if_not_exists(History, :empty), :messages)" in (
+        update_kwargs["UpdateExpression"]
+    )
+    appended = update_kwargs["ExpressionAttributeValues"][":messages"]
+    assert [m["data"]["content"] for m in appended] == ["hi", "hello"]
+
+
+def test_message_mode_add_messages_uses_one_batch():
+    history = message_history()
+    batch = history.table.batch_writer.return_value.__enter__.return_value
+
+    history.add_messages([HumanMessage(content="hi"), AIMessage(content="hello")])
+
+    assert batch.put_item.call_count == 2
+    history.table.put_item.assert_not_called()
+
+
+def summary_history(**kwargs):
+    return DynamoDBChatMessageHistory(
+        table_name="conversation_table",
+        session_id="conversation",
+        limited_item_count=2,
+        boto3_session=MagicMock(),
+        memory_mode="summary",
+        **kwargs,
+    )
+
+
+def test_summary_is_loaded_with_messages():
+    history = summary_history()
+    history.table.get_item.return_value = {
+        "Item": {
+            "History": messages_to_dict([HumanMessage(content="a")]),
+            "Summary": "earlier",
+        }
+    }
+
+    history.messages
+
+    assert history.summary == "earlier"
+
+
+def test_summarize_pending_folds_messages_out_of_window():
+    history = summary_history()
+    stored = messages_to_dict(
+        [HumanMessage(content=c) for c in ["q1", "a1", "q2", "a2", "q3", "a3"]]
+    )
+    history.table.get_item.return_value = {
+        "Item": {"History": stored, "Summary": "s0", "SummarizedCount": 2}
+    }
+    summarize = MagicMock(return_value="s1")
+
+    assert history.summarize_pending(summarize)
+
+    previous, messages = summarize.call_args.args
+    assert previous == "s0"
+    assert [m.content for m in messages] == ["q2", "a2"]
+    update_kwargs = history.table.update_item.call_args.kwargs
+    assert update_kwargs["ExpressionAttributeValues"] == {
+        ":summary": "s1",
+        ":start": 2,
+        ":end": 4,
+    }
+    assert "SummarizedCount = :start" in update_kwargs["ConditionExpression"]
+    assert history.summary == "s1"
+
+
+def test_encrypted_add_messages_keeps_the_summary():
+    history = summary_history()
+    # EncryptedTable only supports get_item and put_item.
+    history.encrypted = True
+    stored = messages_to_dict([HumanMessage(content="q1"), AIMessage(content="a1")])
+    history.table.get_item.return_value = {
+        "Item": {
+            "SessionId": "conversation",
+            "History": stored,
+            "Summary": "s0",
+            "SummarizedCount": 2,
+        }
+    }
+
+    history.add_messages([HumanMessage(content="q2")])
+
+    item = history.table.put_item.call_args.kwargs["Item"]
+    assert [m["data"]["content"] for m in item["History"]] == ["q1", "a1", "q2"]
+    assert item["Summary"] == "s0"
+    assert item["SummarizedCount"] == 2
+    history.table.update_item.assert_not_called()
+
+
+def test_summarize_pending_without_dropped_messages():
+    history = summary_history()
+    history.table.get_item.return_value = {
+        "Item": {"History": messages_to_dict([HumanMessage(content="q1")])}
+    }
+    summarize = MagicMock()
+
+    assert not history.summarize_pending(summarize)
+    summarize.assert_not_called()
+    history.table.update_item.assert_not_called()
+
+
+def test_message_mode_reads_summary_from_head_item():
+    history = message_history(memory_mode="summary")
+    history.table.query.return_value = {
+        "Items": [
+            {"SessionId": "conversation", "CreatedAt": HEAD_SORT_KEY, "Summary": "s"},
+            {
+                "SessionId": "conversation",
+                "CreatedAt": 1,
+                "Message": message_to_dict(HumanMessage(content="a")),
+            },
+        ]
+    }
+
+    assert [m.content for m in history.messages] == ["a"]
+    assert history.summary == "s"
+    assert history.table.query.call_args.kwargs["Limit"] == 3
+
+
+def stored_history(session, storage_mode, **kwargs):
+    return DynamoDBChatMessageHistory(
+        table_name=f"{storage_mode}_table".replace("item_", "conversation_"),
+        session_id="conversation",
+        boto3_session=session,
+        storage_mode=storage_mode,
+        archive_ttl_days=90,
+        **kwargs,
+    )
+
+
+def backups(history):
+    items = history.table.scan()["Items"]
+    return [i for i in items if i["SessionId"].startswith("conversation#")]
+
+
+def test_clear_is_one_write_and_archives_in_background(session):
+    executor = MagicMock()
+    history = stored_history(session, "item", archive_executor=executor)
+    history.add_messages([HumanMessage(content="hi"), AIMessage(content="hello")])
+    history.table = MagicMock(wraps=history.table)
+
+    history.clear()
+
+    history.table.update_item.assert_called_once()
+    history.table.get_item.assert_not_called()
+    history.table.put_item.assert_not_called()
+    assert history.messages == []
+    assert backups(history) == []
+
+    # The archive runs in the executor, after the reset.
+    executor.submit.assert_called_once()
+    executor.submit.call_args.args[0](*executor.submit.call_args.args[1:])
+    (backup,) = backups(history)
+    assert [m["data"]["content"] for m in backup["History"]] == ["hi", "hello"]
+    assert backup[EXPIRES_AT_ATTRIBUTE] > 0
+
+
+def test_clear_of_an_empty_conversation_writes_nothing(session):
+    history = stored_history(session, "item")
+
+    history.clear()
+    history.add_message(HumanMessage(content="hi"))
+
+    assert [m.content for m in history.messages] == ["hi"]
+    assert backups(history) == []
+
+
+@pytest.mark.parametrize("memory_mode", ["window", "summary"])
+def test_message_mode_clear_hides_older_messages(session, memory_mode):
+    executor = MagicMock()
+    history = stored_history(
+        session,
+        "message",
+        limited_item_count=4,
+        memory_mode=memory_mode,
+        archive_executor=executor,
+    )
+    history.add_messages([HumanMessage(content="q1"), AIMessage(content="a1")])
+    history.table = MagicMock(wraps=history.table)
+
+    history.clear()
+
+    history.table.update_item.assert_called_once()
+    history.table.query.assert_not_called()
+    history.table.batch_writer.assert_not_called()
+    history.add_message(HumanMessage(content="q2"))
+    assert [m.content for m in history.messages] == ["q2"]
+    assert [m.content for m in history.all_messages] == ["q2"]
+    assert history.summary == ""
+
+    executor.submit.call_args.args[0](*executor.submit.call_args.args[1:])
+    archived = backups(history)
+    assert [i["Message"]["data"]["content"] for i in archived] == ["q1", "a1"]
+    assert all(EXPIRES_AT_ATTRIBUTE in i for i in archived)
+    assert [m.content for m in history.all_messages] == ["q2"]
+
+
+def test_message_mode_head_item_expires(session):
+    history = stored_history(
+        session,
+        "message",
+        limited_item_count=2,
+        memory_mode="summary",
+        idle_ttl_days=30,
+        archive_executor=MagicMock(),
+    )
+    history.add_messages([HumanMessage(content="q1"), AIMessage(content="a1")])
+    history.add_messages([HumanMessage(content="q2"), AIMessage(content="a2")])
+
+    def head():
+        return history.table.get_item(Key=history._head_key())["Item"]
+
+    with patch("time.time", return_value=1_000_000):
+        assert history.summarize_pending(lambda summary, messages: "s1")
+    assert head()[EXPIRES_AT_ATTRIBUTE] == 1_000_000 + 30 * 86400
+
+    with patch("time.time", return_value=2_000_000):
+        history.clear()
+    assert head()[EXPIRES_AT_ATTRIBUTE] == 2_000_000 + 30 * 86400
+
+
+def test_idle_ttl_is_pushed_back_by_every_write(session):
+    for storage_mode in ("item", "message"):
+        history = stored_history(session, storage_mode, idle_ttl_days=30)
+
+        with patch("time.time", return_value=1_000_000):
+            history.add_message(HumanMessage(content="hi"))
+
+        # With the head item in the "message" layout.
+        items = history.table.scan()["Items"]
+        assert {i[EXPIRES_AT_ATTRIBUTE] for i in items} == {1_000_000 + 30 * 86400}
+
+
+def expire(table, now):
+    """Delete the items whose TTL passed, as DynamoDB would."""
+    for item in table.scan()["Items"]:
+        if item.get(EXPIRES_AT_ATTRIBUTE, now + 1) <= now:
+            table.delete_item(
+                Key={"SessionId": item["SessionId"], "CreatedAt": item["CreatedAt"]}
+            )
+
+
+def test_message_mode_active_conversation_outlives_the_idle_ttl(session):
+    day = 86400
+    history = stored_history(
+        session,
+        "message",
+        limited_item_count=4,
+        memory_mode="summary",
+        idle_ttl_days=1,
+        archive_executor=MagicMock(),
+    )
+
+    with patch("time.time", return_value=1_000_000):
+        history.add_messages([HumanMessage(content="q0"), AIMessage(content="a0")])
+        history.clear()
+        for turn in ("1", "2", "3"):
+            history.add_messages(
+                [HumanMessage(content=f"q{turn}"), AIMessage(content=f"a{turn}")]
+            )
+        assert history.summarize_pending(lambda summary, messages: "s")
+    with patch("time.time", return_value=1_000_000 + 0.6 * day):
+        history.add_messages([HumanMessage(content="q4"), AIMessage(content="a4")])
+
+    # Everything but the last turn was written more than a day ago.
+    expire(history.table, 1_000_000 + 1.2 * day)
+
+    assert [m.content for m in history.messages] == ["q3", "a3", "q4", "a4"]
+    assert history.summary == "s"
+
+    # Idle for a day.
+    expire(history.table, 1_000_000 + 1.9 * day)
+
+    assert history.table.scan()["Items"] == []
+
+
+def test_item_mode_decodes_only_the_window(session):
+    history = stored_history(session, "item", limited_item_count=2)
+    history.add_messages([HumanMessage(content=f"q{i}") for i in range(5)])
+    decoded = []
+
+    def decode(values):
+        decoded.append(len(values))
+        return decode_messages(values)
+
+    with patch("dingtalk_app.chatbot.dynamodb.decode_messages", decode):
+        assert [m.content for m in history.messages] == ["q3", "q4"]
+
+    assert decoded == [2]
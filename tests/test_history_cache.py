@@ -0,0 +1,93 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import sys
+import os
+from unittest.mock import patch, MagicMock
+
+from langchain_core.messages import AIMessage, HumanMessage, messages_to_dict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../dingtalk_app"))
+from dingtalk_app.chatbot.dynamodb import DynamoDBChatMessageHistory
+from dingtalk_app.chatbot.history_cache import HistoryCache
+
+
+def history_with_cache(cache, limited_item_count=2):
+    return DynamoDBChatMessageHistory(
+        table_name="conversation_table",
+        session_id="conversation",
+        limited_item_count=limited_item_count,
+        boto3_session=MagicMock(),
+        cache=cache,
+    )
+
+
+def stored(*contents):
+    return messages_to_dict([HumanMessage(content=c) for c in contents])
+
+
+def test_follow_up_turn_is_served_from_cache():
+    cache = HistoryCache()
+    history = history_with_cache(cache)
+    history.table.get_item.return_value = {"Item": {"History": stored("a", "b", "c")}}
+
+    assert [m.content for m in history.messages] == ["b", "c"]
+    history.add_messages([HumanMessage(content="d"), AIMessage(content="e")])
+    assert [m.content for m in history.messages] == ["d", "e"]
+
+    history.table.get_item.assert_called_once()
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_clear_invalidates():
+    cache = HistoryCache()
+    history = history_with_cache(cache)
+    history.table.get_item.return_value = {"Item": {"History": stored("a")}}
+    history.messages
+
+    history.clear()
+
+    assert cache.get("conversation") is None
+
+
+def test_write_to_uncached_session_is_not_cached():
+    cache = HistoryCache()
+    cache.append("conversation", stored("a"))
+
+    assert cache.get("conversation") is None
+
+
+def test_ttl_expiry():
+    cache = HistoryCache(ttl_seconds=10)
+    with patch("time.monotonic", return_value=100):
+        cache.put("conversation", stored("a"), complete=True)
+    with patch("time.monotonic", return_value=111):
+        assert cache.get("conversation") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_partial_entry_only_serves_shorter_windows():
+    cache = HistoryCache()
+    cache.put("conversation", stored("a", "b"), complete=False)
+
+    assert cache.get("conversation", limit=4) is None
+    assert [m["data"]["content"] for m in cache.get("conversation", limit=1)] == ["b"]
+
+
+def test_lru_eviction_by_count_and_bytes():
+    cache = HistoryCache(max_entries=2)
+    cache.put("a", stored("a"), complete=True)
+    cache.put("b", stored("b"), complete=True)
+    cache.get("a")
+    cache.put("c", stored("c"), complete=True)
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.stats()["evictions"] == 1
+
+    small = HistoryCache(max_bytes=500)
+    small.put("a", stored("x" * 50), complete=True)
+    small.put("b", stored("y" * 50), complete=True)
+    assert small.stats()["entries"] == 1
+    assert small.stats()["bytes"] <= 500
@@ -0,0 +1,96 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import os
+from unittest.mock import patch
+
+import pytest
+
+from benchmarks.fakes import item_size, read_units, write_units
+from benchmarks.load_test import compare, parse_args, run
+
+
+def test_capacity_units():
+    item = {"SessionId": {"S": "abc"}, "History": {"L": [{"S": "x" * 2000}]}}
+
+    assert item_size(item) == 9 + 3 + 7 + 3 + 1 + 2000
+    assert read_units(item_size(item), consistent=False) == 0.5
+    assert read_units(5000, consistent=True) == 2
+    assert write_units(item_size(item)) == 2
+
+
+@pytest.mark.parametrize(
+    "handler,storage_mode", [("thread", "item"), ("asyncio", "message")]
+)
+def test_load_test_smoke(handler, storage_mode):
+    options = parse_args(
+        [
+            "--messages=12",
+            "--rate=200",
+            "--conversations=4",
+            f"--handler={handler}",
+            f"--storage-mode={storage_mode}",
+            "--history-turns=1",
+            "--time-to-first-token=0.01",
+            "--tokens-per-second=1000",
+            "--response-tokens=5",
+            "--dingtalk-latency=0",
+            "--timeout=30",
+        ]
+    )
+    with patch.dict(os.environ):
+        report = run(options)
+
+    assert report["answered"] == 12
+    assert report["unfinished"] == 0
+    assert report["model_calls"] >= report["turns"] > 0
+    assert report["cards"]["replies"] == report["turns"]
+    assert report["dynamodb"]["read_units_per_turn"] > 0
+    assert report["dynamodb"]["write_units_per_turn"] > 0
+    assert report["latency_ms"]["turn"]["p95"] is not None
+    assert compare(report, report, tolerance=0.2) == []
+
+
+def test_compare_reports_regressions():
+    baseline = {
+        "throughput_per_second": 10,
+        "latency_ms": {
+            kind: {"p50": 100, "p95": 200, "p99": 300}
+            for kind in ("first_card", "turn")
+        },
+        "cards": {"updates_per_turn": 2},
+        "dynamodb": {"read_units_per_turn": 1, "write_units_per_turn": 2},
+    }
+    report = {
+        **baseline,
+        "throughput_per_second": 7,
+        "dynamodb": {"read_units_per_turn": 1.1, "write_units_per_turn": 3},
+    }
+
+    assert compare(report, baseline, tolerance=0.2) == [
+        "throughput_per_second: 10 -> 7 (-30%)",
+        "dynamodb.write_units_per_turn: 2 -> 3 (+50%)",
+    ]
+
+
+def test_load_test_reports_the_response_cache_hit_rate():
+    options = parse_args(
+        [
+            "--messages=8",
+            "--rate=200",
+            "--conversations=8",
+            "--distinct-questions=1",
+            "--response-cache-ttl=60",
+            "--time-to-first-token=0.01",
+            "--tokens-per-second=1000",
+            "--response-tokens=5",
+            "--dingtalk-latency=0",
+            "--timeout=30",
+        ]
+    )
+    with patch.dict(os.environ):
+        report = run(options)
+
+    cache = report["response_cache"]
+    assert cache["exact_hits"] + cache["misses"] == 8
+    assert cache["hit_rate"] == round(cache["exact_hits"] / 8, 3)
@@ -0,0 +1,120 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import asyncio
+import io
+import json
+
+import pytest
+
+from dingtalk_app.chatbot.metrics import (
+    CARD_UPDATE,
+    OUTPUT_TOKENS,
+    TIME_TO_FIRST_TOKEN,
+    TOTAL,
+    Histogram,
+    MetricsRecorder,
+    TurnMetrics,
+)
+
+
+def test_span_records_milliseconds_also_on_error():
+    metrics = TurnMetrics()
+
+    with pytest.raises(ValueError):
+        with metrics.span(TIME_TO_FIRST_TOKEN):
+            raise ValueError()
+
+    assert len(metrics.values[TIME_TO_FIRST_TOKEN]) == 1
+    assert metrics.values[TIME_TO_FIRST_TOKEN][0] >= 0
+
+
+def test_timed_functions_record_each_call():
+    metrics = TurnMetrics()
+    update = metrics.timed(CARD_UPDATE, lambda card: card)
+
+    async def update_async(card):
+        return card
+
+    assert update("a") == "a"
+    assert asyncio.run(metrics.timed_async(CARD_UPDATE, update_async)("b")) == "b"
+    assert len(metrics.values[CARD_UPDATE]) == 2
+
+
+def test_only_the_adopted_attempt_reaches_the_turn():
+    turn = TurnMetrics(model_id="a,b")
+    abandoned, answered = turn.attempt(), turn.attempt()
+    abandoned.model_id, answered.model_id = "a", "b"
+    abandoned.observe(TIME_TO_FIRST_TOKEN, 10000)
+    answered.observe(TIME_TO_FIRST_TOKEN, 200)
+
+    turn.adopt(answered)
+    answered.observe(OUTPUT_TOKENS, 3)
+    abandoned.observe(OUTPUT_TOKENS, 5)
+
+    assert turn.model_id == "b"
+    assert turn.values == {TIME_TO_FIRST_TOKEN: [200], OUTPUT_TOKENS: [3]}
+
+
+def test_emf_line_per_turn():
+    stream = io.StringIO()
+    recorder = MetricsRecorder(namespace="Test", emf=True, stream=stream)
+    metrics = recorder.turn("anthropic.claude-v2:1")
+    metrics.observe(TIME_TO_FIRST_TOKEN, 120.5)
+    metrics.observe(CARD_UPDATE, 10)
+    metrics.observe(CARD_UPDATE, 20)
+    metrics.generated(50, 2)
+
+    metrics.finish()
+    metrics.finish()
+
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 1
+    document = json.loads(lines[0])
+    directive = document["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == "Test"
+    assert directive["Dimensions"] == [["ModelId"]]
+    units = {metric["Name"]: metric["Unit"] for metric in directive["Metrics"]}
+    assert units[TIME_TO_FIRST_TOKEN] == "Milliseconds"
+    assert units[OUTPUT_TOKENS] == "Count"
+    assert units["TokensPerSecond"] == "Count/Second"
+    assert document["ModelId"] == "anthropic.claude-v2:1"
+    assert document[TIME_TO_FIRST_TOKEN] == 120.5
+    assert document[CARD_UPDATE] == [10, 20]
+    assert document["TokensPerSecond"] == 25
+    assert document[TOTAL] >= 0
+
+
+def test_disabled_recorder_writes_nothing():
+    stream = io.StringIO()
+    recorder = MetricsRecorder(stream=stream)
+
+    recorder.turn("model").finish()
+
+    assert stream.getvalue() == ""
+    assert recorder.dump() == {}
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    for value in range(1, 1001):
+        histogram.add(value)
+
+    summary = histogram.summary()
+    assert summary["count"] == 1000
+    assert summary["max"] == 1000
+    for q, key in [(0.5, "p50"), (0.95, "p95"), (0.99, "p99")]:
+        assert q * 1000 <= summary[key] <= q * 1000 * 1.1
+
+
+def test_histograms_are_kept_per_model_and_stage():
+    recorder = MetricsRecorder(histograms=True)
+    for model_id, latency in [("a", 100), ("a", 200), ("b", 50)]:
+        metrics = recorder.turn(model_id)
+        metrics.observe(TIME_TO_FIRST_TOKEN, latency)
+        metrics.finish()
+
+    dump = recorder.dump()
+    assert dump["a"][TIME_TO_FIRST_TOKEN]["count"] == 2
+    assert dump["a"][TIME_TO_FIRST_TOKEN]["max"] == 200
+    assert dump["b"][TOTAL]["count"] == 1
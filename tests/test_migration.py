@@ -0,0 +1,106 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import sys
+import os
+
+from langchain_core.messages import AIMessage, HumanMessage, messages_to_dict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../dingtalk_app"))
+from dingtalk_app.chatbot.dynamodb import DynamoDBChatMessageHistory
+from dingtalk_app.chatbot.migration import migrate_to_message_layout
+
+
+def message_history(session, session_id, **kwargs):
+    return DynamoDBChatMessageHistory(
+        table_name="message_table",
+        session_id=session_id,
+        boto3_session=session,
+        storage_mode="message",
+        **{"limited_item_count": 10, **kwargs},
+    )
+
+
+def put_history(session, session_id, *contents):
+    session.resource("dynamodb").Table("conversation_table").put_item(
+        Item={
+            "SessionId": session_id,
+            "History": messages_to_dict(
+                [HumanMessage(content=content) for content in contents]
+            ),
+        }
+    )
+
+
+def test_migrates_history_into_message_items(session):
+    put_history(session, "old", "q1", "q2")
+
+    assert migrate_to_message_layout("conversation_table", "message_table") == 2
+
+    assert [m.content for m in message_history(session, "old").messages] == [
+        "q1",
+        "q2",
+    ]
+
+
+def test_session_with_both_layouts_keeps_the_older_messages_first(session):
+    # The service was switched to the message layout before the migration ran.
+    put_history(session, "both", "q1", "q2")
+    message_history(session, "both").add_messages(
+        [HumanMessage(content="q3"), AIMessage(content="a3")]
+    )
+
+    assert migrate_to_message_layout("conversation_table", "message_table") == 2
+    # Re-running it copies nothing twice.
+    assert migrate_to_message_layout("conversation_table", "message_table") == 0
+
+    assert [m.content for m in message_history(session, "both").messages] == [
+        "q1",
+        "q2",
+        "q3",
+        "a3",
+    ]
+
+
+def test_session_reset_after_the_switch_is_not_brought_back(session):
+    put_history(session, "reset", "old secret q", "old a")
+    history = message_history(session, "reset")
+    history.add_messages([HumanMessage(content="q1"), AIMessage(content="a1")])
+    history.clear()
+    history.add_messages([HumanMessage(content="q2"), AIMessage(content="a2")])
+
+    assert migrate_to_message_layout("conversation_table", "message_table") == 0
+
+    assert [m.content for m in message_history(session, "reset").messages] == [
+        "q2",
+        "a2",
+    ]
+
+
+def test_backups_are_not_migrated(session):
+    put_history(session, "cleared#1700000000000", "q1", "q2")
+
+    assert migrate_to_message_layout("conversation_table", "message_table") == 0
+
+
+def test_summary_moves_to_the_head_item(session):
+    session.resource("dynamodb").Table("conversation_table").put_item(
+        Item={
+            "SessionId": "summarized",
+            "History": messages_to_dict(
+                [HumanMessage(content=c) for c in ("q1", "q2", "q3")]
+            ),
+            "Summary": "about q1 and q2",
+            "SummarizedCount": 2,
+        }
+    )
+
+    assert migrate_to_message_layout("conversation_table", "message_table") == 3
+
+    history = message_history(
+        session, "summarized", memory_mode="summary", limited_item_count=0
+    )
+    assert history.summarize_pending(
+        lambda summary, messages: summary + "".join(m.content for m in messages)
+    )
+    assert history.summary == "about q1 and q2q3"
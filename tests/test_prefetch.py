@@ -0,0 +1,93 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import sys
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+import boto3
+import pytest
+from langchain_core.messages import HumanMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../dingtalk_app"))
+from dingtalk_app.chatbot.dynamodb import DynamoDBChatMessageHistory
+from dingtalk_app.chatbot.prefetch import HistoryBatcher
+
+
+def test_concurrent_reads_share_one_request(table):
+    for session_id in ("a", "b"):
+        table.put_item(Item={"SessionId": session_id, "History": [session_id]})
+    batcher = HistoryBatcher(window_seconds=0.2)
+    session_ids = ["a", "b", "a", "missing"]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        responses = list(
+            executor.map(
+                lambda s: batcher.get_item(table, {"SessionId": s}), session_ids
+            )
+        )
+
+    assert [r.get("Item", {}).get("History") for r in responses] == [
+        ["a"],
+        ["b"],
+        ["a"],
+        None,
+    ]
+    # The duplicate key is read once.
+    assert batcher.stats() == {"requests": 4, "batches": 1, "keys": 3, "fallbacks": 0}
+
+
+def test_unprocessed_keys_are_retried_then_read_one_by_one():
+    table = MagicMock()
+    table.name = "conversation_table"
+    table.meta.client.batch_get_item.return_value = {
+        "Responses": {"conversation_table": []},
+        "UnprocessedKeys": {"conversation_table": {"Keys": [{"SessionId": "a"}]}},
+    }
+    table.get_item.return_value = {"Item": {"SessionId": "a", "History": []}}
+    batcher = HistoryBatcher(window_seconds=0, max_attempts=2)
+
+    response = batcher.get_item(table, {"SessionId": "a"})
+
+    assert response == {"Item": {"SessionId": "a", "History": []}}
+    assert table.meta.client.batch_get_item.call_count == 2
+    assert batcher.stats()["fallbacks"] == 1
+
+
+def test_errors_reach_every_waiting_read():
+    table = MagicMock()
+    table.name = "conversation_table"
+    started = threading.Event()
+
+    def batch_get_item(**kwargs):
+        started.set()
+        raise RuntimeError("unavailable")
+
+    table.meta.client.batch_get_item.side_effect = batch_get_item
+    batcher = HistoryBatcher(window_seconds=0.2)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(batcher.get_item, table, {"SessionId": s})
+            for s in ("a", "b")
+        ]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="unavailable"):
+                future.result()
+    assert table.meta.client.batch_get_item.call_count == 1
+
+
+def test_history_reads_through_the_batcher(table):
+    batcher = HistoryBatcher(window_seconds=0)
+    history = DynamoDBChatMessageHistory(
+        table_name="conversation_table",
+        session_id="conversation",
+        boto3_session=boto3.session.Session(region_name="us-west-2"),
+        batcher=batcher,
+    )
+    history.add_message(HumanMessage(content="hi"))
+
+    assert [m.content for m in history.messages] == ["hi"]
+    assert batcher.stats()["batches"] == 1
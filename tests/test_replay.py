@@ -0,0 +1,123 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+
+from benchmarks import replay
+
+LOGGED = (
+    "2024-03-01 10:00:00,001 INFO:dingtalk_bedrock:{'conversationId': 'cid-group', "
+    "'conversationType': '2', 'msgId': 'm1', 'msgtype': 'text', "
+    "'text': {'content': ' hello'}, 'createAt': 1709287200000}"
+)
+RECORDING = [
+    "INFO:dingtalk_bedrock:<dingtalk_stream.frames.Headers object at 0x7f>",
+    LOGGED,
+    LOGGED,
+    json.dumps(
+        {
+            "conversationId": "cid-group",
+            "conversationType": "2",
+            "msgId": "m2",
+            "msgtype": "text",
+            "text": {"content": "help"},
+            "createAt": 1709287200500,
+        }
+    ),
+    json.dumps(
+        {
+            "headers": {},
+            "data": json.dumps(
+                {
+                    "conversationId": "cid-1",
+                    "msgId": "m3",
+                    "msgtype": "text",
+                    "text": {"content": "question"},
+                    "createAt": 1709287230000,
+                }
+            ),
+        }
+    ),
+    json.dumps({"conversationId": "cid-1", "msgId": "m4", "msgtype": "picture"}),
+    json.dumps({"request_id": "user-001", "title": "not a callback"}),
+]
+
+
+def test_reads_logged_and_json_payloads():
+    recording = replay.Recording().read(RECORDING)
+
+    assert [payload["msgId"] for _, payload in recording.payloads] == [
+        "m1",
+        "m2",
+        "m3",
+    ]
+    assert recording.counts == {
+        "lines": 7,
+        "skipped": 2,
+        "duplicates": 1,
+        "unsupported_picture": 1,
+    }
+
+
+@pytest.mark.parametrize(
+    "speed,max_gap,offsets", [(1, 0, [0, 0.5, 30]), (10, 1, [0, 0.05, 1.05])]
+)
+def test_schedule_keeps_the_recorded_timing(speed, max_gap, offsets):
+    recording = replay.Recording().read(RECORDING)
+
+    schedule = recording.schedule(speed=speed, max_gap=max_gap)
+
+    assert [round(offset, 3) for offset, _ in schedule] == offsets
+    assert schedule[0][1].data["text"] == {"content": " hello"}
+    assert replay.describe(schedule)["peak_messages_per_second"] == 2
+
+
+def test_payloads_without_time_are_spread_at_rate():
+    lines = [
+        json.dumps({"conversationId": "c", "msgtype": "text", "text": {"content": t}})
+        for t in ("a", "b", "c")
+    ]
+
+    schedule = replay.Recording().read(lines).schedule(rate=4)
+
+    assert [offset for offset, _ in schedule] == [0, 0.25, 0.5]
+    assert len({callback.data["msgId"] for _, callback in schedule}) == 3
+
+
+def test_replay(tmp_path, capsys):
+    recording = tmp_path / "traffic.log"
+    recording.write_text("\n".join(RECORDING))
+    output = tmp_path / "report.json"
+
+    with patch.dict(os.environ):
+        status = replay.main(
+            [
+                str(recording),
+                "--speed=100",
+                "--time-to-first-token=0.01",
+                "--tokens-per-second=1000",
+                "--response-tokens=5",
+                "--dingtalk-latency=0",
+                "--timeout=30",
+                f"--output={output}",
+            ]
+        )
+
+    report = json.loads(output.read_text())
+    assert status == 0
+    assert report["messages"] == 3
+    # The help command is answered without a turn.
+    assert report["answered"] == report["turns"] == 2
+    assert report["unfinished"] == 0
+    assert report["replay"]["group_messages"] == 2
+
+
+def test_no_payloads(tmp_path):
+    recording = tmp_path / "requests.jsonl"
+    recording.write_text(json.dumps({"request_id": "user-001"}))
+
+    assert replay.main([str(recording)]) == 2
@@ -0,0 +1,127 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+from unittest.mock import patch
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from dingtalk_app.chatbot.response_cache import (
+    ResponseCache,
+    conversation_context,
+    normalize_question,
+)
+
+MODEL_ID = "anthropic.claude-v2:1"
+
+
+def answered(cache, question, response, model_id=MODEL_ID):
+    lookup = cache.lookup(question, model_id)
+    assert lookup.response is None
+    cache.store(lookup, response)
+
+
+def test_normalize_question():
+    assert normalize_question("  How do I  Reset？ ") == "how do i reset"
+    assert normalize_question("ＶＰＮ怎么连接？！") == "vpn怎么连接"
+
+
+def test_exact_hit_after_normalization():
+    cache = ResponseCache()
+    answered(cache, "How do I reset my password?", "Use the portal.")
+
+    lookup = cache.lookup("how do i reset  my password", MODEL_ID)
+
+    assert lookup.response == "Use the portal."
+    assert lookup.similarity == 1.0
+    assert cache.stats()["exact_hits"] == 1
+
+
+def test_scope_separates_models_and_contexts():
+    cache = ResponseCache()
+    answered(cache, "How do I reset my password?", "Use the portal.")
+
+    assert cache.lookup("How do I reset my password?", "other-model").response is None
+    assert (
+        cache.lookup("How do I reset my password?", MODEL_ID, "other").response is None
+    )
+
+
+def test_conversations_with_different_histories_do_not_share_responses():
+    cache = ResponseCache()
+    first = [HumanMessage(content="My laptop runs Linux"), AIMessage(content="OK")]
+    second = [HumanMessage(content="My laptop runs Windows"), AIMessage(content="OK")]
+    question = "How do I install the VPN client?"
+
+    lookup = cache.lookup(question, MODEL_ID, conversation_context("t", first))
+    cache.store(lookup, "Use apt.")
+
+    assert (
+        cache.lookup(question, MODEL_ID, conversation_context("t", second)).response
+        is None
+    )
+    assert cache.lookup(question, MODEL_ID, conversation_context("t")).response is None
+    assert (
+        cache.lookup(question, MODEL_ID, conversation_context("t", first, "s")).response
+        is None
+    )
+    assert (
+        cache.lookup(question, MODEL_ID, conversation_context("t", first)).response
+        == "Use apt."
+    )
+
+
+def test_longer_conversations_have_no_context():
+    turn = [HumanMessage(content="hi"), AIMessage(content="hello")]
+
+    assert conversation_context("t", turn, max_turns=1) is not None
+    assert conversation_context("t", turn * 2, max_turns=1) is None
+    # A window starting with an answer.
+    assert conversation_context("t", turn[1:] + turn, max_turns=1) is None
+    assert conversation_context("t", turn * 2) is not None
+
+
+def test_short_questions_are_not_cached():
+    assert ResponseCache().lookup("why?", MODEL_ID) is None
+
+
+def test_ttl_and_lru_eviction():
+    cache = ResponseCache(max_entries=2, ttl_seconds=10)
+    with patch("dingtalk_app.chatbot.response_cache.time.monotonic") as monotonic:
+        monotonic.return_value = 0
+        answered(cache, "first question", "1")
+        answered(cache, "second question", "2")
+        cache.lookup("first question", MODEL_ID)
+        answered(cache, "third question", "3")
+
+        assert cache.lookup("second question", MODEL_ID).response is None
+        assert cache.lookup("first question", MODEL_ID).response == "1"
+        assert cache.stats()["evictions"] == 1
+
+        monotonic.return_value = 11
+        assert cache.lookup("first question", MODEL_ID).response is None
+
+
+def fake_embed(text):
+    # Questions about passwords point one way, the others another way.
+    if "password" in text:
+        return [1.0, 0.1 if "forgot" in text else 0.0, 0.0]
+    return [0.0, 0.0, 1.0]
+
+
+def test_semantic_hit_above_threshold():
+    cache = ResponseCache(embed=fake_embed, similarity_threshold=0.9)
+    answered(cache, "How do I reset my password?", "Use the portal.")
+
+    lookup = cache.lookup("I forgot my password, help", MODEL_ID)
+
+    assert lookup.response == "Use the portal."
+    assert 0.9 <= lookup.similarity < 1.0
+    assert cache.lookup("Where is the canteen?", MODEL_ID).response is None
+    assert cache.stats()["semantic_hits"] == 1
+
+
+def test_semantic_hit_stays_within_scope():
+    cache = ResponseCache(embed=fake_embed, similarity_threshold=0.9)
+    answered(cache, "How do I reset my password?", "Use the portal.")
+
+    assert cache.lookup("I forgot my password", "other-model").response is None
@@ -0,0 +1,309 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import asyncio
+import itertools
+import random
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+import pytest
+from botocore.credentials import Credentials
+
+from dingtalk_app.chatbot.bedrock_async import AsyncBedrockClient
+from dingtalk_app.chatbot.metrics import (
+    HISTORY_LOAD,
+    PROMPT_BUILD,
+    TIME_TO_FIRST_TOKEN,
+    TurnMetrics,
+)
+from dingtalk_app.chatbot.router import (
+    Endpoint,
+    FirstTokenTimeout,
+    ModelRouter,
+    RoutedChatbot,
+    parse_endpoints,
+)
+
+
+class FakeChatbot:
+    """Streams `chunks`, or raises `error` before or after the first chunk."""
+
+    prompt = "template"
+
+    def __init__(self, chunks=("Hello", " there"), error=None, stall=0, after=None):
+        self.chunks = chunks
+        self.error = error
+        self.stall = stall
+        self.after = after
+        self.usage_totals = Counter(input_tokens=1)
+        self.calls = 0
+        self.requests = []
+
+    def build_request(self, input_text, history, summary="", stop=None):
+        return {"input": input_text, "history": history, "summary": summary}
+
+    request_body = build_request
+
+    def stream(self):
+        for position, chunk in enumerate(self.chunks):
+            if self.after == position:
+                raise self.error
+            yield chunk
+
+    def ask_stream(self, input_text, **kwargs):
+        self.calls += 1
+        self.requests.append(kwargs.get("request"))
+        threading.Event().wait(self.stall)
+        if self.error is not None and self.after is None:
+            raise self.error
+        chunks = self.stream()
+        first = next(chunks)
+        return itertools.chain([first], chunks)
+
+    async def ask_stream_async(self, bedrock_client, input_text, *args, **kwargs):
+        self.calls += 1
+        self.requests.append(kwargs.get("body"))
+        self.client = bedrock_client
+        await asyncio.sleep(self.stall)
+        if self.error is not None and self.after is None:
+            raise self.error
+        for chunk in self.stream():
+            yield chunk
+
+    def summarize(self, summary, messages):
+        if self.error is not None:
+            raise self.error
+        return "summary"
+
+
+class MeteredChatbot(FakeChatbot):
+    """Observes its model and first token, like `Chatbot`, and tells whether
+    its stream was closed."""
+
+    def __init__(self, model_id, **kwargs):
+        super().__init__(**kwargs)
+        self.model_id = model_id
+        self.closed = threading.Event()
+
+    def ask_stream(self, input_text, metrics=None, **kwargs):
+        metrics.model_id = self.model_id
+        with metrics.span(TIME_TO_FIRST_TOKEN):
+            chunks = super().ask_stream(input_text, **kwargs)
+        return self.relay(chunks)
+
+    def relay(self, chunks):
+        try:
+            yield from chunks
+        finally:
+            self.closed.set()
+
+
+class FirstChoice(random.Random):
+    """Draws the first available endpoint, so failover order is predictable."""
+
+    def choices(self, population, weights=None, **kwargs):
+        return [population[0]]
+
+
+def routed(chatbots, **kwargs):
+    endpoints = [Endpoint(name) for name in chatbots]
+    return RoutedChatbot(
+        endpoints,
+        chatbot_factory=lambda endpoint: chatbots[endpoint.model_id],
+        rng=FirstChoice(),
+        **kwargs,
+    )
+
+
+def test_parse_endpoints():
+    endpoints = parse_endpoints(
+        "anthropic.claude-3-haiku-20240307-v1:0@us-west-2=2, anthropic.claude-v2:1"
+    )
+
+    assert [(e.model_id, e.region_name, e.weight) for e in endpoints] == [
+        ("anthropic.claude-3-haiku-20240307-v1:0", "us-west-2", 2.0),
+        ("anthropic.claude-v2:1", None, 1.0),
+    ]
+    assert endpoints[0].name == "anthropic.claude-3-haiku-20240307-v1:0@us-west-2"
+
+
+def test_duplicate_endpoints_are_rejected():
+    with pytest.raises(ValueError):
+        ModelRouter([Endpoint("a", "us-west-2"), Endpoint("a", "us-west-2")])
+
+
+def test_calls_are_spread_by_weight():
+    heavy, light = Endpoint("heavy", weight=3), Endpoint("light")
+    router = ModelRouter([heavy, light], rng=random.Random(0))
+
+    firsts = Counter(router.candidates()[0].name for _ in range(2000))
+
+    assert 0.7 < firsts["heavy"] / 2000 < 0.8
+
+
+def test_unhealthy_endpoints_get_fewer_calls_and_are_taken_out():
+    good, bad = Endpoint("good"), Endpoint("bad")
+    router = ModelRouter(
+        [good, bad], failure_threshold=3, cooldown_seconds=60, rng=FirstChoice()
+    )
+    router.succeeded(good, 0.5)
+    router.failed(bad)
+
+    assert router.score(bad) < router.score(good)
+
+    router.failed(bad)
+    router.failed(bad)
+
+    assert router.candidates() == [good, bad]
+    assert router.stats()["bad"] == {
+        "calls": 3,
+        "failures": 3,
+        "first_token_ms": None,
+        "error_rate": 0.488,
+        "out": True,
+    }
+
+
+def test_fails_over_before_the_first_token():
+    failing = FakeChatbot(error=ValueError("ThrottlingException"))
+    backup = FakeChatbot()
+    chatbot = routed({"a": failing, "b": backup})
+
+    assert list(chatbot.ask_stream("hi")) == ["Hello", " there"]
+    assert failing.calls == backup.calls == 1
+    assert chatbot.stats()["a"]["failures"] == 1
+    assert chatbot.stats()["b"]["failures"] == 0
+
+
+def test_history_is_read_and_the_request_built_once():
+    failing = FakeChatbot(error=ValueError("ThrottlingException"))
+    backup = FakeChatbot()
+    chatbot = RoutedChatbot(
+        [Endpoint("a", "us-west-2"), Endpoint("a", "us-east-1")],
+        chatbot_factory=lambda endpoint: {"us-west-2": failing, "us-east-1": backup}[
+            endpoint.region_name
+        ],
+        rng=FirstChoice(),
+    )
+    memory = MagicMock()
+    memory.chat_memory.messages = ["message"]
+    memory.chat_memory.summary = "summary"
+    metrics = TurnMetrics()
+
+    assert list(
+        chatbot.ask_stream("hi", conversation_history=memory, metrics=metrics)
+    ) == ["Hello", " there"]
+
+    assert len(metrics.values[HISTORY_LOAD]) == 1
+    assert len(metrics.values[PROMPT_BUILD]) == 1
+    assert (
+        failing.requests
+        == backup.requests
+        == [{"input": "hi", "history": ["message"], "summary": "summary"}]
+    )
+
+
+def test_busy_first_token_threads_do_not_queue_calls():
+    stalled, backup = FakeChatbot(stall=0.5), FakeChatbot()
+    chatbot = routed({"a": stalled, "b": backup}, first_token_timeout=0.05)
+    chatbot.first_token_executor = ThreadPoolExecutor(max_workers=1)
+    chatbot._first_token_slots = threading.BoundedSemaphore(1)
+
+    # The stalled call is abandoned and keeps the only thread, the backup
+    # answers in the caller's thread.
+    assert list(chatbot.ask_stream("hi")) == ["Hello", " there"]
+    assert backup.calls == 1
+
+
+def test_fails_over_when_the_first_token_stalls():
+    stalled, backup = FakeChatbot(stall=1), FakeChatbot()
+    chatbot = routed({"a": stalled, "b": backup}, first_token_timeout=0.05)
+
+    assert list(chatbot.ask_stream("hi")) == ["Hello", " there"]
+    assert chatbot.stats()["a"]["failures"] == 1
+
+
+def test_abandoned_calls_are_closed_and_left_out_of_the_metrics():
+    stalled, backup = MeteredChatbot("a", stall=0.2), MeteredChatbot("b")
+    chatbot = routed({"a": stalled, "b": backup}, first_token_timeout=0.05)
+    metrics = TurnMetrics()
+
+    assert list(chatbot.ask_stream("hi", metrics=metrics)) == ["Hello", " there"]
+    # The stalled call streams its first token after the backup answered.
+    assert stalled.closed.wait(1)
+
+    assert metrics.model_id == "b"
+    assert len(metrics.values[TIME_TO_FIRST_TOKEN]) == 1
+    assert metrics.values[TIME_TO_FIRST_TOKEN][0] < 200
+
+
+def test_errors_while_streaming_are_raised():
+    failing = FakeChatbot(error=ValueError("stream broke"), after=1)
+    backup = FakeChatbot()
+    chatbot = routed({"a": failing, "b": backup})
+
+    chunks = chatbot.ask_stream("hi")
+    with pytest.raises(ValueError, match="stream broke"):
+        list(chunks)
+
+    assert backup.calls == 0
+    assert chatbot.stats()["a"]["calls"] == 1
+    assert chatbot.stats()["a"]["failures"] == 1
+
+
+def test_raises_the_last_error_when_all_endpoints_fail():
+    chatbot = routed(
+        {
+            "a": FakeChatbot(error=ValueError("first")),
+            "b": FakeChatbot(error=ValueError("last")),
+        }
+    )
+
+    with pytest.raises(ValueError, match="last"):
+        chatbot.ask_stream("hi")
+
+
+def test_chatbot_interface():
+    chatbot = routed({"a": FakeChatbot(error=ValueError()), "b": FakeChatbot()})
+
+    assert chatbot.model_id == "a,b"
+    assert chatbot.prompt == "template"
+    assert chatbot.usage_totals == Counter(input_tokens=2)
+    assert chatbot.summarize("", []) == "summary"
+
+
+def test_async_fails_over_to_the_region_of_the_next_endpoint():
+    failing, backup = FakeChatbot(stall=1), FakeChatbot()
+    chatbot = RoutedChatbot(
+        [Endpoint("a", "us-west-2"), Endpoint("b", "us-east-1")],
+        chatbot_factory=lambda endpoint: {"a": failing, "b": backup}[endpoint.model_id],
+        first_token_timeout=0.05,
+        rng=FirstChoice(),
+    )
+
+    async def run():
+        client = AsyncBedrockClient(
+            None, region_name="us-west-2", credentials=Credentials("AKID", "SECRET")
+        )
+        return client, [text async for text in chatbot.ask_stream_async(client, "hi")]
+
+    client, chunks = asyncio.run(run())
+
+    assert chunks == ["Hello", " there"]
+    assert chatbot.stats()["a@us-west-2"]["failures"] == 1
+    assert backup.client.region_name == "us-east-1"
+    assert (
+        backup.client.endpoint_url == "https://bedrock-runtime.us-east-1.amazonaws.com"
+    )
+    assert client.for_region("us-east-1") is backup.client
+    assert client.for_region("us-west-2") is client
+
+
+def test_first_token_timeout_error():
+    chatbot = routed({"a": FakeChatbot(stall=1)}, first_token_timeout=0.05)
+
+    with pytest.raises(FirstTokenTimeout):
+        chatbot.ask_stream("hi")
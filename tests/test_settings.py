@@ -1,10 +1,19 @@
 #  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
 #  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
 
+import functools
 import pytest
 import os
 import json
-from dingtalk_app.chatbot.settings import load_dingtalk_app_setting
+import threading
+
+import dingtalk_stream
+
+from dingtalk_app.chatbot.settings import (
+    DingTalkCredentialProvider,
+    load_dingtalk_app_setting,
+    update_stream_credential,
+)
 
 
 def read_config():
@@ -36,3 +45,112 @@ def test_get_dingtalk_settings(secret_name, region_name):
 
     # assert app_key.startswith("dingxct5ui")
     # assert app_secret.startswith("3u_e7gBNrg")
+
+
+@pytest.fixture
+def secret(aws):
+    client = aws.client("secretsmanager")
+    client.create_secret(
+        Name="dingtalk_app_credential",
+        SecretString=json.dumps({"AppKey": "key1", "AppSecret": "secret1"}),
+    )
+    return client
+
+
+def test_provider_reads_the_secret_once(secret):
+    loads = []
+
+    def loader(*args):
+        loads.append(args)
+        return load_dingtalk_app_setting(*args)
+
+    provider = DingTalkCredentialProvider(
+        "dingtalk_app_credential", "us-west-2", environ={}, loader=loader
+    )
+
+    assert provider.get() == ("key1", "secret1")
+    assert provider.get() == ("key1", "secret1")
+    assert provider.source == "secretsmanager"
+    assert len(loads) == 1
+
+
+def test_provider_starts_from_the_environment_without_network():
+    def loader(*args):
+        raise AssertionError("Secrets Manager must not be called")
+
+    provider = DingTalkCredentialProvider(
+        "dingtalk_app_credential",
+        "us-west-2",
+        environ={"DINGTALK_APP_KEY": "key", "DINGTALK_APP_SECRET": "secret"},
+        loader=loader,
+    )
+
+    assert provider.get() == ("key", "secret")
+    assert provider.source == "environment"
+
+
+def test_provider_falls_back_to_a_file(tmp_path):
+    path = tmp_path / "dingtalk.json"
+    path.write_text(json.dumps({"AppKey": "key", "AppSecret": "secret"}))
+
+    def loader(*args):
+        raise ConnectionError("offline")
+
+    provider = DingTalkCredentialProvider(
+        "dingtalk_app_credential",
+        "us-west-2",
+        fallback_file=str(path),
+        environ={},
+        loader=loader,
+    )
+
+    assert provider.get() == ("key", "secret")
+    assert provider.source == "file"
+    # Still offline, the file credentials are kept.
+    assert provider.refresh() is False
+    assert provider.get() == ("key", "secret")
+
+
+def test_rotation_updates_the_stream_client(secret):
+    stream_client = dingtalk_stream.DingTalkStreamClient(
+        dingtalk_stream.Credential("key1", "secret1")
+    )
+    stream_client._access_token = {"accessToken": "old", "expireTime": 2**40}
+    provider = DingTalkCredentialProvider(
+        "dingtalk_app_credential", "us-west-2", environ={}
+    )
+    provider.get()
+    provider.subscribe(functools.partial(update_stream_credential, stream_client))
+
+    assert provider.refresh() is False
+
+    secret.put_secret_value(
+        SecretId="dingtalk_app_credential",
+        SecretString=json.dumps({"AppKey": "key2", "AppSecret": "secret2"}),
+    )
+
+    assert provider.refresh() is True
+    assert provider.rotations == 1
+    assert stream_client.credential.client_id == "key2"
+    assert stream_client.credential.client_secret == "secret2"
+    assert stream_client._access_token == {}
+
+
+def test_background_refresh():
+    versions = iter([("key1", "secret1"), ("key2", "secret2")])
+    rotated = threading.Event()
+    provider = DingTalkCredentialProvider(
+        "dingtalk_app_credential",
+        ttl_seconds=0.01,
+        environ={},
+        loader=lambda *args: next(versions, ("key2", "secret2")),
+    )
+    provider.subscribe(lambda credentials: rotated.set())
+
+    provider.start()
+    try:
+        assert rotated.wait(5)
+    finally:
+        provider.stop()
+
+    assert provider.get() == ("key2", "secret2")
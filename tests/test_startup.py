@@ -0,0 +1,58 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import json
+import subprocess
+import sys
+
+from benchmarks.startup import DEFERRED_MODULES, check, parse_importtime, probe
+
+IMPORTTIME = """\
+import time: self [us] | cumulative | imported package
+import time:      1000 |       1000 | site
+import time:       500 |        500 |     langchain_core.messages.base
+import time:      2000 |       2500 |   langchain_core.messages
+import time:      3000 |       3000 |   chatbot.templates
+import time:      4000 |       9500 | app
+"""
+
+
+def test_parse_importtime_splits_the_app():
+    assert parse_importtime(IMPORTTIME) == {
+        "site": 1.0,
+        "langchain_core": 2.5,
+        "chatbot.templates": 3.0,
+    }
+
+
+def dingtalk_stream_modules():
+    """The deferred modules the installed dingtalk_stream imports itself.
+
+    Newer releases than the pinned one import aiohttp, which the app cannot
+    defer.
+    """
+    code = (
+        "import json, sys, dingtalk_stream; "
+        f"print(json.dumps([m for m in {DEFERRED_MODULES!r} if m in sys.modules]))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    return set(json.loads(output))
+
+
+def test_model_modules_are_loaded_after_connecting():
+    times = probe(sys.executable, "thread", "anthropic.claude-v2:1")
+    preloaded = dingtalk_stream_modules()
+
+    assert set(times["eager_modules"]) - preloaded == set()
+    assert "langchain" in times["preload_imports"]
+    assert not (set(DEFERRED_MODULES) - preloaded) & set(times["imports"])
+
+
+def test_budget():
+    report = {"connect_ms": 300, "eager_modules": []}
+
+    assert check(report, budget_ms=1000) == []
+    assert check(report, budget_ms=0) == []
+    assert check(report, budget_ms=200) == ["connect_ms 300 exceeds the budget of 200"]
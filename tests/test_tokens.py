@@ -0,0 +1,73 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import sys
+import os
+from unittest.mock import MagicMock
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../dingtalk_app"))
+from dingtalk_app.chatbot.dynamodb import DynamoDBChatMessageHistory
+from dingtalk_app.chatbot.tokens import (
+    TOKEN_COUNT_KEY,
+    estimate_tokens,
+    message_tokens,
+    select_history,
+)
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd" * 10) == 10
+    assert estimate_tokens("你好世界") == 4
+
+
+def test_stored_token_count_is_used():
+    message = HumanMessage(content="x" * 400)
+    assert message_tokens(message) == 104
+
+    message.additional_kwargs[TOKEN_COUNT_KEY] = 7
+    assert message_tokens(message) == 7
+
+
+def counted(message, tokens):
+    message.additional_kwargs[TOKEN_COUNT_KEY] = tokens
+    return message
+
+
+def test_select_history_fills_newest_first():
+    history = [
+        counted(HumanMessage(content="q1"), 50),
+        counted(AIMessage(content="a1"), 50),
+        counted(HumanMessage(content="q2"), 10),
+        counted(AIMessage(content="a2"), 10),
+    ]
+
+    assert [m.content for m in select_history(history, 1000)] == [
+        "q1",
+        "a1",
+        "q2",
+        "a2",
+    ]
+    assert [m.content for m in select_history(history, 80)] == ["q2", "a2"]
+    # Never start with an answer whose question was dropped.
+    assert select_history(history, 15) == []
+
+
+def test_token_counts_round_trip_through_dynamodb():
+    history = DynamoDBChatMessageHistory(
+        table_name="conversation_table",
+        session_id="conversation",
+        boto3_session=MagicMock(),
+    )
+
+    history.add_messages([HumanMessage(content="abcd" * 10)])
+    stored = history.table.update_item.call_args.kwargs["ExpressionAttributeValues"][
+        ":messages"
+    ]
+    assert stored[0][TOKEN_COUNT_KEY] == 14
+
+    history.table.get_item.return_value = {"Item": {"History": stored}}
+    (message,) = history.messages
+    assert message.additional_kwargs[TOKEN_COUNT_KEY] == 14
@@ -0,0 +1,117 @@
+#  Copyright 2023 Amazon.com and its affiliates; all rights reserved.
+#  This file is Amazon Web Services Content and may not be duplicated or distributed without permission.
+
+import asyncio
+import threading
+
+from dingtalk_app.chatbot.worker_pool import InflightLimiter, WorkerPool
+
+
+def test_try_submit_refuses_work_beyond_the_queue_bound():
+    release = threading.Event()
+    started = threading.Event()
+    pool = WorkerPool(max_workers=1, max_queue_size=1)
+
+    def work():
+        started.set()
+        release.wait(5)
+
+    running = pool.try_submit(work)
+    started.wait(5)
+    queued = pool.try_submit(work)
+    refused = pool.try_submit(work)
+
+    assert running is not None and queued is not None
+    assert refused is None
+    assert pool.stats() == {
+        "workers": 1,
+        "active": 1,
+        "queued": 1,
+        "completed": 0,
+        "rejected": 1,
+    }
+
+    release.set()
+    running.result(5)
+    queued.result(5)
+    pool.shutdown()
+    assert pool.stats()["completed"] == 2
+    assert pool.stats()["active"] == pool.stats()["queued"] == 0
+
+
+def test_concurrent_try_submit_never_exceeds_the_bound():
+    release = threading.Event()
+    pool = WorkerPool(max_workers=2, max_queue_size=3)
+    barrier = threading.Barrier(20)
+    accepted = []
+
+    def offer():
+        barrier.wait(5)
+        future = pool.try_submit(release.wait, 5)
+        if future is not None:
+            accepted.append(future)
+
+    threads = [threading.Thread(target=offer) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(accepted) == 5
+    assert pool.stats()["rejected"] == 15
+    release.set()
+    for future in accepted:
+        future.result(5)
+    # The places are free again once the tasks are done.
+    assert pool.try_submit(lambda: None).result(5) is None
+    pool.shutdown()
+
+
+def test_submit_is_not_bounded():
+    pool = WorkerPool(max_workers=1, max_queue_size=0)
+
+    assert [pool.submit(lambda n=n: n).result(5) for n in range(3)] == [0, 1, 2]
+    assert pool.stats()["rejected"] == 0
+
+
+def test_inflight_limiter_bounds_concurrent_calls():
+    limiter = InflightLimiter(2)
+    lock = threading.Lock()
+    peak = [0]
+    barrier = threading.Barrier(2)
+
+    def call():
+        with limiter:
+            with lock:
+                peak[0] = max(peak[0], limiter.in_flight)
+            try:
+                barrier.wait(0.05)
+            except threading.BrokenBarrierError:
+                pass
+
+    threads = [threading.Thread(target=call) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert peak[0] == 2
+    assert limiter.stats() == {"model_calls_in_flight": 0, "model_calls_waiting": 0}
+
+
+def test_inflight_limiter_async():
+    limiter = InflightLimiter(1)
+    seen = []
+
+    async def call():
+        async with limiter:
+            await asyncio.sleep(0.01)
+            seen.append((limiter.in_flight, limiter.waiting))
+
+    async def run():
+        await asyncio.gather(call(), call(), call())
+
+    asyncio.run(run())
+
+    assert seen == [(1, 2), (1, 1), (1, 0)]
+    assert limiter.in_flight == 0